@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+合成データで各スクリプトの処理時間を測るベンチマーク.
+
+実データ (2025MMDD/ の約 2.7k ファイル) と同じ形の JSON を
+乱数の種を固定して作り，読み込み・CSV・表・抽出・あてはめ・散布図の
+段階ごとの時間を表示する. また，まとめて計算する経路が
+1 件ずつ計算する経路と同じ CSV と表を出すことを確かめる.
+
+  $ python bench.py --scale 10
+  $ python bench.py --days 3 --per-day 300 --out /tmp/bench --keep
+  $ python bench.py --pack
+"""
+
+import contextlib
+import csv
+import datetime
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import common
+from common import readDataset, iter_records, limitedJsons, set_ru_model
+from common import parse_cond, predicate_mask, profile_stage, compactDir
+from common import classify
+from common import add_profile_arguments, start_profile
+
+# 実データの 1 日あたりの件数と日数
+REAL_PER_DAY = 104
+REAL_DAYS = 26
+FIRST_DAY = datetime.date(2025, 10, 8)
+# この日までのファイルには user_rank, following, followers, name がない
+LAST_DAY_WITHOUT_PROFILE = '20251022'
+
+USER_RANKS = ['D', 'C1', 'C2', 'C3', 'B1', 'B2', 'B3',
+              'A1', 'A2', 'A3', 'A4', 'A5', 'S', 'SS']
+
+
+def synth_day(rng, date: str, n: int) -> list:
+  """date の n 件のレコードを livescore の降順で作る.
+
+  total_gift は対数正規分布で，livescore / total_gift は total_gift が
+  大きいほど少し下がる. gift は降順で，末尾に 0 が並ぶ.
+  """
+  total = np.clip(rng.lognormal(np.log(29_000), 1.0, n), 1_000, 3_000_000)
+  total = total.astype(np.int64)
+  rate = (3.25 - 0.3 * np.log10(total / 10_000)
+          + rng.normal(0, 0.15, n))
+  rate = np.clip(rate, 1.75, 3.57)
+  livescore = (total * rate).astype(np.int64)
+  order = np.argsort(-livescore, kind='stable')
+  profile = date > LAST_DAY_WITHOUT_PROFILE
+
+  records = []
+  for rank, i in enumerate(order, start=1):
+    data = {'livescore': int(livescore[i]),
+            'gift': synth_gift(rng, int(total[i])),
+            'date': date,
+            'rank': rank,
+            'label': str(rank)}
+    if profile:
+      # 上位ほどランクが高い
+      q = 1 - rank / (n + 1)
+      u = int(np.clip(round(q * len(USER_RANKS) + rng.normal(0, 1.5)),
+                      0, len(USER_RANKS) - 1))
+      data['user_rank'] = USER_RANKS[u]
+      data['following'] = int(rng.integers(0, 400))
+      data['followers'] = int(rng.lognormal(np.log(250), 1.0))
+      data['name'] = f'user{int(rng.integers(0, 100_000)):05d}'
+    records.append(data)
+  return records
+
+
+def synth_gift(rng, total: int) -> list:
+  """合計が total の降順のギフト. 0 のギフトが末尾に並ぶ."""
+  n = int(np.clip(rng.lognormal(np.log(31), 0.8), 1, 400))
+  zeros = int(rng.binomial(n - 1, 0.3)) if n > 1 else 0
+  w = np.sort(rng.pareto(1.1, n - zeros) + 1e-3)[::-1]
+  gift = np.floor(w / w.sum() * total).astype(np.int64)
+  gift[0] += total - gift.sum()
+  return gift.tolist() + [0] * zeros
+
+
+def generate(out: str, days: int, per_day: int, seed: int = 0) -> int:
+  """out/YYYYMMDD/<livescore>-<rank>.json を作り，件数を返す.
+
+  1 日ずつ書くので，件数によらずメモリは 1 日分.
+  """
+  rng = np.random.default_rng(seed)
+  n = 0
+  for d in range(days):
+    date = (FIRST_DAY + datetime.timedelta(days=d)).strftime('%Y%m%d')
+    dirname = os.path.join(out, date)
+    os.makedirs(dirname, exist_ok=True)
+    for data in synth_day(rng, date, per_day):
+      fname = os.path.join(dirname, f"{data['livescore']}-{data['rank']}.json")
+      with open(fname, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    n += per_day
+  return n
+
+
+def quiet():
+  """標準出力を捨てる (各関数の途中経過の表示を測らない)"""
+  return contextlib.redirect_stdout(io.StringIO())
+
+
+def check_csv(ds, root: str, cache_dir) -> bool:
+  """write_csv_file() の CSV が write_csv_row() を 1 件ずつ呼んだものと
+  同じバイト列か."""
+  from makecsv import write_csv_file, write_csv_row
+
+  fast = io.StringIO(newline='')
+  write_csv_file(fast, ds)
+  slow = io.StringIO(newline='')
+  write_csv_file(slow, [])
+  writer = csv.writer(slow)
+  for data in iter_records([root], cache_dir=cache_dir):
+    write_csv_row(writer, data)
+  return fast.getvalue() == slow.getvalue()
+
+
+def check_table(ds, root: str) -> bool:
+  """classify.count_table() の表が, 元の classify.py の filters() のように
+  レコードを 1 件ずつ数えたものと同じか."""
+  from classify import count_table, COINS, NUMS
+
+  table = count_table(ds)
+  ref = {}
+  for data in iter_records([root], cache_dir=None):
+    cls = classify(data)
+    for coin in COINS:
+      num = len([d for d in data['gift'] if d >= coin])
+      ref.setdefault((num, coin), [0] * 4)[cls] += 1
+  for num in NUMS:
+    for i, coin in enumerate(COINS):
+      if table[num, i].tolist() != ref.get((num, coin), [0] * 4):
+        return False
+  return True
+
+
+def run(root: str, n: int, scatter: bool = True, jobs: int = 1) -> bool:
+  """root のデータで各段階を測り，一致の確認がすべて通れば True.
+
+  時間は common.PROFILER に集める.
+  """
+  from makecsv import write_csv_file
+  from classify import count_table, print_html_img, select_days
+  from extract import write_data
+  from linfit import seprat, design_matrix, NormalEquations
+
+  cache_dir = os.path.join(root, '.cache')
+  with quiet():
+    set_ru_model(0)
+
+  with profile_stage('read (cold)', n):
+    ds = readDataset([root], cache_dir=cache_dir, workers=jobs)
+  with profile_stage('read (cache)', n):
+    ds = readDataset([root], cache_dir=cache_dir, workers=jobs)
+  with profile_stage('iter_records', n):
+    for _ in iter_records([root], cache_dir=cache_dir):
+      pass
+
+  with profile_stage('csv', n):
+    write_csv_file(io.StringIO(newline=''), ds)
+  with profile_stage('csv (stream)', n):
+    write_csv_file(io.StringIO(newline=''),
+                   iter_records([root], cache_dir=cache_dir))
+
+  with profile_stage('classify table', n):
+    table = count_table(select_days(ds))
+  with profile_stage('classify html', None), quiet():
+    print_html_img(table)
+
+  with profile_stage('extract filter', n):
+    sel = ds.filter(predicate_mask(ds, [parse_cond('rank<50')]))
+  with profile_stage('extract order', len(sel)):
+    sel = sel.order_by([('livescore', True)])
+  with profile_stage('extract write', len(sel)):
+    write_data(io.StringIO(), sel.records(),
+               ['date', 'rank', 'user_rank', 'total_gift', 'livescore'])
+
+  with profile_stage('linfit design', n):
+    xs, ys, _ = design_matrix(ds, False)
+  with profile_stage('linfit sums', len(ys)):
+    ne = NormalEquations(xs.shape[1])
+    ne.add(xs, ys)
+    ne.fit()
+  with profile_stage('linfit seprat', n), quiet():
+    seprat(ds, [0, 50_000, 180_000, 100_000_000])
+
+  if scatter:
+    from scatter import write_scatter
+    with quiet():
+      data = limitedJsons(ds, None, 150_000, 1.6, 3.6)
+    with profile_stage('scatter', len(data)), quiet():
+      write_scatter(os.path.join(root, 'scatter.png'), data,
+                    xlim=150_000, heatmap='10coin')
+
+  # 確認は測らない
+  common.PROFILER = None
+  ok = True
+  with quiet():
+    for name, check in [('csv', lambda: check_csv(ds, root, cache_dir)),
+                        ('table', lambda: check_table(ds, root))]:
+      same = check()
+      print(f"check {name}: {'ok' if same else 'MISMATCH'}", file=sys.stderr)
+      ok &= same
+  return ok
+
+
+def main() -> int:
+  import argparse
+
+  parser = argparse.ArgumentParser(description='benchmark with synthetic data')
+  parser.add_argument('--scale', type=float, default=1,
+                      help="number of days relative to the real archive"
+                      f" ({REAL_DAYS} days); default %(default)s")
+  parser.add_argument('--days', type=int,
+                      help="number of day directories; overrides --scale")
+  parser.add_argument('--per-day', type=int, default=REAL_PER_DAY,
+                      help="records per day; default %(default)s")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--out', help="directory for the synthetic archive;"
+                      " default a temporary directory. An existing"
+                      " non-empty directory is reused as is")
+  parser.add_argument('--keep', action='store_true',
+                      help="do not remove the temporary directory")
+  parser.add_argument('--pack', action='store_true',
+                      help="pack each day directory with compact.py before"
+                      " measuring")
+  parser.add_argument('--no-scatter', action='store_true',
+                      help="skip the scatter chart stage")
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help="number of processes to read json files;"
+                      " 0 means all CPUs")
+  parser.add_argument('--memory', action='store_true',
+                      help="also measure the peak memory of each stage"
+                      " with tracemalloc (slower)")
+  parser.add_argument('--doctest', action='store_true')
+  add_profile_arguments(parser)
+  args = parser.parse_args()
+
+  if args.doctest:
+    import doctest
+    doctest.testmod()
+    return 0
+
+  days = args.days or max(1, round(REAL_DAYS * args.scale))
+  root = args.out or tempfile.mkdtemp(prefix='livescore-bench-')
+  # 段階ごとの表は常に出す
+  args.profile = True
+  start_profile(args, 'bench', memory=args.memory)
+  try:
+    if os.path.isdir(root) and any(e.name[:1] != '.' for e in os.scandir(root)):
+      n = sum(1 for _ in iter_records([root], cache_dir=None))
+      print(f"reuse {root}: {n} records", file=sys.stderr)
+    else:
+      with profile_stage('generate', days * args.per_day):
+        n = generate(root, days, args.per_day, args.seed)
+    if args.pack:
+      from compact import day_dirs
+      with profile_stage('compact', n):
+        for dirname in day_dirs([root]):
+          compactDir(dirname, remove=True)
+    ok = run(root, n, not args.no_scatter, args.jobs)
+  finally:
+    if not args.out and not args.keep:
+      shutil.rmtree(root, ignore_errors=True)
+    elif not args.out:
+      print(f"kept {root}", file=sys.stderr)
+  return 0 if ok else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
+
+
+# vim:set et ts=2 sts=2 sw=2 tw=80:
@@ -5,29 +5,61 @@
 scat-score.html に掲載する表を生成する．
 """
 
+import json
 import sys
 import re
-from common import readJsons
+import numpy as np
+from common import readDataset, IncrementalState, SEPARATORS
+from common import profile_stage, add_profile_arguments, start_profile
 
+COINS = [10, 100, 1000]
+NUMS = range(1, 21)
 
-def filters(jsons, num, coin):
-  return [data for data in jsons
-          if len([d for d in data['gift'] if d >= coin]) == num]
 
+def count_class(ds) -> list:
+  return np.bincount(ds['class'], minlength=4)[:4].tolist()
 
-def print_text(jsons: list):
+
+def count_table(ds, coins=COINS, nmax: int = max(NUMS)):
+  """table[num, i, c]: coins[i] 以上のギフトをした人数が num で,
+  クラスが c のレコード数. num が nmax より多いものは table[nmax + 1].
+
+  (num, coin) ごとにレコードを絞り込む代わりに, すべての
+  (num, coin, class) を np.bincount 1 回で数える.
+  """
+  ncls = len(SEPARATORS) + 1
+  idx = []
+  for i, coin in enumerate(coins):
+    key = f'{coin}coin'
+    num = ds[key] if key in ds else ds.count_gifts_geq(coin)
+    idx.append((np.minimum(num, nmax + 1) * len(coins) + i) * ncls
+               + ds['class'])
+  size = (nmax + 2) * len(coins) * ncls
+  counts = np.bincount(np.concatenate(idx), minlength=size) if idx else (
+      np.zeros(size, dtype=np.int64))
+  return counts.reshape(nmax + 2, len(coins), ncls)
+
+
+def select_days(ds):
+  """YYYYMMDD のディレクトリのデータだけを返す."""
+  days = np.array([re.fullmatch(r'20\d{6}', k) is not None
+                   for k in ds.categories('dirname')] + [False])
+  return ds.filter(days[ds.codes('dirname')])
+
+
+def print_text(table, coins=COINS, nums=NUMS):
   print('|  N | gift |total |    Z |   A |   B |   C |')
   print('+----+------+------+------+-----+-----+-----+')
-  for num in range(1, 21):
-    for coin in [10, 100, 1000]:
-      vals = filters(jsons, num, coin)
-      cls = [len([d for d in vals if d['class'] == c]) for c in range(4)]
-      print(f'| {num:2d} | {coin:4d} | {len(vals):4d} |'
+  for num in nums:
+    for i, coin in enumerate(coins):
+      cls = table[num, i].tolist()
+      total = sum(cls)
+      print(f'| {num:2d} | {coin:4d} | {total:4d} |'
             f' {" |".join([f"{c:4d}" for c in cls])} |'
-            f' {" |".join([f" {c/len(vals):.3f}" for c in cls])} |')
+            f' {" |".join([f" {c/total:.3f}" for c in cls])} |')
 
 
-def print_html(jsons: list):
+def print_html(table, coins=COINS, nums=NUMS):
   print('<table class="scatter-table">')
   print('  <thead><tr>')
   for k in ['N', 'gift', 'total',
@@ -37,28 +69,26 @@ def print_html(jsons: list):
   print('  </tr></thead>')
   print('  <tbody>')
 
-  for num in range(1, 21):
-    for coin in [10, 100, 1000]:
-      vals = filters(jsons, num, coin)
-      cls = [len([d for d in vals if d['class'] == c]) for c in range(4)]
+  for num in nums:
+    for i, coin in enumerate(coins):
+      cls = table[num, i].tolist()
+      total = sum(cls)
       print(f'    <tr class="coin{coin}">')
-      for v in [num, coin, len(vals)] + cls + [f'{c/len(vals):.3f}' if len(vals) > 0 else '' for c in cls]:
+      for v in [num, coin, total] + cls + [f'{c/total:.3f}' if total > 0 else '' for c in cls]:
         print(f'      <td class="scatter-cell">{v}</td>')
       print('    </tr>')
   print('  </tbody>')
   print('</table>')
 
 
-def print_html_img(jsons: list):
-  coins = [10, 100, 1000]
+def print_html_img(table, coins=COINS, nums=NUMS):
   colspan = 4
   print('<table class="scatter-table">')
   print('  <thead>')
   print('    <tr>')
   print('      <th class="scatter-header" rowspan=3>人数</th>')
-  print(f'      <th class="scatter-header" colspan={colspan}>10コイン</th>')
-  print(f'      <th class="scatter-header" colspan={colspan}>100コイン</th>')
-  print(f'      <th class="scatter-header" colspan={colspan}>1000コイン</th>')
+  for coin in coins:
+    print(f'      <th class="scatter-header" colspan={colspan}>{coin}コイン</th>')
   print('    </tr>')
   print('    <tr>')
   for i in range(len(coins)):
@@ -87,7 +117,7 @@ def print_html_img(jsons: list):
       print(f' src="img/livescore/{coin}coin-{num}gifters.png"></td>')
     print('    </tr>')
 
-  for num in range(1, 21):
+  for num in nums:
     print('    <tr>')
     print(f'      <td class="scatter-cell" rowspan=3>{num}</td>')
     for coin in coins:
@@ -97,19 +127,18 @@ def print_html_img(jsons: list):
     print('    </tr>')
 
     print('    <tr>')
-    for coin in coins:
-      vals = filters(jsons, num, coin)
-      cls = [len([d for d in vals if d['class'] == c]) for c in range(4)]
-      for v in cls:
+    for i in range(len(coins)):
+      for v in table[num, i].tolist():
         print(f'      <td class="scatter-cell">{v}</td>')
     print('    </tr>')
 
     print('    <tr>')
-    for coin in coins:
-      vals = filters(jsons, num, coin)
-      cls = [len([d for d in vals if d['class'] == c]) for c in range(4)]
+    for i in range(len(coins)):
+      cls = table[num, i].tolist()
+      total = sum(cls)
       for v in cls:
-        val = v / len(vals)
+        # 該当者がいなければ 0
+        val = v / total if total else 0.0
         print(f'      <td class="scatter-cell">{val:.3f}</td>')
     print('    </tr>')
   print('  </tbody>')
@@ -121,15 +150,54 @@ def main() -> int:
 
   parser = argparse.ArgumentParser(description='')
   parser.add_argument('args', nargs='*')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help="number of processes to read json files;"
+                      " 0 means all CPUs")
+  parser.add_argument('--coin', type=int, action='append',
+                      help="coin thresholds of the table; default 10 100 1000")
+  parser.add_argument('--nmax', type=int, default=max(NUMS),
+                      help="maximum number of gifters in the table")
+  parser.add_argument('--incremental', metavar='STATE',
+                      help="read only files not yet recorded in STATE"
+                      " and add them to the table stored there")
+  add_profile_arguments(parser)
   args = parser.parse_args()
-
-  jsons = readJsons(args.args if args.args else ['.'])
-  jsons = sum([v for k, v in jsons.items()
-               if isinstance(v, list) and re.fullmatch(r'20\d{6}', k)], [])
-
-  # print_text(jsons)
-  # print_html(jsons)
-  print_html_img(jsons)
+  start_profile(args, 'classify')
+
+  paths = args.args if args.args else ['.']
+  coins = args.coin or COINS
+  nums = range(1, args.nmax + 1)
+  if args.incremental:
+    # 分類の境界が変わったら表を作り直す
+    state = IncrementalState(args.incremental,
+                             {'coins': coins, 'nmax': args.nmax,
+                              'separators': json.dumps(SEPARATORS)})
+    with profile_stage('read') as st:
+      ds = select_days(state.readNew(paths, workers=args.jobs))
+      st.records = len(ds)
+    agg = state.aggregates
+    with profile_stage('classify.table', len(ds)):
+      table = count_table(ds, coins, args.nmax)
+    classes = np.array(count_class(ds))
+    if 'table' in agg:
+      table += np.array(agg['table'], dtype=np.int64)
+      classes += np.array(agg['class'], dtype=np.int64)
+    agg['table'] = table.tolist()
+    agg['class'] = classes.tolist()
+    state.save()
+    print(f"# {len(ds)} new records; class {classes.tolist()}",
+          file=sys.stderr)
+  else:
+    with profile_stage('read') as st:
+      ds = select_days(readDataset(paths, workers=args.jobs))
+      st.records = len(ds)
+    with profile_stage('classify.table', len(ds)):
+      table = count_table(ds, coins, args.nmax)
+
+  # print_text(table, coins, nums)
+  # print_html(table, coins, nums)
+  with profile_stage('classify.html'):
+    print_html_img(table, coins, nums)
 
   return 0
 
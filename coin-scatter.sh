@@ -43,25 +43,28 @@ done
 shift `expr $OPTIND - 1`
 
 
-CMD="python3 makecsv.py --x 150_000 --ymin 1.6 --ymax 3.6 --no-model --no-livescore"
+# データの読み込みは 1 回で，全チャートをまとめて描画する
+CMD="python3 makecsv.py --x 150_000 --ymin 1.6 --ymax 3.6 --no-model --no-livescore --render-jobs 0"
+SPECS=
 for coin in 10 100 1000; do
 	FILE=$DIR/${coin}coin-NNgifters.png
-	$CMD --scatter $FILE --heatmap ${coin}coin --cmap turbo .
-	if [ $? -ne 0 ]; then
-		exit 1
-	fi
+	SPECS="$SPECS --scatter-spec scatter=$FILE,heatmap=${coin}coin,cmap=turbo"
 	continue
 
 	for N in `seq 1 20`; do
 		rm -f $DIR/${coin}-${N}.png
 		FILE=$DIR/${coin}coin-${N}gifters.png
-		$CMD --scatter $FILE --dimension ${coin}coin${N} .
+		SPECS="$SPECS --scatter-spec scatter=$FILE,dimension=${coin}coin${N}"
 		break
 	done
 	N=21
 	FILE=$DIR/${coin}coin-${N}gifters.png
-	$CMD --scatter $DIR/${coin}coin-${N}gifters.png --dimension ">${coin}coin20" .
+	SPECS="$SPECS --scatter-spec scatter=$FILE,dimension=>${coin}coin20"
 done
+$CMD $SPECS .
+if [ $? -ne 0 ]; then
+	exit 1
+fi
 
 
 # EOF
@@ -5,12 +5,236 @@
 """
 
 from pathlib import Path
+import bisect
+import hashlib
 import json
+import mmap
+import os
+import sys
 import numpy as np
+import operator
 import re
+import struct
+import time
 
 
-def limitedJsons(jsons: dict, xmin, xmax, y2min, y2max) -> dict:
+# ==================================
+# 計測
+# ==================================
+
+class _Stage:
+  """Profiler.stage() の 1 回分. records に件数を入れられる."""
+
+  __slots__ = ('prof', 'name', 'records', 'wall', 'cpu', 'peak')
+
+  def __init__(self, prof, name: str, records: int = None):
+    self.prof = prof
+    self.name = name
+    self.records = records
+
+  def __enter__(self):
+    self.prof._enter(self)
+    return self
+
+  def __exit__(self, *exc):
+    self.prof._exit(self)
+    return False
+
+
+class _NullStage:
+  """計測しないときの stage. 何もしない"""
+
+  records = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+  def __setattr__(self, name, value):
+    pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Profiler:
+  """段階ごとの経過時間, CPU 時間, 件数, メモリの最大値を集める.
+
+  同じ名前の段階は何度入っても 1 行にまとめる (calls が回数).
+  時間は入れ子の段階の分も含む. memory なら tracemalloc で
+  段階の間の確保済みメモリの最大値を測る (その分遅くなる).
+  プロセスプールのワーカーの中は測らない.
+
+  >>> prof = Profiler(memory=False)
+  >>> for _ in range(3):
+  ...   with prof.stage('read') as st:
+  ...     st.records = 10
+  >>> s = prof.stats['read']
+  >>> s['calls'], s['records'], s['wall'] >= 0, s['peak']
+  (3, 30, True, None)
+  """
+
+  def __init__(self, memory: bool = True, script: str = None):
+    self.memory = memory
+    self.script = script or Path(sys.argv[0]).stem
+    # 段階名 -> calls, wall, cpu, records, peak (最初に入った順)
+    self.stats = {}
+    self._stack = []
+    if memory:
+      import tracemalloc
+      self._tracemalloc = tracemalloc
+      if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+  def stage(self, name: str, records: int = None) -> _Stage:
+    return _Stage(self, name, records)
+
+  def _peak(self) -> int:
+    return self._tracemalloc.get_traced_memory()[1]
+
+  def _enter(self, st: _Stage) -> None:
+    if self.memory:
+      # 外側の段階の最大値を残してから測り直す
+      if self._stack:
+        outer = self._stack[-1]
+        outer.peak = max(outer.peak, self._peak())
+      self._tracemalloc.reset_peak()
+      st.peak = 0
+    else:
+      st.peak = None
+    if st.name not in self.stats:
+      self.stats[st.name] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                             'records': None, 'peak': st.peak}
+    self._stack.append(st)
+    st.cpu = time.process_time()
+    st.wall = time.perf_counter()
+
+  def _exit(self, st: _Stage) -> None:
+    wall = time.perf_counter() - st.wall
+    cpu = time.process_time() - st.cpu
+    self._stack.pop()
+    if self.memory:
+      st.peak = max(st.peak, self._peak())
+      if self._stack:
+        outer = self._stack[-1]
+        outer.peak = max(outer.peak, st.peak)
+
+    s = self.stats[st.name]
+    s['calls'] += 1
+    s['wall'] += wall
+    s['cpu'] += cpu
+    if st.records is not None:
+      s['records'] = (s['records'] or 0) + int(st.records)
+    if st.peak is not None:
+      s['peak'] = max(s['peak'], st.peak)
+
+  def report(self, fp=None) -> None:
+    """段階ごとの表を fp (既定は標準エラー) に出す."""
+    fp = fp or sys.stderr
+    print(f"# profile: {self.script}", file=fp)
+    print(f"{'stage':<24} {'calls':>7} {'wall[s]':>9} {'cpu[s]':>9}"
+          f" {'records':>10} {'peak[MB]':>9}", file=fp)
+    for name, s in self.stats.items():
+      records = '' if s['records'] is None else s['records']
+      peak = '' if s['peak'] is None else f"{s['peak'] / 2**20:.1f}"
+      print(f"{name:<24} {s['calls']:7d} {s['wall']:9.3f} {s['cpu']:9.3f}"
+            f" {records:>10} {peak:>9}", file=fp)
+
+  def write_json(self, path: str) -> None:
+    """段階ごとに 1 行の JSON を path に追記する ('-' なら標準エラー)."""
+    import datetime
+
+    now = datetime.datetime.now().astimezone().isoformat(timespec='seconds')
+    lines = [json.dumps({'time': now, 'script': self.script,
+                         'pid': os.getpid(), 'stage': name,
+                         'calls': s['calls'],
+                         'wall_s': round(s['wall'], 6),
+                         'cpu_s': round(s['cpu'], 6),
+                         'records': s['records'],
+                         'peak_bytes': s['peak']}) + '\n'
+             for name, s in self.stats.items()]
+    if path == '-':
+      sys.stderr.writelines(lines)
+      return
+    with open(path, 'a', encoding='utf-8') as f:
+      f.writelines(lines)
+
+
+# start_profile() で有効にした Profiler. None なら計測しない
+PROFILER = None
+
+
+def profile_stage(name: str, records: int = None):
+  """PROFILER の段階. 計測しないときは何もしない context manager.
+
+    with profile_stage('csv') as st:
+      st.records = write_csv_file(fp, ds)
+  """
+  if PROFILER is None:
+    return _NULL_STAGE
+  return _Stage(PROFILER, name, records)
+
+
+def profiled(name: str):
+  """関数の呼び出しを profile_stage(name) で測るデコレータ."""
+  import functools
+
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if PROFILER is None:
+        return func(*args, **kwargs)
+      with _Stage(PROFILER, name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+def add_profile_arguments(parser) -> None:
+  """--profile と --profile-json を parser に追加する."""
+  parser.add_argument('--profile', action='store_true',
+                      help="report wall/CPU time, records and peak memory"
+                      " (tracemalloc) of each stage to stderr")
+  parser.add_argument('--profile-json', metavar='FILE',
+                      help="append the --profile stages to FILE as JSON"
+                      " lines; '-' for stderr")
+
+
+def start_profile(args, script: str = None, memory: bool = True):
+  """args.profile か args.profile_json なら PROFILER を有効にする.
+
+  終了時に表 (と JSON) を出力する. 有効にした Profiler を返す.
+  """
+  global PROFILER
+  if not (args.profile or args.profile_json):
+    return None
+  import atexit
+
+  prof = PROFILER = Profiler(memory=memory, script=script)
+
+  def finish():
+    if args.profile:
+      prof.report()
+    if args.profile_json:
+      prof.write_json(args.profile_json)
+  atexit.register(finish)
+  return prof
+
+
+@profiled('limitedJsons')
+def limitedJsons(jsons, xmin, xmax, y2min, y2max):
+  """total_gift が xmin..xmax, livescore / total_gift が y2min..y2max
+  のデータだけを返す. None の端は制限しない.
+
+  jsons が LiveDataset なら, 同じギフト配列を共有する LiveDataset を返す.
+  """
+  if isinstance(jsons, LiveDataset):
+    idx, y2mind, y2maxd = limitedIndex(jsons, xmin, xmax, y2min, y2max)
+    print(f"excluded by y2: {y2mind} .. {y2maxd}, #={len(idx)}")
+    return jsons.take(idx)
+
   ret = {}
   y2mind = y2min
   y2maxd = y2max
@@ -36,80 +260,1475 @@ def limitedJsons(jsons: dict, xmin, xmax, y2min, y2max) -> dict:
   return ret
 
 
-def readJsons(fnames: list) -> dict:
-  return _readJsons(fnames, {})
+def limitedIndex(ds, xmin, xmax, y2min, y2max):
+  """limitedJsons() の NumPy 版.
+
+  returns (残すレコードの添字, y2 で除外した最小値, 最大値)
+  除外がなければ最小値/最大値は y2min/y2max のまま.
+  """
+  x = ds['total_gift']
+  y2 = ds['rate']
+  mask = np.ones(len(ds), dtype=bool)
+  if xmin is not None:
+    mask &= x >= xmin
+  if xmax is not None:
+    mask &= x <= xmax
+
+  y2mind = y2min
+  y2maxd = y2max
+  if y2max is not None:
+    over = mask & (y2 > y2max)
+    if over.any():
+      y2maxd = max(y2max, float(y2[over].max()))
+    mask &= ~over
+  if y2min is not None:
+    under = mask & (y2 < y2min)
+    if under.any():
+      y2mind = min(y2min, float(y2[under].min()))
+    mask &= ~under
+  return np.flatnonzero(mask), y2mind, y2maxd
+
+
+def segmentIndex(ds, sep: list):
+  """total_gift を sep で区切った区間 sep[i]..sep[i + 1] ごとの添字を返す
+  ジェネレータ.
+
+  limitedJsons(ds, sep[i], sep[i + 1], None, None) を区間の数だけ
+  呼ぶのと同じだが, total_gift のソートは 1 回だけ.
+  両端を含むので, 区切りちょうどのデータは両方の区間に入る.
+  limitedJsons() と同じく区間ごとの件数を表示する.
+  """
+  order = np.argsort(ds['total_gift'], kind='stable')
+  x = ds['total_gift'][order]
+  lo = np.searchsorted(x, sep[:-1], side='left')
+  hi = np.searchsorted(x, sep[1:], side='right')
+  for a, b in zip(lo, hi):
+    print(f"excluded by y2: None .. None, #={b - a}")
+    # 区間内は元の順序に戻す
+    yield np.sort(order[a:b])
+
+
+# 日ごとのディレクトリを列形式でキャッシュする場所
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent / '.cache'
+CACHE_VERSION = 5
+
+_JSON_NAME = re.compile(r'[0-9]+-[0-9]+\.json')
+# compactDir() で日のディレクトリの JSON をまとめたファイル
+PACK_NAME = 'records.pack'
+
+# キャッシュで列として持つキー. それ以外は extra に JSON 文字列で保存する
+_INT_KEYS = ('livescore', 'rank', 'following', 'followers')
+_STR_KEYS = ('date', 'label', 'user_rank', 'name')
+_INT_DERIVED_KEYS = ('total_gift', 'max_coin', '1000coin', '100coin',
+                     '10coin', '0coin', 'class')
+# 文字列表の添字 (codes) で持つ列
+_STR_CODES = _STR_KEYS + ('extra',)
+_KNOWN_KEYS = frozenset(_INT_KEYS + _STR_KEYS + _INT_DERIVED_KEYS
+                        + ('rate', 'gift', 'filename'))
+
+
+def readJsons(fnames: list, cache_dir=DEFAULT_CACHE_DIR,
+              workers: int = 1) -> dict:
+  """JSON ファイル群を読み込み，ディレクトリ名をキーにした辞書を返す.
+
+  readDataset() の結果を LiveDataset.to_jsons() で辞書にしたもの.
+  """
+  return readDataset(fnames, cache_dir, workers).to_jsons()
+
+
+def readDataset(fnames: list, cache_dir=DEFAULT_CACHE_DIR,
+                workers: int = 1) -> 'LiveDataset':
+  """JSON ファイル群を読み込み，LiveDataset を返す.
+
+  compactDir() で作ったパックは mmap して JSON の代わりに読む.
+  ディレクトリ単位で cache_dir に列形式のキャッシュを作る.
+  ファイル名, mtime, サイズが一致すれば JSON を読み直さない.
+  cache_dir=None ならキャッシュを使わない.
+
+  workers > 1 ならキャッシュにないディレクトリを複数プロセスで読む.
+  workers=0 なら CPU 数だけ使う.
+  結果はディレクトリ名, ファイル名の順に並ぶ.
+  """
+  with profile_stage('read.walk'):
+    tasks = []
+    _walk(fnames, tasks)
+  index_path = None
+  if cache_dir is not None:
+    index_path = _indexPath(fnames, tasks, cache_dir)
+  parts = _readParts(tasks, cache_dir, workers)
+  with profile_stage('read.concat') as st:
+    ds = LiveDataset._from_parts(tasks, parts, index_path)
+    st.records = len(ds)
+  if index_path is not None:
+    with profile_stage('read.map_gift'):
+      try:
+        ds.map_gift(_giftPath(*index_path))
+      except OSError as e:
+        print(f"cannot write gift buffer: {e}", file=sys.stderr)
+  return ds
+
+
+def _readParts(tasks: list, cache_dir, workers: int) -> list:
+  """_walk() の読み込み単位ごとに列形式のデータを読む."""
+  # パックとキャッシュから読めないディレクトリだけ JSON を読む
+  parts = [None] * len(tasks)
+  misses = []
+  for i, (path, files) in enumerate(tasks):
+    if _isPack(path):
+      parts[i] = _readPack(path, files)
+    elif files is not None and cache_dir is not None:
+      with profile_stage('read.cache') as st:
+        parts[i] = _loadDirCache(path, files, cache_dir)
+        if parts[i] is not None:
+          st.records = len(parts[i]['rate'])
+    if parts[i] is None:
+      misses.append(i)
+
+  if workers != 1 and len(misses) > 1:
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers or None) as ex:
+      futures = [ex.submit(_readColumns, *tasks[i]) for i in misses]
+      for i, fut in zip(misses, futures):
+        parts[i] = fut.result()
+  else:
+    for i in misses:
+      parts[i] = _readColumns(*tasks[i])
+
+  for i in misses:
+    path, files = tasks[i]
+    if files is not None and cache_dir is not None:
+      with profile_stage('read.save_cache'):
+        _saveDirCache(path, files, parts[i], cache_dir)
+  return parts
+
 
+def _walk(fnames: list, tasks: list) -> None:
+  """読み込む単位を tasks に追加する.
 
-def _readJsons(fnames: list, ret: dict) -> dict:
+  ディレクトリは (dirname, [(name, mtime, size), ...]),
+  単独のファイルとパックは (fname, None) として追加する.
+  パックと同じディレクトリの JSON は, パックにないものと
+  パックした後に変更されたもの (mtime かサイズが違うもの) を
+  パックの後に読む. 変更されたものがあればパックは
+  (pack, [(name, mtime, size), ...]) としてそれ以外の行だけを読む.
+  """
   for fname in fnames:
     # ディレクトリなら再帰する
-    if Path(fname).is_dir():
-      sub_fnames = [str(p) for p in Path(fname).iterdir()]
-      _readJsons(sub_fnames, ret)
-      continue
-    if not Path(fname).is_file():
-      continue
-    if not re.fullmatch(r'[0-9]+-[0-9]+\.json', Path(fname).name):
+    if os.path.isdir(fname):
+      _walkDir(fname, tasks)
+    elif os.path.isfile(fname) and (_isPack(fname) or _JSON_NAME.fullmatch(
+        os.path.basename(fname))):
+      tasks.append((fname, None))
+
+
+def _walkDir(dirname: str, tasks: list) -> None:
+  dirname = str(Path(dirname))
+  files, subdirs, pack = _scanDir(dirname)
+  if pack is not None:
+    stale = set()
+    if files:
+      sig, _ = _packFiles(pack)
+      packed = dict(zip(sig['sig_name'].tolist(),
+                        zip(sig['sig_mtime'].tolist(),
+                            sig['sig_size'].tolist())))
+      # パックした後に変更された JSON はパックの行の代わりに読む
+      stale = {name for name, mtime, size in files
+               if packed.get(name, (mtime, size)) != (mtime, size)}
+      files = [f for f in files if f[0] not in packed or f[0] in stale]
+    if stale:
+      tasks.append((pack, [(name, mtime, size)
+                           for name, (mtime, size) in packed.items()
+                           if name not in stale]))
+    else:
+      tasks.append((pack, None))
+  if files:
+    tasks.append((dirname, files))
+  _walk(subdirs, tasks)
+
+
+def _scanDir(dirname: str) -> tuple:
+  """dirname 直下の JSON の [(name, mtime, size)], サブディレクトリ,
+  パックのパス (なければ None) を返す."""
+  files = []
+  subdirs = []
+  pack = None
+  with os.scandir(dirname) as it:
+    for entry in it:
+      if entry.is_dir():
+        # .git や .cache には入らない
+        if not entry.name.startswith('.'):
+          subdirs.append(_join(dirname, entry.name))
+      elif entry.is_file() and _JSON_NAME.fullmatch(entry.name):
+        st = entry.stat()
+        files.append((entry.name, st.st_mtime_ns, st.st_size))
+      elif entry.name == PACK_NAME and entry.is_file():
+        pack = _join(dirname, entry.name)
+  return sorted(files), sorted(subdirs), pack
+
+
+def _isPack(path: str) -> bool:
+  return os.path.basename(path) == PACK_NAME
+
+
+def _readColumns(path: str, files) -> dict:
+  if files is None:
+    records = [_readJson(path)]
+  else:
+    records = [_readJson(_join(path, name)) for name, _, _ in files]
+  with profile_stage('read.columns', len(records)):
+    return _records2columns(records)
+
+
+def _join(dirname: str, name: str) -> str:
+  # Path(dirname) / name と同じ文字列を返す
+  return name if dirname == '.' else os.path.join(dirname, name)
+
+
+def _readJson(fname: str) -> dict:
+  return _enrich(_readRaw(fname))
+
+
+def _readRaw(fname: str) -> dict:
+  """JSON を読み, ギフトから計算する値以外を埋める."""
+  with profile_stage('read.json', 1):
+    return _readRawJson(fname)
+
+
+def _readRawJson(fname: str) -> dict:
+  with open(fname, 'r', encoding='utf-8') as f:
+    data = json.load(f)
+  data['filename'] = fname
+  data['livescore'] = int(data.get('livescore', 0))
+  if 'date' not in data:
+    # ファイル名から日付を取得する
+    data['date'] = Path(fname).parent.name
+  return data
+
+
+def _enrich(data: dict) -> dict:
+  """ギフトから計算する値を追加する."""
+  with profile_stage('read.derive', 1):
+    return _enrichGifts(data)
+
+
+def _enrichGifts(data: dict) -> dict:
+  gifts = np.array(data.get('gift', []))
+  data['total_gift'] = gifts.sum()
+  data['max_coin'] = gifts.max()
+  data['1000coin'] = (gifts >= 1000).sum()
+  data['100coin'] = (gifts >= 100).sum()
+  data['10coin'] = (gifts >= 10).sum()
+  data['0coin'] = len(gifts)
+  data['rate'] = data['livescore'] / data['total_gift']
+  data['class'] = classify(data)
+  assert data['rate'] > 1.6, data
+  assert 'followers' in data or data['date'] <= "20251022", data
+
+  # if xlim and data['total_gift'] > xlim:
+  #   continue
+  return data
+
+
+def iter_records(fnames: list, where=None, cache_dir=DEFAULT_CACHE_DIR,
+                 workers: int = 1):
+  """readJsons() と同じ順序でレコードを 1 件ずつ返すジェネレータ.
+
+  全体をメモリに載せず, 読み込み単位 (ディレクトリ) ごとに読む.
+  where(data) が False のレコードは捨てる.
+  キャッシュにないディレクトリは readDataset() と同じくキャッシュを作る.
+  workers > 1 なら (0 は CPU 数) キャッシュにないディレクトリを
+  複数プロセスで先読みする. 先読みは workers の 2 倍まで.
+  """
+  tasks = []
+  _walk(fnames, tasks)
+  for path, files, cols in _iterParts(tasks, cache_dir, workers):
+    if cols is not None:
+      for data in LiveDataset._from_parts([(path, files)], [cols]).records():
+        if where is None or where(data):
+          yield data
       continue
-    with open(fname, 'r', encoding='utf-8') as f:
-      data = json.load(f)
-    data['filename'] = fname
-    data['livescore'] = int(data.get('livescore', 0))
-    if 'date' not in data:
-      # ファイル名から日付を取得する
-      path = Path(fname)
-      date_str = path.parent.name
-      data['date'] = date_str
-
-    gifts = np.array(data.get('gift', []))
-    data['total_gift'] = gifts.sum()
-    data['max_coin'] = gifts.max()
-    data['1000coin'] = (gifts >= 1000).sum()
-    data['100coin'] = (gifts >= 100).sum()
-    data['10coin'] = (gifts >= 10).sum()
-    data['0coin'] = len(gifts)
-    data['rate'] = data['livescore'] / data['total_gift']
-    data['class'] = classify(data)
-    assert data['rate'] > 1.6, data
-    assert 'followers' in data or data['date'] <= "20251022", data
-
-    # if xlim and data['total_gift'] > xlim:
-    #   continue
-
-    # ディレクトリ名をキーにする
-    path = Path(fname)
-    key = path.parent.name
-    if key not in ret:
-      ret[key] = []
-    ret[key].append(data)
+
+    if files is None:
+      paths = [path]
+    else:
+      paths = [_join(path, name) for name, _, _ in files]
+    for fname in paths:
+      data = _readJson(fname)
+      if where is None or where(data):
+        yield data
+
+
+def _iterParts(tasks: list, cache_dir, workers: int):
+  """tasks を順に読み, (path, files, 列) を返すジェネレータ.
+
+  キャッシュを使わず 1 プロセスで読むときは列が None で,
+  呼び出し側が JSON を 1 件ずつ読む.
+  """
+  pool = None
+  if workers != 1 and len(tasks) > 1:
+    from concurrent.futures import ProcessPoolExecutor
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers)
+
+  def load(i):
+    # (列または Future, キャッシュに保存するか)
+    path, files = tasks[i]
+    if _isPack(path):
+      return _readPack(path, files), False
+    if files is not None and cache_dir is not None:
+      with profile_stage('read.cache'):
+        cols = _loadDirCache(path, files, cache_dir)
+      if cols is not None:
+        return cols, False
+    if pool is not None:
+      return pool.submit(_readColumns, path, files), True
+    if cache_dir is not None:
+      return _readColumns(path, files), True
+    return None, False
+
+  ahead = 2 * workers if pool is not None else 1
+  queue = []
+  nxt = 0
+  try:
+    while nxt < len(tasks) or queue:
+      while nxt < len(tasks) and len(queue) < ahead:
+        queue.append((nxt, load(nxt)))
+        nxt += 1
+      i, (cols, miss) = queue.pop(0)
+      path, files = tasks[i]
+      if miss and pool is not None:
+        cols = cols.result()
+      if miss and files is not None and cache_dir is not None:
+        with profile_stage('read.save_cache'):
+          _saveDirCache(path, files, cols, cache_dir)
+      yield path, files, cols
+  finally:
+    if pool is not None:
+      pool.shutdown(cancel_futures=True)
+
+
+def _cachePath(dirname: str, cache_dir) -> Path:
+  path = str(Path(dirname).resolve())
+  h = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+  return Path(cache_dir) / f'{Path(path).name}-{h}.npz'
+
+
+def _indexPath(fnames: list, tasks: list, cache_dir) -> tuple:
+  """
+  索引ファイルのパスと, 読み込んだファイル群の署名.
+  パスは入力の組で決まり, 中身が変われば署名が変わる.
+  """
+  paths = '\0'.join(str(Path(f).resolve()) for f in fnames)
+  h = hashlib.sha1(paths.encode('utf-8')).hexdigest()[:16]
+  sig = hashlib.sha1(str(CACHE_VERSION).encode('utf-8'))
+  for path, files in tasks:
+    if files is None or _isPack(path):
+      # パックは一部の行だけを読むときもパック自体の変更を見る
+      st = os.stat(path)
+      sig.update(repr((path, st.st_mtime_ns, st.st_size)).encode('utf-8'))
+    sig.update(repr((path, files)).encode('utf-8'))
+  return Path(cache_dir) / f'index-{h}.npz', sig.hexdigest()
+
+
+def _giftPath(index_path: Path, sig: str) -> Path:
+  """readDataset() のギフトを置くファイル."""
+  stem = index_path.stem.replace('index-', 'gift-', 1)
+  return index_path.with_name(f'{stem}-{sig[:16]}.npy')
+
+
+# cache_dir に残す索引とギフトのファイルの数 (それぞれ)
+CACHE_KEEP = 8
+
+
+def _evictCache(cache_dir, pattern: str, keep: int = CACHE_KEEP) -> None:
+  """cache_dir の pattern のファイルを, 使った (mtime) のが新しい順に
+  keep 個だけ残す. 入力の組を変えて何度も読んでも増え続けない."""
+  files = []
+  for path in Path(cache_dir).glob(pattern):
+    try:
+      files.append((path.stat().st_mtime_ns, path))
+    except OSError:
+      pass
+  for _, path in sorted(files, reverse=True)[keep:]:
+    try:
+      path.unlink()
+    except OSError:
+      pass
+
+
+def _records2columns(records: list) -> dict:
+  """レコードのリストを列形式 (NumPy 配列の辞書) にする.
+
+  ints: _INT_KEYS + _INT_DERIVED_KEYS, has: _INT_KEYS + _STR_KEYS の有無,
+  codes: _STR_CODES の strings (文字列のリスト) での添字,
+  gift: 全レコードのギフトを連結したもの (int32)
+  """
+  n = len(records)
+  int_keys = _INT_KEYS + _INT_DERIVED_KEYS
+  ints = np.zeros((n, len(int_keys)), dtype=np.int64)
+  codes = np.zeros((n, len(_STR_CODES)), dtype=np.int32)
+  has = np.zeros((n, len(_INT_KEYS + _STR_KEYS)), dtype=bool)
+  strings = {'': 0}
+  for i, data in enumerate(records):
+    extra = {}
+    for j, key in enumerate(_INT_KEYS + _STR_KEYS):
+      v = data.get(key)
+      if type(v) is int if j < len(_INT_KEYS) else isinstance(v, str):
+        has[i, j] = True
+        if j < len(_INT_KEYS):
+          ints[i, j] = v
+        else:
+          codes[i, j - len(_INT_KEYS)] = strings.setdefault(v, len(strings))
+      elif key in data:
+        extra[key] = v
+    for j, key in enumerate(_INT_DERIVED_KEYS):
+      ints[i, len(_INT_KEYS) + j] = data[key]
+    for k, v in data.items():
+      if k not in _KNOWN_KEYS:
+        extra[k] = v
+    if extra:
+      codes[i, -1] = strings.setdefault(
+          json.dumps(extra, ensure_ascii=False), len(strings))
+
+  lens = [len(data.get('gift', [])) for data in records]
+  return {
+      'ints': ints,
+      'codes': codes,
+      'strings': list(strings),
+      'has': has,
+      'rate': np.array([data['rate'] for data in records], dtype=np.float64),
+      'gift_offsets': np.concatenate(([0], np.cumsum(lens))).astype(np.int64),
+      'gift': np.array([g for data in records for g in data.get('gift', [])],
+                       dtype=np.int32),
+  }
+
+
+def _loadDirCache(dirname: str, files: list, cache_dir):
+  path = _cachePath(dirname, cache_dir)
+  try:
+    with np.load(path, allow_pickle=False) as z:
+      cols = {k: z[k] for k in z.files}
+  except (OSError, ValueError):
+    return None
+  if int(cols.get('version', -1)) != CACHE_VERSION:
+    return None
+
+  # ファイル名, mtime, サイズがすべて一致したときだけ使う
+  strings = _decodeTable(cols.pop('str_offsets'), cols.pop('str_data'))
+  names = [strings[i] for i in cols.pop('sig_name').tolist()]
+  cached = list(zip(names, cols['sig_mtime'].tolist(),
+                    cols['sig_size'].tolist()))
+  if cached != files:
+    return None
+  cols['strings'] = strings
+  return cols
+
+
+def _saveDirCache(dirname: str, files: list, cols: dict, cache_dir):
+  path = _cachePath(dirname, cache_dir)
+  cols = dict(cols)
+  cols['version'] = np.array(CACHE_VERSION)
+  # 文字列はパックと同じく UTF-8 の連結と位置で持つ.
+  # ファイル名も同じ表に入れる
+  strings = cols.pop('strings')
+  index = {v: i for i, v in enumerate(strings)}
+  cols['sig_name'] = np.array([index.setdefault(f[0], len(index))
+                               for f in files], dtype=np.int32)
+  cols['str_offsets'], cols['str_data'] = _encodeTable(list(index))
+  cols['sig_mtime'] = np.array([f[1] for f in files], dtype=np.int64)
+  cols['sig_size'] = np.array([f[2] for f in files], dtype=np.int64)
+  try:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp, 'wb') as f:
+      np.savez_compressed(f, **cols)
+    os.replace(tmp, path)
+  except OSError as e:
+    # キャッシュが書けなくても読み込みは続ける
+    print(f"cannot write cache {path}: {e}", file=sys.stderr)
+
+
+# ==================================
+# 日ごとのパック
+# ==================================
+# 日のディレクトリの JSON を 1 つのファイルにまとめたもの. 列は
+# _records2columns() とほぼ同じで, 文字列は文字列表の添字として持つ.
+# 先頭は PACK_MAGIC, 版, 配列の数, 続いて配列ごとに
+# (名前, dtype, 先頭からの位置, 行数, 列数; 1 次元なら 0) の表.
+# 配列は 8 バイト境界に置き, mmap した領域をそのまま使う.
+PACK_MAGIC = b'LSPACK\0\0'
+PACK_VERSION = 1
+_PACK_HEADER = struct.Struct('<8sII')
+_PACK_ENTRY = struct.Struct('<16s8sQQQ')
+# 文字列表の添字で持つ列 (strs, extra は _records2columns() の codes)
+_PACK_STR_COLUMNS = ('strs', 'extra', 'sig_name')
+# 行ごとでない列
+_PACK_FLAT_COLUMNS = ('gift', 'gift_offsets')
+
+
+def compactDir(dirname: str, remove: bool = False) -> tuple:
+  """dirname 直下の JSON を PACK_NAME にまとめる.
+
+  既にパックがあれば, パックにない JSON とパックした後に変更された
+  JSON (mtime かサイズが違うもの) を読んで書き直す.
+  書いたパックを読み直して一致を確かめ, remove=True なら
+  まとめた JSON (とパックと中身が同じ JSON) を消す.
+  (追加または置き換えたファイル数, パックの件数) を返す.
+  """
+  dirname = str(Path(dirname))
+  files, _, pack = _scanDir(dirname)
+  old = None
+  if pack is not None:
+    old = _readPack(pack)
+    packed = {name: (mtime, size, bytes(h).hex()) for name, mtime, size, h
+              in zip(old['sig_name'].tolist(), old['sig_mtime'].tolist(),
+                     old['sig_size'].tolist(), old['sig_sha1'])}
+    if remove:
+      removed = set()
+      for name, _, _ in files:
+        p = _join(dirname, name)
+        if name in packed and _sha1(p) == packed[name][2]:
+          os.remove(p)
+          removed.add(name)
+      files = [f for f in files if f[0] not in removed]
+    files = [f for f in files
+             if packed.get(f[0], (None, None))[:2] != (f[1], f[2])]
+    if files:
+      # 変更された JSON の行は読み直したもので置き換える
+      names = {f[0] for f in files}
+      old = _takeRows(old, np.array(
+          [i for i, name in enumerate(old['sig_name'].tolist())
+           if name not in names], dtype=np.int64))
+  if not files:
+    return 0, 0 if old is None else len(old['rate'])
+
+  paths = [_join(dirname, name) for name, _, _ in files]
+  cols = _records2columns([_readJson(p) for p in paths])
+  cols['sig_name'] = np.array([f[0] for f in files], dtype=object)
+  cols['sig_mtime'] = np.array([f[1] for f in files], dtype=np.int64)
+  cols['sig_size'] = np.array([f[2] for f in files], dtype=np.int64)
+  cols['sig_sha1'] = np.array([list(bytes.fromhex(_sha1(p))) for p in paths],
+                              dtype=np.uint8).reshape(len(paths), 20)
+  if old is not None:
+    cols = _concatColumns([old, cols])
+    cols = _takeRows(cols, np.argsort(cols['sig_name'], kind='stable'))
+
+  pack = _join(dirname, PACK_NAME)
+  writePack(pack, cols)
+  back = _readPack(pack)
+  for key, v in cols.items():
+    if key == 'codes':
+      same = np.array_equal(_decodeStrings(back), _decodeStrings(cols))
+    else:
+      same = key == 'strings' or np.array_equal(back[key], v)
+    if not same:
+      raise RuntimeError(f"{pack}: {key} differs after writing")
+  if remove:
+    for p in paths:
+      os.remove(p)
+  return len(files), len(cols['rate'])
+
+
+def writePack(path: str, cols: dict) -> None:
+  """列形式のデータを path にパックとして書く.
+
+  cols は _records2columns() の列に sig_name, sig_mtime, sig_size
+  (元のファイル) と sig_sha1 (SHA-1 の 20 バイト) を加えたもの.
+  """
+  strings = {'': 0}
+
+  def encode(values):
+    return np.array([strings.setdefault(v, len(strings)) for v in values],
+                    dtype=np.int32)
+
+  # 読み込み単位ごとの文字列表をつなげたものなので重複を除く
+  codes = encode(cols['strings'])[cols['codes']]
+  arrays = {}
+  for key in ('ints', 'has', 'rate') + _PACK_STR_COLUMNS + (
+      'sig_mtime', 'sig_size', 'sig_sha1') + _PACK_FLAT_COLUMNS:
+    if key == 'strs':
+      arrays[key] = codes[:, :len(_STR_KEYS)]
+    elif key == 'extra':
+      arrays[key] = codes[:, len(_STR_KEYS)]
+    elif key == 'sig_name':
+      arrays[key] = encode(cols[key].tolist())
+    else:
+      arrays[key] = cols[key]
+  # ギフトは int32 に収まれば int32 で持つ
+  gift = arrays['gift']
+  if not len(gift) or (gift.min() >= -2**31 and gift.max() < 2**31):
+    arrays['gift'] = gift.astype(np.int32)
+  arrays['str_offsets'], arrays['str_data'] = _encodeTable(list(strings))
+
+  pos = _align(_PACK_HEADER.size + _PACK_ENTRY.size * len(arrays))
+  table = []
+  for key, v in arrays.items():
+    v = np.ascontiguousarray(v, dtype=np.asarray(v).dtype.newbyteorder('<'))
+    arrays[key] = v
+    table.append(_PACK_ENTRY.pack(
+        key.encode('ascii'), v.dtype.str.encode('ascii'), pos,
+        v.shape[0], v.shape[1] if v.ndim > 1 else 0))
+    pos = _align(pos + v.nbytes)
+
+  tmp = f'{path}.{os.getpid()}.tmp'
+  with open(tmp, 'wb') as f:
+    f.write(_PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(arrays)))
+    f.write(b''.join(table))
+    for v in arrays.values():
+      f.write(b'\0' * (_align(f.tell()) - f.tell()))
+      f.write(v.tobytes())
+    f.write(b'\0' * (pos - f.tell()))
+  os.replace(tmp, path)
+
+
+def _align(pos: int) -> int:
+  return (pos + 7) & ~7
+
+
+def _openPack(path: str) -> dict:
+  """パックを mmap し, 名前 -> 配列 (mmap の領域を指す) の辞書を返す."""
+  mm = _mapFd(os.open(path, os.O_RDONLY))
+  magic, version, count = _PACK_HEADER.unpack_from(mm)
+  if magic != PACK_MAGIC or version != PACK_VERSION:
+    raise ValueError(f"{path}: not a pack (version {PACK_VERSION})")
+  arrays = {}
+  for i in range(count):
+    key, dtype, pos, rows, ncols = _PACK_ENTRY.unpack_from(
+        mm, _PACK_HEADER.size + _PACK_ENTRY.size * i)
+    dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+    v = np.frombuffer(mm, dtype=dtype, count=rows * max(ncols, 1),
+                      offset=pos)
+    arrays[key.rstrip(b'\0').decode('ascii')] = (v.reshape(rows, ncols)
+                                                  if ncols else v)
+  return arrays
+
+
+def _packFiles(path: str) -> tuple:
+  """パックの sig_* の列と文字列表 (リスト) を返す."""
+  arrays = _openPack(path)
+  table = _decodeTable(arrays['str_offsets'], arrays['str_data'])
+  sig = {key: arrays[key] for key in ('sig_mtime', 'sig_size', 'sig_sha1')}
+  # 固定幅の文字列にすると最長のファイル名の幅になるので object で持つ
+  sig['sig_name'] = np.array(table, dtype=object)[arrays['sig_name']]
+  return sig, (arrays, table)
+
+
+def _encodeTable(strings: list) -> tuple:
+  """文字列のリストを位置 (int64) と UTF-8 の連結 (uint8) にする."""
+  blobs = [v.encode('utf-8') for v in strings]
+  offsets = np.concatenate(([0], np.cumsum([len(b) for b in blobs])))
+  return (offsets.astype(np.int64),
+          np.frombuffer(b''.join(blobs), dtype=np.uint8))
+
+
+def _decodeTable(offsets, data) -> list:
+  """位置 (offsets) と UTF-8 の連結 (data) から文字列のリストを作る."""
+  offsets = offsets.tolist()
+  data = data.tobytes()
+  return [data[a:b].decode('utf-8') for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def _decodeStrings(cols: dict) -> np.ndarray:
+  """列形式のデータの codes を文字列 (object の配列) にする."""
+  return np.array(cols['strings'], dtype=object)[cols['codes']]
+
+
+def _readPack(path: str, files: list = None) -> dict:
+  """パックを _records2columns() と同じ形式の列にする.
+
+  files が [(name, mtime, size), ...] ならそのファイルの行だけを返す.
+  """
+  with profile_stage('read.pack') as st:
+    sig, (arrays, table) = _packFiles(path)
+    cols = dict(sig)
+    for key in ('ints', 'has', 'rate', 'gift_offsets'):
+      cols[key] = arrays[key]
+    cols['codes'] = np.column_stack((arrays['strs'], arrays['extra']))
+    cols['strings'] = table
+    # ギフトはパックの領域をそのまま使う
+    cols['gift'] = arrays['gift']
+    if files is not None:
+      pos = {name: i for i, name in enumerate(cols['sig_name'].tolist())}
+      cols = _takeRows(cols, np.array([pos[name] for name, _, _ in files],
+                                      dtype=np.int64))
+    st.records = len(cols['rate'])
+    return cols
+
+
+def _concatColumns(parts: list) -> dict:
+  """列形式のデータをつなげる. 文字列表もつなげて添字をずらす."""
+  cols = {key: np.concatenate([c[key] for c in parts])
+          for key in parts[0]
+          if key not in _PACK_FLAT_COLUMNS + ('codes', 'strings')}
+  cols['gift'] = np.concatenate([c['gift'] for c in parts])
+  codes = []
+  cols['strings'] = []
+  for c in parts:
+    codes.append(c['codes'] + len(cols['strings']))
+    cols['strings'].extend(c['strings'])
+  cols['codes'] = np.concatenate(codes)
+  offsets = [np.zeros(1, dtype=np.int64)]
+  base = 0
+  for c in parts:
+    offsets.append(c['gift_offsets'][1:] + base)
+    base += int(c['gift_offsets'][-1])
+  cols['gift_offsets'] = np.concatenate(offsets)
+  return cols
+
+
+def _takeRows(cols: dict, idx) -> dict:
+  """列形式のデータの idx 行目を取り出す. 文字列表はそのまま使う."""
+  ret = {key: v[idx] for key, v in cols.items()
+         if key not in _PACK_FLAT_COLUMNS + ('strings',)}
+  ret['strings'] = cols['strings']
+  offsets = cols['gift_offsets']
+  starts = offsets[idx]
+  lens = offsets[idx + 1] - starts
+  new = np.concatenate(([0], np.cumsum(lens))).astype(np.int64)
+  pick = np.repeat(starts - new[:-1], lens) + np.arange(new[-1])
+  ret['gift'] = cols['gift'][pick]
+  ret['gift_offsets'] = new
   return ret
 
 
+class IncrementalState:
+  """増分読み込みの状態.
+
+  読み込み済みのファイル (manifest) と, 呼び出し側が作る集計値
+  (aggregates) を path に JSON で保存する.
+  manifest は絶対パス -> [size, mtime_ns, sha1].
+
+  config が保存時と違うとき, または読み込み済みのファイルの中身が
+  変わったときは rebuilt が True になり, manifest と aggregates を
+  空にして今回の引数のファイルをすべて読み直す (呼び出し側で
+  aggregates を作り直す). 作り直さないときは, 今回の引数に含まれない
+  読み込み済みのファイルも manifest と aggregates にそのまま残る.
+  """
+
+  VERSION = 1
+
+  def __init__(self, path, config: dict = None):
+    self.path = Path(path)
+    self.config = config or {}
+    self.reset()
+    try:
+      with open(self.path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    except (OSError, ValueError):
+      return
+    if (state.get('version') == self.VERSION
+        and state.get('config') == self.config):
+      self.manifest = state['manifest']
+      self.aggregates = state['aggregates']
+      self.rebuilt = False
+
+  def reset(self) -> None:
+    self.manifest = {}
+    self.aggregates = {}
+    self.rebuilt = True
+
+  def readNew(self, fnames: list, workers: int = 1) -> 'LiveDataset':
+    """manifest にない (または変更された) ファイルだけを読む.
+
+    読んだファイルは manifest に追加する.
+    ディレクトリの一部だけを読むことがあるのでキャッシュは使わない.
+    """
+    tasks = []
+    _walk(fnames, tasks)
+
+    new_tasks = []
+    entries = {}
+    for path, files in tasks:
+      sha1s = None
+      if _isPack(path):
+        # パックにはファイルごとの SHA-1 も入っている
+        sig, _ = _packFiles(path)
+        rows = list(zip(sig['sig_name'].tolist(), sig['sig_mtime'].tolist(),
+                        sig['sig_size'].tolist(),
+                        [bytes(h).hex() for h in sig['sig_sha1']]))
+        if files is not None:
+          # 変更された JSON の行は読まない (JSON の方を読む)
+          keep = {name for name, _, _ in files}
+          rows = [r for r in rows if r[0] in keep]
+        files = [r[:3] for r in rows]
+        sha1s = [r[3] for r in rows]
+        dirname = str(Path(path).parent)
+        items = [(_join(dirname, name), mtime, size)
+                 for name, mtime, size in files]
+      elif files is None:
+        st = os.stat(path)
+        items = [(path, st.st_mtime_ns, st.st_size)]
+      else:
+        items = [(_join(path, name), mtime, size)
+                 for name, mtime, size in files]
+
+      new = []
+      for i, (fname, mtime, size) in enumerate(items):
+        key = os.path.abspath(fname)
+        known = self.manifest.get(key)
+        if known and known[:2] == [size, mtime]:
+          continue
+        sha1 = sha1s[i] if sha1s else _sha1(fname)
+        if known and known[2] == sha1:
+          # touch されただけ
+          self.manifest[key] = [size, mtime, sha1]
+          continue
+        if known and not self.rebuilt:
+          # 集計済みのデータが変わったので作り直す
+          print(f"changed: {fname}; rebuilding {self.path}",
+                file=sys.stderr)
+          self.reset()
+          return self.readNew(fnames, workers)
+        entries[key] = [size, mtime, sha1]
+        new.append(i)
+
+      if new:
+        new_tasks.append((path, None if files is None
+                          else [files[i] for i in new]))
+
+    parts = _readParts(new_tasks, None, workers)
+    self.manifest.update(entries)
+    return LiveDataset._from_parts(new_tasks, parts)
+
+  def save(self) -> None:
+    state = {'version': self.VERSION,
+             'config': self.config,
+             'manifest': self.manifest,
+             'aggregates': self.aggregates}
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+      json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, self.path)
+
+
+def _sha1(fname: str) -> str:
+  with open(fname, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+def argsort_stable(keys, reverse: bool = False):
+  """安定ソートの添字. reverse でも同じ値の順序は保つ."""
+  if not reverse:
+    return np.argsort(keys, kind='stable')
+  idx = np.argsort(keys[::-1], kind='stable')[::-1]
+  return len(keys) - 1 - idx
+
+
+def _kth(keys, k: int, reverse: bool):
+  # 並べたときに k 番目 (1 始まり) になる値
+  if reverse:
+    return np.partition(keys, len(keys) - k)[len(keys) - k]
+  return np.partition(keys, k - 1)[k - 1]
+
+
+def _group_reduce(func: str, gid, values, ngroups: int):
+  """
+  グループ番号 gid ごとに values を集計する.
+  値のないグループは count, sum なら 0, それ以外は nan.
+
+  >>> g = np.array([0, 1, 0, 0]); v = np.array([4, 7, 1, 2])
+  >>> [_group_reduce(f, g, v, 3).tolist() for f in ['count', 'sum', 'max']]
+  [[3, 1, 0], [7, 7, 0], [4.0, 7.0, nan]]
+  >>> _group_reduce('median', g, v, 2).tolist(), _group_reduce('p90', g, v, 2).tolist()
+  ([2.0, 7.0], [3.6, 7.0])
+  """
+  order = np.lexsort((values, gid))
+  v = values[order]
+  counts = np.bincount(gid, minlength=ngroups)
+  starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+  ne = counts > 0
+  if func == 'count':
+    return counts
+  if func == 'sum':
+    out = np.zeros(ngroups, dtype=v.dtype)
+    if ne.any():
+      out[ne] = np.add.reduceat(v, starts[ne])
+    return out
+
+  out = np.full(ngroups, np.nan)
+  if not ne.any():
+    return out
+  b, c = starts[ne], counts[ne]
+  if func == 'mean':
+    out[ne] = np.add.reduceat(v, b) / c
+  elif func == 'min':
+    out[ne] = v[b]
+  elif func == 'max':
+    out[ne] = v[b + c - 1]
+  elif func == 'median' or re.fullmatch(r'p\d+(\.\d+)?', func):
+    q = 0.5 if func == 'median' else float(func[1:]) / 100
+    # np.percentile(method='linear') と同じ補間
+    pos = q * (c - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, c - 1)
+    t = pos - lo
+    a = v[b + lo].astype(np.float64)
+    d = v[b + hi] - a
+    out[ne] = np.where(t >= 0.5, v[b + hi] - d * (1 - t), a + d * t)
+  else:
+    raise ValueError(f'invalid aggregate: {func}')
+  return out
+
+
+class _GiftMap(mmap.mmap):
+  """map_gift() の .npy やパックの mmap. fd (ファイルを開いたまま持つ) を
+  属性に持つ."""
+
+
+def _mapFd(fd: int) -> _GiftMap:
+  """fd を mmap する. fd は mmap を使うものがなくなったときに閉じる.
+
+  ファイルが消されたり置き換えられたりしても, 開いた時点の中身を
+  読み続ける.
+  """
+  import weakref
+  try:
+    mm = _GiftMap(fd, 0, access=mmap.ACCESS_READ)
+  except BaseException:
+    os.close(fd)
+    raise
+  mm.fd = fd
+  weakref.finalize(mm, os.close, fd)
+  return mm
+
+
+class _GiftFd:
+  """pickle した LiveDataset の gift の代わりに入れる fd と,
+  gift の mmap 内の位置 (バイト) と長さ."""
+
+  def __init__(self, gift: np.ndarray, mm: _GiftMap):
+    from multiprocessing.reduction import DupFd
+    self.fd = DupFd(mm.fd)
+    base = np.frombuffer(mm, dtype=np.uint8, count=0)
+    self.offset = gift.ctypes.data - base.ctypes.data
+    self.count = len(gift)
+
+  def load(self) -> np.ndarray:
+    mm = _mapFd(self.fd.detach())
+    return np.frombuffer(mm, dtype=np.int32, count=self.count,
+                         offset=self.offset)
+
+
+def _mapGift(fd: int) -> np.ndarray:
+  """.npy を開いた fd を mmap し, int32 の配列を返す."""
+  try:
+    with os.fdopen(os.dup(fd), 'rb') as f:
+      f.seek(0)
+      major, _ = np.lib.format.read_magic(f)
+      read = (np.lib.format.read_array_header_1_0 if major == 1
+              else np.lib.format.read_array_header_2_0)
+      shape, _, dtype = read(f)
+      offset = f.tell()
+    if dtype != np.int32 or len(shape) != 1:
+      raise ValueError(f"not an int32 gift buffer: {dtype} {shape}")
+  except BaseException:
+    os.close(fd)
+    raise
+  return np.frombuffer(_mapFd(fd), dtype=np.int32, count=shape[0],
+                       offset=offset)
+
+
+def _giftMap(gift):
+  """gift が _mapFd() の領域の配列なら, その _GiftMap を返す."""
+  base = gift
+  while isinstance(base, (np.ndarray, memoryview)):
+    base = base.base if isinstance(base, np.ndarray) else base.obj
+  return base if isinstance(base, _GiftMap) else None
+
+
+def _writeGift(f, gift) -> None:
+  np.save(f, np.ascontiguousarray(gift, dtype=np.int32))
+  f.flush()
+
+
+def _mergeStrings(parts: list) -> tuple:
+  """(文字列のリスト, その添字) の組をつなげ, (添字, 値一覧) を返す.
+
+  値一覧はソートしておき, 添字の大小と文字列の大小を揃える.
+  末尾の '' は値がない (添字 -1) ときのためのもの.
+  最長の文字列の幅にならないように値一覧は object の配列で持つ.
+  """
+  used = [np.unique(codes).tolist() for _, codes in parts]
+  uniq = sorted({strings[i] for (strings, _), u in zip(parts, used)
+                 for i in u})
+  index = {v: i for i, v in enumerate(uniq)}
+  ret = []
+  for (strings, codes), u in zip(parts, used):
+    m = np.zeros(len(strings), dtype=np.int32)
+    m[u] = [index[strings[i]] for i in u]
+    ret.append(m[codes])
+  codes = np.concatenate(ret) if ret else np.zeros(0, dtype=np.int32)
+  return codes, np.array(uniq + [''], dtype=object)
+
+
+class LiveDataset:
+  """ライブ集計結果を列ごとの NumPy 配列で持つ.
+
+  ds['total_gift'] のように列を取り出す. 文字列の列 (date, user_rank など)
+  は値一覧への添字で持ち, ds[name] で文字列の配列に戻す.
+  JSON にないキーは has(name) が False になる.
+
+  ギフトは全レコード分を連結した int32 の gift に入っていて,
+  i 番目のレコードは gift[gift_start[i]:gift_start[i] + 0coin[i]].
+  filter() や sort_by() は gift を共有したまま添字だけを選び直す.
+  map_gift() した gift はファイルを mmap したもので, pickle すると
+  開いたファイルの fd だけを渡し, 受け取ったプロセスも同じファイルを
+  mmap する.
+  """
+
+  INT_COLUMNS = _INT_KEYS + _INT_DERIVED_KEYS
+  STR_COLUMNS = _STR_KEYS + ('dirname', 'filename', 'extra')
+  # JSON になければ has() が False になる列
+  OPTIONAL_COLUMNS = _INT_KEYS + _STR_KEYS
+
+  def __init__(self, cols: dict, cats: dict, has: dict, gift,
+               index=None, rows=None):
+    # 文字列の列は cats の添字. cats の末尾は欠損 (-1) 用の ''
+    self._cols = cols
+    self._cats = cats
+    self._has = has
+    self.gift = gift
+    # take() した後も元のデータの索引を使う. rows は元のデータでの行番号
+    self._index = index if index is not None else DatasetIndex(self)
+    self._rows = rows
+
+  def map_gift(self, path=None) -> None:
+    """gift を path (.npy) に書き, そこを mmap したものに置き換える.
+
+    path に同じ長さのファイルがあれば書かずに使う. path を省略すると
+    名前のない一時ファイルに書く.
+    """
+    if _giftMap(self.gift) is not None or not len(self.gift):
+      return
+    if path is None:
+      import tempfile
+      with tempfile.TemporaryFile(prefix='livescore-gift-') as f:
+        _writeGift(f, self.gift)
+        self.gift = _mapGift(os.dup(f.fileno()))
+      return
+    try:
+      fd = os.open(path, os.O_RDONLY)
+    except OSError:
+      pass
+    else:
+      try:
+        gift = _mapGift(fd)
+      except (OSError, ValueError):
+        gift = None
+      if gift is not None and gift.shape == self.gift.shape:
+        # 最近使ったものを _evictCache() で残す
+        os.utime(path)
+        self.gift = gift
+        return
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'w+b') as f:
+      _writeGift(f, self.gift)
+      os.replace(tmp, path)
+      self.gift = _mapGift(os.dup(f.fileno()))
+    _evictCache(path.parent, 'gift-*.npy')
+
+  def __getstate__(self) -> dict:
+    state = self.__dict__.copy()
+    mm = _giftMap(self.gift)
+    if mm is not None:
+      # ワーカーには gift のファイルの fd だけを渡す
+      state['gift'] = _GiftFd(self.gift, mm)
+    return state
+
+  def __setstate__(self, state: dict) -> None:
+    if isinstance(state['gift'], _GiftFd):
+      state['gift'] = state['gift'].load()
+    self.__dict__.update(state)
+
+  @classmethod
+  def _from_parts(cls, tasks: list, parts: list,
+                  index_path=None) -> 'LiveDataset':
+    """
+    readDataset() の読み込み単位ごとの列をつなげる.
+    index_path は _indexPath() の (パス, 署名) で, 索引をそこに保存する.
+    """
+    if parts:
+      ints = np.concatenate([c['ints'] for c in parts])
+      has = np.concatenate([c['has'] for c in parts])
+      rate = np.concatenate([c['rate'] for c in parts])
+      if len(parts) == 1 and parts[0]['gift'].dtype == np.int32:
+        # 読み込み単位が 1 つならコピーしない. パックならその mmap の
+        # 領域のままなので map_gift() で書き直すこともない
+        gift = parts[0]['gift']
+      else:
+        gift = np.concatenate([c['gift'] for c in parts], dtype=np.int32)
+    else:
+      ints = np.zeros((0, len(cls.INT_COLUMNS)), dtype=np.int64)
+      has = np.zeros((0, len(cls.OPTIONAL_COLUMNS)), dtype=bool)
+      rate = np.zeros(0, dtype=np.float64)
+      gift = np.zeros(0, dtype=np.int32)
+
+    starts = []
+    dirnames = []
+    filenames = []
+    base = 0
+    for (path, files), c in zip(tasks, parts):
+      n = len(c['rate'])
+      starts.append(c['gift_offsets'][:-1] + base)
+      base += int(c['gift_offsets'][-1])
+      if _isPack(path):
+        dirname = str(Path(path).parent)
+        dirnames.extend([Path(dirname).name] * n)
+        filenames.extend(_join(dirname, name)
+                         for name in c['sig_name'].tolist())
+      elif files is None:
+        dirnames.append(Path(path).parent.name)
+        filenames.append(path)
+      else:
+        dirnames.extend([Path(path).name] * n)
+        filenames.extend(_join(path, name) for name, _, _ in files)
+
+    cols = {}
+    cats = {}
+    for j, key in enumerate(cls.INT_COLUMNS):
+      cols[key] = np.ascontiguousarray(ints[:, j])
+    cols['rate'] = rate
+    # 境界線を変えてもキャッシュを作り直さなくていいように毎回分類する
+    cols['class'] = classify_many(cols['total_gift'], rate)
+    cols['gift_start'] = (np.concatenate(starts) if starts
+                          else np.zeros(0, dtype=np.int64))
+    strcols = {key: [(c['strings'], c['codes'][:, j]) for c in parts]
+               for j, key in enumerate(_STR_CODES)}
+    strcols['dirname'] = [(dirnames, np.arange(len(dirnames)))]
+    strcols['filename'] = [(filenames, np.arange(len(filenames)))]
+    hascols = {key: np.ascontiguousarray(has[:, j])
+               for j, key in enumerate(cls.OPTIONAL_COLUMNS)}
+    for key, values in strcols.items():
+      codes, cats[key] = _mergeStrings(values)
+      if key in hascols:
+        codes[~hascols[key]] = -1
+      cols[key] = codes
+    ds = cls(cols, cats, hascols, gift)
+    ds._index = DatasetIndex(ds, index_path)
+    return ds
+
+  def __len__(self) -> int:
+    return len(self._cols['rate'])
+
+  def __contains__(self, name: str) -> bool:
+    return name in self._cols
+
+  def __getitem__(self, name: str):
+    if name in self._cats:
+      return self._cats[name][self._cols[name]]
+    return self._cols[name]
+
+  @property
+  def columns(self) -> list:
+    return [k for k in self._cols if k != 'gift_start']
+
+  @property
+  def gift_start(self):
+    """レコードごとのギフトの開始位置. 長さは 0coin 列."""
+    return self._cols['gift_start']
+
+  def has(self, name: str):
+    """name 列の値を持つレコードなら True の配列."""
+    if name in self._has:
+      return self._has[name]
+    return np.full(len(self), name in self._cols)
+
+  def codes(self, name: str):
+    """文字列の列の添字. categories(name)[codes] が値. 欠損は -1."""
+    return self._cols[name]
+
+  def categories(self, name: str):
+    return self._cats[name][:-1]
+
+  def gifts(self, i: int):
+    """i 番目のレコードのギフト (コピーしない)."""
+    start = self._cols['gift_start'][i]
+    return self.gift[start:start + self._cols['0coin'][i]]
+
+  def count_gifts_geq(self, coin: int):
+    """レコードごとに coin 以上のギフトの人数を数える."""
+    c = np.concatenate(([0], np.cumsum(self.gift >= coin)))
+    start = self._cols['gift_start']
+    return c[start + self._cols['0coin']] - c[start]
+
+  def take(self, idx) -> 'LiveDataset':
+    rows = self._rows if self._rows is not None else np.arange(len(self))
+    return LiveDataset({k: v[idx] for k, v in self._cols.items()},
+                       self._cats,
+                       {k: v[idx] for k, v in self._has.items()},
+                       self.gift,
+                       self._index, rows[idx])
+
+  def index(self, name: str):
+    """name 列の索引 (SortedIndex か BitmapIndex). なければ None."""
+    return self._index.get(name)
+
+  def from_base(self, mask):
+    """索引を作った元のデータでの mask を, このデータの mask にする."""
+    return mask if self._rows is None else mask[self._rows]
+
+  def filter(self, mask) -> 'LiveDataset':
+    """mask が True のレコードだけを持つ LiveDataset を返す."""
+    mask = np.asarray(mask)
+    if mask.dtype == bool:
+      mask = np.flatnonzero(mask)
+    return self.take(mask)
+
+  def sort_by(self, col: str, reverse: bool = False,
+              limit: int = None) -> 'LiveDataset':
+    """col 列で安定ソートする. 同じ値の順序は reverse でも保つ.
+
+    limit を与えると先頭 limit 件だけを返す. 全体はソートせず,
+    np.partition で limit 番目の値を求めてそれより前の行だけを並べる.
+    """
+    keys = self._cols[col]
+    if limit is not None and limit < len(keys):
+      if limit <= 0:
+        return self.take(np.zeros(0, dtype=np.int64))
+      kth = _kth(keys, limit, reverse)
+      better = np.flatnonzero(keys > kth if reverse else keys < kth)
+      # limit 番目と同じ値の行は元の順に先頭から
+      tie = np.flatnonzero(keys == kth)[:limit - len(better)]
+      return self.take(np.sort(np.concatenate([better, tie]))) \
+          .sort_by(col, reverse)
+    return self.take(argsort_stable(keys, reverse))
+
+  def order_by(self, keys: list, limit: int = None) -> 'LiveDataset':
+    """keys = [(列, reverse), ...] で並べる. 先の列ほど優先.
+
+    limit があれば先頭の列で limit 番目の値までの行に絞ってから並べる.
+    """
+    if len(keys) == 1:
+      return self.sort_by(*keys[0], limit=limit)
+    ds = self
+    if keys and limit is not None and 0 < limit < len(self):
+      col, reverse = keys[0]
+      v = self._cols[col]
+      kth = _kth(v, limit, reverse)
+      ds = self.take(np.flatnonzero(v >= kth if reverse else v <= kth))
+    for col, reverse in reversed(keys):
+      ds = ds.sort_by(col, reverse)
+    if limit is not None:
+      ds = ds.take(np.arange(min(max(limit, 0), len(ds))))
+    return ds
+
+  def group_by(self, col: str) -> dict:
+    """col 列の値ごとに分けた LiveDataset の辞書を返す.
+
+    キーは最初に現れた順. 各グループ内のレコードの順序は保つ.
+    """
+    keys = self._cols[col]
+    uniq, first, inverse = np.unique(keys, return_index=True,
+                                     return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(inverse))))
+    values = self._cats[col][uniq] if col in self._cats else uniq
+    ret = {}
+    for k in np.argsort(first):
+      ret[values[k].item()] = self.take(order[bounds[k]:bounds[k + 1]])
+    return ret
+
+  def aggregate(self, by: list, aggs: list) -> dict:
+    """by の列の値の組ごとに集計する.
+
+    aggs は (関数, 列) のリストで, 関数は count, sum, mean, median,
+    min, max, pNN (NN パーセンタイル). count の列は None でよい.
+    値のないレコード (has が False) はその列の集計から除く.
+    グループはキーの昇順. 列名 (by の列と "関数:列") → 値のリストの辞書を返す.
+    """
+    n = len(self)
+    if by:
+      codes = np.column_stack([self._cols[c] for c in by]) if n \
+          else np.zeros((0, len(by)), dtype=np.int64)
+      uniq, gid = np.unique(codes, axis=0, return_inverse=True)
+      gid = gid.reshape(-1)
+    else:
+      uniq = np.zeros((1 if n else 0, 0), dtype=np.int64)
+      gid = np.zeros(n, dtype=np.int64)
+    ngroups = len(uniq)
+
+    ret = {}
+    for j, col in enumerate(by):
+      keys = uniq[:, j]
+      ret[col] = (self._cats[col][keys] if col in self._cats
+                  else keys).tolist()
+    for func, col in aggs:
+      name = func if col is None else f'{func}:{col}'
+      if col is None:
+        ret[name] = np.bincount(gid, minlength=ngroups).tolist()
+        continue
+      has = self.has(col)
+      ret[name] = _group_reduce(func, gid[has], self._cols[col][has],
+                                ngroups).tolist()
+    return ret
+
+  def records(self) -> list:
+    """readJsons() と同じ形式の辞書のリストを返す."""
+    vals = {k: self[k].tolist() for k in self.OPTIONAL_COLUMNS}
+    has = {k: self._has[k].tolist() for k in self.OPTIONAL_COLUMNS}
+    derived = [self._cols[k].tolist() for k in _INT_DERIVED_KEYS]
+    rate = self._cols['rate'].tolist()
+    filename = self['filename'].tolist()
+    extra = self['extra'].tolist()
+    starts = self._cols['gift_start'].tolist()
+    ends = (self._cols['gift_start'] + self._cols['0coin']).tolist()
+
+    ret = []
+    for i in range(len(self)):
+      data = {k: vals[k][i] for k in self.OPTIONAL_COLUMNS if has[k][i]}
+      if extra[i]:
+        data.update(json.loads(extra[i]))
+      data['gift'] = self.gift[starts[i]:ends[i]].tolist()
+      data['filename'] = filename[i]
+      for k, v in zip(_INT_DERIVED_KEYS, derived):
+        data[k] = v[i]
+      data['rate'] = rate[i]
+      ret.append(data)
+    return ret
+
+  def to_jsons(self) -> dict:
+    """ディレクトリ名をキーにした readJsons() 形式の辞書を返す."""
+    ret = {}
+    for key, data in zip(self['dirname'].tolist(), self.records()):
+      if key not in ret:
+        ret[key] = []
+      ret[key].append(data)
+    return ret
+
+
+# is_excluded() の境界線 rate = SLOPE * total_gift / SCALE + RATE の
+# (SLOPE, SCALE, RATE)
+EXCLUDE_LINE = (-0.6, 130_000, 3)
+
+
 def is_excluded(total_gift, livescore):
   """跳ねていない"""
-  return livescore / total_gift <= -0.6 * total_gift / 130_000 + 3
+  slope, scale, rate = EXCLUDE_LINE
+  return livescore / total_gift <= slope * total_gift / scale + rate
 
 
-def set_ru_model(idx: int):
+class RuModel:
+  """
+  ライブスコアのモデル. 係数 (b, a) の直線の最小値
+  score = min(a * total_gift + b) で表す上に凸な折れ線.
+  直線は傾きの降順に並べ, 交点 (breaks) で区間を引く.
+
+  >>> m = RuModel([(0, 3), (17299.15066, 2.675280793)])
+  >>> m(10_000), m(100_000)
+  (30000, 284827.22996)
+  >>> m.many([10_000, 100_000]).tolist()
+  [30000.0, 284827.22996]
+  >>> m.tolist([10_000, 100_000])
+  [30000, 284827.22996]
+  >>> round(m.inverse(m(100_000)), 6)
+  100000.0
+  >>> m.inverse_many([30000, m(100_000)]).round(6).tolist()
+  [10000.0, 100000.0]
+  """
+
+  def __init__(self, params: list):
+    # 下側の包絡線に現れない直線は除く
+    lines = []
+    for b, a in sorted(params, key=lambda p: (-p[1], p[0])):
+      if lines and lines[-1][1] == a:
+        continue
+      while len(lines) >= 2 and \
+          _cross(lines[-2], (b, a)) <= _cross(lines[-2], lines[-1]):
+        lines.pop()
+      lines.append((b, a))
+    self.params = lines
+    self.b = np.array([p[0] for p in lines], dtype=np.float64)
+    self.a = np.array([p[1] for p in lines], dtype=np.float64)
+    # 区間 i は breaks[i-1] < x <= breaks[i]
+    self.breaks = np.array([_cross(p, q) for p, q in zip(lines, lines[1:])],
+                           dtype=np.float64)
+    self._breaks = self.breaks.tolist()
+    self._scores = (self.a[:-1] * self.breaks + self.b[:-1]).tolist()
+    # 係数が整数の区間は int を返す (ru_model() の互換)
+    self._int = np.array([isinstance(b, int) and isinstance(a, int)
+                          for b, a in lines])
+
+  def points(self) -> list:
+    """交点 (x, y) のリスト"""
+    return list(zip(self._breaks, self._scores))
+
+  def __call__(self, total_gift):
+    b, a = self.params[bisect.bisect_left(self._breaks, total_gift)]
+    return total_gift * a + b
+
+  def segment(self, total_gift) -> np.ndarray:
+    """各 total_gift の区間番号"""
+    return np.searchsorted(self.breaks, total_gift, side='left')
+
+  def many(self, total_gift) -> np.ndarray:
+    """ru_model() の配列版"""
+    x = np.asarray(total_gift, dtype=np.float64)
+    i = self.segment(x)
+    return x * self.a[i] + self.b[i]
+
+  def tolist(self, total_gift) -> list:
+    """[self(v) for v in total_gift] と同じ値と型のリスト"""
+    i = self.segment(total_gift)
+    v = self.many(total_gift).tolist()
+    return [int(s) if f else s for s, f in zip(v, self._int[i].tolist())]
+
+  def inverse(self, score) -> float:
+    """
+    スコアからギフト (coin) を求める逆関数.
+    navi.js の score2coin_orig() に相当する.
+    """
+    b, a = self.params[bisect.bisect_left(self._scores, score)]
+    return (score - b) / a
+
+  def inverse_many(self, score) -> np.ndarray:
+    """inverse() の配列版"""
+    y = np.asarray(score, dtype=np.float64)
+    i = np.searchsorted(self._scores, y, side='left')
+    return (y - self.b[i]) / self.a[i]
+
+
+def _cross(p, q) -> float:
+  # 直線 p = (b1, a1), q = (b2, a2) の交点の x
+  (b1, a1), (b2, a2) = p, q
+  return (b2 - b1) / (a1 - a2)
+
+
+def ru_model_params(idx: int) -> list:
+  """--ru-model の番号のモデル係数 (b, a) のリスト"""
+  if idx == 1:
+    # default model (2025-09-28 ..)
+    return [(0, 3),
+            (17299.15066, 2.675280793)]
+  # separator [50000, 180000] 2025-11-06
+  __RU_MODEL = [
+    (0, 3),  # 0..50K  1814 samples, 0
+    (15531.441501008434, 2.6950897058012684),  # 50K..180K  671 samples, 50937.74069459752
+    (41958.68833499996, 2.5483011271896387),  # 180K..100M  79 samples, 180036.12463550194
+  ]
+  return __RU_MODEL
+
+
+def set_ru_model(idx: int, verbose: bool = True) -> RuModel:
+  """ru_model() などが使うモデルを切り替える. verbose ならモデルを表示する"""
   global __RU_MODEL
+  __RU_MODEL = RuModel(ru_model_params(idx))
+  if not verbose:
+    return __RU_MODEL
   if idx == 1:
     print("default model (2025-09-28 ..)")
-    __RU_MODEL = [(0, 3),
-                  (17299.15066, 2.675280793)]
-  else:
-    # separator [50000, 180000] 2025-11-06
-    __RU_MODEL = [
-      (0, 3),  # 0..50K  1814 samples, 0
-      (15531.441501008434, 2.6950897058012684),  # 50K..180K  671 samples, 50937.74069459752
-      (41958.68833499996, 2.5483011271896387),  # 180K..100M  79 samples, 180036.12463550194
-    ]
-  # 交点を計算する
-  for i in range(len(__RU_MODEL) - 1):
-    b1, a1 = __RU_MODEL[i]
-    b2, a2 = __RU_MODEL[i + 1]
-    x = (b2 - b1) / (a1 - a2)
-    y = a1 * x + b1
+  for i, ((x, y), (b2, a2)) in enumerate(zip(__RU_MODEL.points(),
+                                             __RU_MODEL.params[1:])):
     print(f"ru_model seg {i}: P({x:9.2f}, {y:9.2f})  F(a={a2}, b={b2})")
+  return __RU_MODEL
+
+
+def get_ru_model() -> RuModel:
+  """set_ru_model() で選んだモデル"""
+  return __RU_MODEL
 
 
 def ru_model_x(xmin, xmax) -> list:
@@ -127,7 +1746,11 @@ def ru_model_x(xmin, xmax) -> list:
 
 
 def ru_model(total_gift: int) -> float:
-  return min([total_gift * k[1] + k[0] for k in __RU_MODEL])
+  return __RU_MODEL(total_gift)
+
+
+def ru_model_many(total_gift) -> np.ndarray:
+  return __RU_MODEL.many(total_gift)
 
 
 def comma_formatter(x, pos):
@@ -162,6 +1785,50 @@ def classify_geq(sep: list, d: dict) -> bool:
   return True
 
 
+# classify() の境界線. 上から順に Z, A, B
+SEPARATORS = [
+    [[0, 3.1], [40000, 2.8], [140000, 2.6]],
+    [[0, 2.8], [20000, 2.6], [120000, 2.3]],
+    [[0, 2.4], [20000, 2.3], [60000, 2.1]],
+]
+
+
+def compile_separators(separators: list) -> list:
+  """境界線ごとに, 線分の (x1, y1, x2 - x1, y2 - y1) の配列を作る."""
+  ret = []
+  for sep in separators:
+    ret.append([(x1, y1, x2 - x1, y2 - y1)
+                for (x1, y1), (x2, y2) in zip(sep[:-1], sep[1:])])
+  return ret
+
+
+_SEPARATOR_SEGMENTS = compile_separators(SEPARATORS)
+
+
+def classify_many(total_gift, rate, segments=None):
+  """classify() を配列に対してまとめて行う.
+
+  segments は compile_separators() の結果. 省略時は SEPARATORS.
+
+  >>> classify_many(np.array([20_000, 20_000, 80_000]),
+  ...               np.array([3.1, 2.8, 2.3])).tolist()
+  [0, 1, 2]
+  """
+  if segments is None:
+    segments = _SEPARATOR_SEGMENTS
+  x = np.asarray(total_gift)
+  y = np.asarray(rate)
+  ret = np.full(x.shape, len(segments), dtype=np.int64)
+  # 後ろの境界線から上書きして, 最初に当てはまるものを残す
+  for k in range(len(segments) - 1, -1, -1):
+    geq = np.ones(x.shape, dtype=bool)
+    for x1, y1, dx, dy in segments[k]:
+      # 2点を結ぶ直線より上にあるか. classify_geq() と同じ式
+      geq &= dx * (y - y1) - dy * (x - x1) >= 0
+    ret[geq] = k
+  return ret
+
+
 def classify(d: dict) -> int:
   """どのグループに属するか.
 
@@ -187,13 +1854,393 @@ def classify(d: dict) -> int:
   >>> classify({'total_gift': 80_000, 'rate': 2.3})
   2
   """
-  if classify_geq([[0, 3.1], [40000, 2.8], [140000, 2.6]], d):
-    return 0
-  if classify_geq([[0, 2.8], [20000, 2.6], [120000, 2.3]], d):
-    return 1
-  if classify_geq([[0, 2.4], [20000, 2.3], [60000, 2.1]], d):
-    return 2
-  return 3
+  return int(classify_many(d['total_gift'], d['rate']))
+
+
+# ##########################################
+# 索引
+# ##########################################
+
+# 索引を作る列
+SORTED_INDEX_COLUMNS = ('rank', 'total_gift', '1000coin', '100coin', '10coin')
+BITMAP_INDEX_COLUMNS = ('date', 'user_rank')
+INDEX_VERSION = 1
+
+
+class SortedIndex:
+  """
+  数値の列を値の昇順に並べた行番号. 比較の条件を二分探索で引く.
+  値のない行 (has が False) は missing に分けておく.
+
+  >>> idx = SortedIndex.build(np.array([5, 1, 3, 3]), np.array([1, 1, 1, 0], dtype=bool))
+  >>> idx.lookup(operator.ge, 3).tolist(), idx.lookup(operator.eq, 3).tolist()
+  ([2, 0], [2])
+  >>> idx.lookup(operator.lt, 5).tolist(), idx.missing.tolist()
+  ([1, 2], [3])
+  """
+
+  def __init__(self, order, values, missing, n: int):
+    self.order = order
+    self.values = values
+    self.missing = missing
+    self.n = n
+
+  @classmethod
+  def build(cls, col, has) -> 'SortedIndex':
+    rows = np.flatnonzero(has)
+    order = rows[np.argsort(col[rows], kind='stable')]
+    return cls(order, col[order], np.flatnonzero(~has), len(col))
+
+  def lookup(self, op, value) -> np.ndarray:
+    """op(値, value) を満たす行番号 (値の昇順)"""
+    lo = np.searchsorted(self.values, value, side='left')
+    hi = np.searchsorted(self.values, value, side='right')
+    n = len(self.values)
+    a, b = {operator.eq: (lo, hi),
+            operator.lt: (0, lo),
+            operator.le: (0, hi),
+            operator.gt: (hi, n),
+            operator.ge: (lo, n)}[op]
+    return self.order[a:b]
+
+  def mask(self, pred) -> np.ndarray:
+    """pred を満たす行の mask. 索引で引けない条件なら None"""
+    if pred.op not in _INDEX_OPS or pred.conv not in (None, int, float) \
+        or not isinstance(pred.value, (int, float)):
+      return None
+    m = np.zeros(self.n, dtype=bool)
+    m[self.lookup(pred.op, pred.value)] = True
+    if pred._test_missing():
+      m[self.missing] = True
+    return m
+
+
+class BitmapIndex:
+  """
+  文字列の列の値ごとの行のビットマップ (np.packbits).
+  最後の行は値のない行. 条件は値一覧ごとに判定して OR をとる.
+  """
+
+  def __init__(self, bits, cats: list, n: int):
+    self.bits = bits
+    self.cats = cats
+    self.n = n
+
+  @classmethod
+  def build(cls, codes, cats: list) -> 'BitmapIndex':
+    n = len(codes)
+    bits = np.zeros((len(cats) + 1, n), dtype=bool)
+    # 欠損の -1 は最後の行になる
+    bits[codes, np.arange(n)] = True
+    return cls(np.packbits(bits, axis=1), cats, n)
+
+  def mask(self, pred) -> np.ndarray:
+    table = [pred.test(v) for v in self.cats] + [pred._test_missing()]
+    sel = np.flatnonzero(table)
+    if len(sel) == 0:
+      return np.zeros(self.n, dtype=bool)
+    bits = np.bitwise_or.reduce(self.bits[sel], axis=0)
+    return np.unpackbits(bits, count=self.n).astype(bool)
+
+
+class DatasetIndex:
+  """
+  LiveDataset の索引の組. 初めて使うときに作る.
+  path = (パス, 署名) があれば npz に保存し, 署名が同じなら次回はそれを読む.
+  """
+
+  def __init__(self, ds, path=None):
+    self._ds = ds
+    self._path = path
+    self._indexes = None
+
+  def get(self, name: str):
+    if name not in SORTED_INDEX_COLUMNS and name not in BITMAP_INDEX_COLUMNS:
+      return None
+    if self._indexes is None:
+      self._indexes = self._load()
+      if self._indexes is None:
+        self._indexes = self._build()
+        self._save()
+    return self._indexes.get(name)
+
+  def _build(self) -> dict:
+    ds = self._ds
+    ret = {}
+    for name in SORTED_INDEX_COLUMNS:
+      ret[name] = SortedIndex.build(ds[name], ds.has(name))
+    for name in BITMAP_INDEX_COLUMNS:
+      ret[name] = BitmapIndex.build(ds.codes(name),
+                                    ds.categories(name).tolist())
+    return ret
+
+  def _load(self):
+    if self._path is None:
+      return None
+    path, sig = self._path
+    n = len(self._ds)
+    try:
+      with np.load(path) as z:
+        if int(z['version']) != INDEX_VERSION or str(z['sig']) != sig \
+            or int(z['n']) != n:
+          return None
+        ret = {}
+        for name in SORTED_INDEX_COLUMNS:
+          ret[name] = SortedIndex(z[f'{name}.order'], z[f'{name}.values'],
+                                  z[f'{name}.missing'], n)
+        for name in BITMAP_INDEX_COLUMNS:
+          ret[name] = BitmapIndex(z[f'{name}.bits'],
+                                  self._ds.categories(name).tolist(), n)
+      # 最近使ったものを _evictCache() で残す
+      os.utime(path)
+      return ret
+    except (OSError, KeyError, ValueError):
+      return None
+
+  def _save(self) -> None:
+    if self._path is None:
+      return
+    path, sig = self._path
+    arrays = {'version': np.array(INDEX_VERSION), 'sig': np.array(sig),
+              'n': np.array(len(self._ds))}
+    for name, index in self._indexes.items():
+      if isinstance(index, SortedIndex):
+        arrays[f'{name}.order'] = index.order
+        arrays[f'{name}.values'] = index.values
+        arrays[f'{name}.missing'] = index.missing
+      else:
+        arrays[f'{name}.bits'] = index.bits
+    try:
+      path.parent.mkdir(parents=True, exist_ok=True)
+      tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+      with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+      os.replace(tmp, path)
+    except OSError as e:
+      print(f"cannot write index {path}: {e}", file=sys.stderr)
+    _evictCache(path.parent, 'index-*.npz')
+
+
+# ##########################################
+# 条件式
+# ##########################################
+
+class Predicate:
+  """
+  レコードの条件 op(key の値, value).
+  p(d) で 1 レコード (dict) を, p.mask(ds) で LiveDataset 全体を判定する.
+
+  conv は比べる前に値へ適用する変換. key がないレコードは missing の値で
+  比べ, missing が None なら条件を満たさない.
+  文字列の列は値一覧ごとに 1 回だけ判定して添字で引く.
+
+  >>> p = Predicate('user_rank', operator.eq, 'S')
+  >>> p({'user_rank': 'S'}), p({'user_rank': 'A1'}), p({})
+  (True, False, False)
+  """
+
+  def __init__(self, key: str, op, value, conv=None, missing=None):
+    self.key = key
+    self.op = op
+    self.value = value
+    self.conv = conv
+    self.missing = missing
+
+  def __repr__(self) -> str:
+    return f'Predicate({self.key!r}, {getattr(self.op, "__name__", self.op)}, {self.value!r})'
+
+  def test(self, v) -> bool:
+    """値 v が条件を満たすか"""
+    if self.conv is not None:
+      v = self.conv(v)
+    return bool(self.op(v, self.value))
+
+  def __call__(self, d: dict) -> bool:
+    if self.key in d:
+      return self.test(d[self.key])
+    if self.missing is None:
+      return False
+    return self.test(self.missing)
+
+  def _test_missing(self) -> bool:
+    return self.missing is not None and self.test(self.missing)
+
+  def mask(self, ds) -> np.ndarray:
+    index = ds.index(self.key)
+    if index is not None:
+      m = index.mask(self)
+      if m is not None:
+        return ds.from_base(m)
+
+    if self.key in LiveDataset.STR_COLUMNS and self.key in _RECORD_COLUMNS:
+      # 値一覧ごとの判定表. 末尾は欠損 (-1)
+      table = [self.test(v) for v in ds.categories(self.key).tolist()]
+      table.append(self._test_missing())
+      return np.array(table, dtype=bool)[ds.codes(self.key)]
+
+    if self.key not in _RECORD_COLUMNS:
+      # extra に入っている列など
+      return np.fromiter((self(d) for d in ds.records()), dtype=bool,
+                         count=len(ds))
+
+    col = ds[self.key]
+    if self.op in _VECTOR_OPS and self.conv in (None, int, float):
+      m = np.asarray(self.op(col, self.value), dtype=bool)
+    else:
+      # 正規表現などは値の種類ごとに判定する
+      uniq, inv = np.unique(col, return_inverse=True)
+      table = np.array([self.test(v) for v in uniq.tolist()], dtype=bool)
+      m = table[inv]
+    if self.key in ds.OPTIONAL_COLUMNS:
+      m = np.where(ds.has(self.key), m, self._test_missing())
+    return m
+
+
+class _NotExcluded(Predicate):
+  """--dimension exclude: 跳ねていない"""
+
+  def __init__(self):
+    super().__init__('livescore', None, None)
+
+  def __repr__(self) -> str:
+    return '_NotExcluded()'
+
+  def __call__(self, d: dict) -> bool:
+    return not is_excluded(d['total_gift'], d['livescore'])
+
+  def mask(self, ds) -> np.ndarray:
+    return ~is_excluded(ds['total_gift'], ds['livescore'])
+
+
+# ベクトル化できる比較
+_VECTOR_OPS = (operator.lt, operator.le, operator.eq, operator.ne,
+               operator.ge, operator.gt)
+# SortedIndex で引ける比較
+_INDEX_OPS = (operator.lt, operator.le, operator.eq, operator.ge, operator.gt)
+
+# LiveDataset.records() の辞書にある列
+_RECORD_COLUMNS = frozenset(LiveDataset.OPTIONAL_COLUMNS + _INT_DERIVED_KEYS
+                             + ('rate', 'filename'))
+
+_COND_OPS = {'<': operator.lt,
+             '>': operator.gt,
+             '>=': operator.ge,
+             '<=': operator.le,
+             '=': operator.eq}
+
+
+def _regex_op(pattern: str):
+  r = re.compile(pattern)
+
+  def search(a, b) -> bool:
+    return r.search(a) is not None
+  return search
+
+
+def parse_cond(cond: str) -> Predicate:
+  """
+  extract.py --cond の "key op value" を Predicate にする.
+  op は <, >, <=, >=, = と正規表現の =~.
+
+  >>> parse_cond('rank>1000')
+  Predicate('rank', gt, 1000)
+  >>> parse_cond('  rank   < 1000  ')
+  Predicate('rank', lt, 1000)
+  >>> parse_cond('gift>=1.5')({'total_gift': 2})
+  True
+  >>> parse_cond('user_rank=~^A')({'user_rank': 'A5'})
+  True
+  """
+  m = re.fullmatch(r'\s*(\S+?)\s*(=~|>=|<=|[<=>])\s*(\S+)\s*', cond)
+  if not m:
+    raise ValueError(f'Invalid condition: {cond}')
+  key, op, value = m.groups()
+  if op == '=~':
+    # 正規表現マッチ
+    return Predicate(key, _regex_op(value), value)
+
+  if op not in _COND_OPS:
+    raise ValueError(f'Invalid operator: {op}')
+  if re.fullmatch(r'\d+', value):
+    value = int(value)
+  else:
+    value = float(value)
+
+  if key in ["gift"]:
+    key = 'total_gift'
+
+  return Predicate(key, _COND_OPS[op], value)
+
+
+def _dimension_operator(dimension: str):
+  if dimension.startswith('<='):
+    return operator.le, dimension[2:]
+  elif dimension.startswith('>='):
+    return operator.ge, dimension[2:]
+  compares = {'<': operator.lt,
+              '>': operator.gt,
+              '=': operator.eq}
+  if dimension[0] not in compares:
+    return operator.eq, dimension
+  return compares[dimension[0]], dimension[1:]
+
+
+def parse_dimension(dimension: str) -> list:
+  """
+  makecsv.py --dimension を Predicate のリスト (すべて満たす) にする.
+
+  >>> parse_dimension('>10coin20')
+  [Predicate('10coin', gt, 20)]
+  >>> [p({'rank': 3, 'date': '20251013'}) for p in parse_dimension('20251013-5')]
+  [False, True]
+  """
+  if not dimension:
+    return []
+  elif dimension == "exclude":
+    return [_NotExcluded()]
+  elif not isinstance(dimension, str):
+    raise Exception(f"invalid dimension type: {type(dimension)}")
+
+  compare, dimension = _dimension_operator(dimension)
+
+  ret = []
+  ctype = int
+  if re.fullmatch(r'20\d\d[01]\d[0-3]\d', dimension):
+    key = 'date'
+    value = int(dimension)
+  elif re.fullmatch(r'score\d+', dimension):
+    key = 'livescore'
+    value = int(dimension[5:])
+  elif re.fullmatch(r'\d+(coin|gift)\d+', dimension):
+    m = re.fullmatch(r'(\d+)(coin|gift)(\d+)', dimension)
+    key = f'{m.group(1)}coin'
+    value = int(m.group(3))
+  elif re.fullmatch(r'100(coin|gift)\d+-\d+', dimension):
+    key = '10coin'
+    value = int(dimension.split('-')[1])
+    value2 = int(dimension.split('-')[0][7:])
+    ret.append(Predicate('100coin', operator.eq, value2))
+  elif re.fullmatch(r'20\d\d[01]\d[0-3]\d-\d+', dimension):
+    key = 'rank'
+    value = int(dimension.split('-')[1])
+    value2 = int(dimension.split('-')[0])
+    ret.append(Predicate('date', operator.eq, value2, conv=int, missing=0))
+  elif re.fullmatch(r'rank[ABCDS][12345S]?', dimension):
+    ctype = str
+    key = 'user_rank'
+    value = dimension[4:]
+  else:
+    raise Exception(f"invalid dimension: {dimension}")
+
+  return [Predicate(key, compare, value, conv=ctype, missing=0)] + ret
+
+
+def predicate_mask(ds, preds: list) -> np.ndarray:
+  """preds をすべて満たすレコードなら True の配列"""
+  m = np.ones(len(ds), dtype=bool)
+  for p in preds:
+    m &= p.mask(ds)
+  return m
 
 
 if __name__ == "__main__":
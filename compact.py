@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+日のディレクトリ (YYYYMMDD/) の JSON を 1 つのパック (records.pack) に
+まとめる.
+
+パックは mmap して読むので，1 日分をファイル 1 つを開くだけで
+JSON を解析せずに読める. readDataset() などはパックと，パックにない
+JSON (その日にあとから増えたもの) を合わせて読む.
+今日のディレクトリはまだ増えるので --all がなければまとめない.
+
+  $ python compact.py .
+  $ python compact.py --remove 20251008 20251009
+"""
+
+import datetime
+import os
+import sys
+from pathlib import Path
+from common import compactDir, PACK_NAME
+from common import profile_stage, add_profile_arguments, start_profile
+
+
+def day_dirs(fnames: list) -> list:
+  """fnames 以下で JSON かパックを含むディレクトリ (. で始まるものを除く)."""
+  ret = []
+  for fname in fnames:
+    for dirpath, dirnames, filenames in os.walk(fname):
+      dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+      if any(f.endswith('.json') or f == PACK_NAME for f in filenames):
+        ret.append(dirpath)
+  return ret
+
+
+def main() -> int:
+  import argparse
+
+  parser = argparse.ArgumentParser(description='pack day directories')
+  parser.add_argument('dirs', nargs='*', default=['.'])
+  parser.add_argument('--remove', action='store_true',
+                      help="remove the json files after checking the pack")
+  parser.add_argument('--all', action='store_true',
+                      help="also pack today's directory")
+  parser.add_argument('-n', '--dry-run', action='store_true',
+                      help="only list the directories to pack")
+  add_profile_arguments(parser)
+  args = parser.parse_args()
+  start_profile(args, 'compact', memory=False)
+
+  today = datetime.date.today().strftime('%Y%m%d')
+  for dirname in day_dirs(args.dirs):
+    if Path(dirname).name == today and not args.all:
+      print(f"{dirname}: skip today", file=sys.stderr)
+      continue
+    if args.dry_run:
+      print(dirname)
+      continue
+    with profile_stage('compact.dir') as st:
+      added, n = compactDir(dirname, args.remove)
+      st.records = added
+    if added:
+      size = os.path.getsize(os.path.join(dirname, PACK_NAME))
+      print(f"{dirname}: {added} files -> {PACK_NAME}"
+            f" ({n} records, {size:,} bytes)")
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
+
+
+# vim:set et ts=2 sts=2 sw=2 tw=80:
@@ -4,22 +4,20 @@
 """
 """
 
-from common import readJsons
+from common import readDataset, iter_records, parse_cond
+from common import predicate_mask, argsort_stable, profile_stage
+from common import add_profile_arguments, start_profile
+import numpy as np
+import itertools
 import re
-import operator
+import sys
 
 
 def is_target(data: dict, conds: list) -> bool:
-  for cond in conds:
-    key, op, value = cond
-    if key not in data:
-      return False
-    if not op(data[key], value):
-      return False
-  return True
+  return all(cond(data) for cond in conds)
 
 
-def print_data(data: dict, keys: list):
+def format_data(data: dict, keys: list) -> str:
   out = []
   for k in keys:
     v = data.get(k, '')
@@ -27,56 +25,58 @@ def print_data(data: dict, keys: list):
       out.append(f'{v:.3f}')
     else:
       out.append(str(v))
-  print(','.join(out))
-
-
-def parse_cond(cond: str) -> list:
-  """ <, =, > のいずれかで分割する
-
-  >>> a = parse_cond('rank>1000')
-  >>> a[0] == "rank"
-  True
-  >>> a[1](1500, 1000)
-  True
-  >>> a[1](500, 1000)
-  False
-  >>> a[2] == 1000
-  True
-  >>> a = parse_cond('  rank   < 1000  ')
-  >>> a[0] == "rank"
-  True
-  >>> a[1](1500, 1000)
-  False
-  >>> a[1](500, 1000)
-  True
-  >>> a[2] == 1000
-  True
+  return ','.join(out)
+
+
+def write_data(fp, records, keys: list) -> None:
+  """records を 1 行ずつ print せずにまとめて書く"""
+  fp.writelines(format_data(d, keys) + '\n' for d in records)
+
+
+# --group-by で --agg がないときの集計
+DEFAULT_AGGS = ['count', 'sum:total_gift', 'mean:total_gift',
+                'mean:livescore', 'mean:rate', 'median:rate', 'p90:rate']
+
+
+def parse_order(order: str) -> tuple:
+  """ "-" を前につけると昇順
+
+  >>> parse_order('livescore'), parse_order('-rank')
+  (('livescore', True), ('rank', False))
+  """
+  if order.startswith('-'):
+    return order[1:], False
+  return order, True
+
+
+def parse_agg(agg: str) -> tuple:
+  """ "関数:列" を (関数, 列) にする. count は列を省略できる
+
+  >>> parse_agg('p90:rate'), parse_agg('count')
+  (('p90', 'rate'), ('count', None))
   """
-  m = re.fullmatch(r'\s*(\S+)\s*(=~|[<=>]|>=|<=)\s*(\S+)\s*', cond)
-  if not m:
-    raise ValueError(f'Invalid condition: {cond}')
-  key, op, value = m.groups()
-  print([key, op, value])
-  compares = {'<': operator.lt,
-              '>': operator.gt,
-              '>=': operator.ge,
-              '<=': operator.le,
-              '=': operator.eq}
-  if op == '=~':
-    # 正規表現マッチ
-    return [key, lambda a, b: re.search(b, a) is not None, value]
-
-  if op not in compares:
-    raise ValueError(f'Invalid operator: {op}')
-  if re.fullmatch(r'\d+', value):
-    value = int(value)
-  else:
-    value = float(value)
-
-  if key in ["gift"]:
-    key = 'total_gift'
-
-  return [key, compares[op], value]
+  func, _, col = agg.partition(':')
+  if not re.fullmatch(r'count|sum|mean|median|min|max|p\d+(\.\d+)?', func):
+    raise ValueError(f'Invalid aggregate: {agg}')
+  if not col and func != 'count':
+    raise ValueError(f'Invalid aggregate: {agg}')
+  return func, col or None
+
+
+def print_groups(ds, by: list, aggs: list, orders: list, limit: int):
+  """by の列ごとの集計を CSV で出力する. orders は出力の列で並べる"""
+  cols = ds.aggregate(by, aggs)
+  keys = list(cols)
+  print(','.join(keys))
+
+  idx = np.arange(len(cols[keys[0]]) if keys else 0)
+  for col, reverse in reversed(orders):
+    if col in cols:
+      idx = idx[argsort_stable(np.array(cols[col])[idx], reverse)]
+  if limit is not None:
+    idx = idx[:limit]
+  rows = [{k: cols[k][i] for k in keys} for i in idx.tolist()]
+  write_data(sys.stdout, rows, keys)
 
 
 def main():
@@ -90,10 +90,29 @@ def main():
   parser.add_argument('--key', action='append',
                       help='SELECT 文の列を追加する.'
                       ' e.g, --key date --key rank')
-  parser.add_argument('--order', default="livescore")
+  parser.add_argument('--order', action='append',
+                      help='並べ替える列. "-" を前につけると昇順.'
+                      ' 繰り返すと先の列から順に比べる. 既定は livescore.'
+                      ' 空文字列なら並べ替えずに 1 件ずつ出力する')
+  parser.add_argument('-n', '--limit', type=int,
+                      help='先頭の N 件だけを出力する.'
+                      ' --order の列は全体をソートせずに上位 N 件を選ぶ')
+  parser.add_argument('--group-by', action='append',
+                      help='列の値ごとに集計する. 繰り返すと値の組ごと.'
+                      ' e.g., --group-by date --group-by user_rank')
+  parser.add_argument('--agg', action='append',
+                      help='--group-by の集計を "関数:列" で追加する.'
+                      ' 関数は count, sum, mean, median, min, max, pNN.'
+                      f' 既定は {" ".join(DEFAULT_AGGS)}.'
+                      ' e.g., --agg p90:total_gift')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help="number of processes to read json files;"
+                      " 0 means all CPUs")
   parser.add_argument('--doctest', action='store_true',
                       help='Run doctest and exit.')
+  add_profile_arguments(parser)
   args = parser.parse_args()
+  start_profile(args, 'extract')
 
   if args.doctest:
     import doctest
@@ -106,28 +125,48 @@ def main():
                 'max_coin', '1000coin',
                 '100coin', '10coin', '0coin']
 
-  jsons = readJsons(args.args)
-
   conds = [parse_cond(c) for c in args.cond or []]
+  if args.limit is not None:
+    args.limit = max(args.limit, 0)
+
+  if args.group_by:
+    # 集計は読み込んだ列のまま行う. 並べ替えは集計結果の列で
+    aggs = [parse_agg(a) for a in args.agg or DEFAULT_AGGS]
+    ds = read_filtered(args, conds)
+    with profile_stage('extract.group', len(ds)):
+      print_groups(ds, args.group_by, aggs,
+                   [parse_order(o) for o in args.order or [] if o],
+                   args.limit)
+    return
 
   print(','.join(args.key))
 
-  ret = []
-  for data_list in jsons.values():
-    for data in data_list:
-      if is_target(data, conds):
-        ret.append(data)
+  orders = args.order or ['livescore']
+  if not any(orders):
+    # 並べ替えないなら全体を読まずに流す
+    records = iter_records(args.args, where=lambda d: is_target(d, conds),
+                           workers=args.jobs)
+    with profile_stage('extract.stream'):
+      write_data(sys.stdout, itertools.islice(records, args.limit), args.key)
+    return
+
+  ds = read_filtered(args, conds)
+
+  keys = [parse_order(o) for o in orders if o]
+  with profile_stage('extract.order', len(ds)):
+    ds = ds.order_by([k for k in keys if k[0] in ds], limit=args.limit)
+
+  with profile_stage('extract.write', len(ds)):
+    write_data(sys.stdout, ds.records(), args.key)
 
-  if args.order:
-    if args.order[0] == '-':
-      args.order = args.order[1:]
-      reverse = False
-    else:
-      reverse = True
-    ret.sort(key=lambda x: x.get(args.order, 0), reverse=reverse)
 
-  for data in ret:
-    print_data(data, args.key)
+def read_filtered(args, conds: list):
+  """args.args を読んで conds をすべて満たすレコードだけにする"""
+  with profile_stage('read') as st:
+    ds = readDataset(args.args, workers=args.jobs)
+    st.records = len(ds)
+  with profile_stage('extract.filter', len(ds)):
+    return ds.filter(predicate_mask(ds, conds))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+スクリプトの import にかかる時間を python -X importtime で測り，
+予算を超えていないか確認する.
+
+cron などから何度も呼ぶので，CSV だけを作るときに matplotlib を
+読んでいないことも確認する.
+
+  $ python importtime.py
+  $ python importtime.py --budget 200 makecsv extract
+"""
+
+import os
+import re
+import subprocess
+import sys
+
+# 既定で測るモジュール
+DEFAULT_MODULES = ('common', 'makecsv', 'extract', 'linfit', 'classify')
+# これらのモジュールの import で読んではいけないもの (描画するときだけ読む)
+FORBIDDEN = ('matplotlib',)
+
+_LINE = re.compile(r'import time:\s*(\d+)\s*\|\s*(\d+)\s*\|( *)(\S+)')
+
+
+def parse_importtime(text: str) -> list:
+  """
+  -X importtime の出力を (モジュール名, 自身の us, 累積の us, 深さ)
+  のリストにする.
+
+  >>> parse_importtime('''import time: self [us] | cumulative | imported package
+  ... import time:       100 |        150 |   numpy.core
+  ... import time:       200 |        350 | numpy''')
+  [('numpy.core', 100, 150, 1), ('numpy', 200, 350, 0)]
+  """
+  ret = []
+  for line in text.splitlines():
+    m = _LINE.match(line)
+    if m:
+      ret.append((m.group(4), int(m.group(1)), int(m.group(2)),
+                  len(m.group(3)) // 2))
+  return ret
+
+
+def measure(module: str, cwd: str = None) -> list:
+  """新しいインタプリタで module を import し，parse_importtime() の結果を返す."""
+  p = subprocess.run([sys.executable, '-X', 'importtime',
+                      '-c', f'import {module}'],
+                     cwd=cwd, capture_output=True, text=True)
+  if p.returncode != 0:
+    raise RuntimeError(f"import {module} failed:\n{p.stderr}")
+  return parse_importtime(p.stderr)
+
+
+def check(module: str, budget: float, repeat: int = 3,
+          top: int = 5, cwd: str = None) -> bool:
+  """module の import 時間 (repeat 回の最小値) が budget ms 以下で，
+  FORBIDDEN を読んでいなければ True.
+  """
+  runs = [measure(module, cwd) for _ in range(repeat)]
+  times = [next(c for name, _, c, _ in r if name == module) for r in runs]
+  ms = min(times) / 1000
+  loaded = {name.split('.')[0] for name, _, _, _ in runs[0]}
+  bad = sorted(loaded & set(FORBIDDEN))
+
+  ok = ms <= budget and not bad
+  status = 'ok' if ok else 'NG'
+  print(f"{module:<10} {ms:8.1f} ms  (budget {budget:.0f} ms)  {status}")
+  for name in bad:
+    print(f"  imports {name}")
+  # 時間のかかっているトップレベルの import
+  first = [(c, name) for name, _, c, depth in runs[0] if depth == 1]
+  for c, name in sorted(first, reverse=True)[:top]:
+    print(f"  {c / 1000:8.1f} ms  {name}")
+  return ok
+
+
+def main() -> int:
+  import argparse
+
+  parser = argparse.ArgumentParser(description='import time budget check')
+  parser.add_argument('modules', nargs='*', default=list(DEFAULT_MODULES))
+  parser.add_argument('--budget', type=float, default=300,
+                      help="maximum import time in ms per module;"
+                      " default %(default)s")
+  parser.add_argument('--repeat', type=int, default=3,
+                      help="take the fastest of N runs; default %(default)s")
+  parser.add_argument('--top', type=int, default=5,
+                      help="show the N slowest direct imports;"
+                      " default %(default)s")
+  parser.add_argument('--doctest', action='store_true')
+  args = parser.parse_args()
+
+  if args.doctest:
+    import doctest
+    doctest.testmod()
+    return 0
+
+  cwd = os.path.dirname(os.path.abspath(__file__))
+  results = [check(m, args.budget, args.repeat, args.top, cwd)
+             for m in args.modules]
+  return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
+
+
+# vim:set et ts=2 sts=2 sw=2 tw=80:
@@ -5,26 +5,71 @@
 """
 
 import numpy as np
-from common import is_excluded, readJsons, limitedJsons, comma_formatter
+from common import is_excluded, readDataset, limitedJsons, comma_formatter
+from common import segmentIndex, LiveDataset, IncrementalState
+from common import iter_records, profile_stage, profiled, EXCLUDE_LINE
+from common import add_profile_arguments, start_profile
 import datetime
+import itertools
 # import os
 
 
 def vif(X):
-  # X: 説明変数行列（切片列を含めないで渡すことを推奨）
-  X = np.asarray(X)[:, 1:]
-  n_vars = X.shape[1]
+  # X: 説明変数行列. 先頭の切片列は除いて計算する
+  X = np.asarray(X, dtype=np.float64)[:, 1:]
+  return vif_nested(centered_r(X), [X.shape[1]])[0]
+
+
+def centered_r(X):
+  """平均を引いた X の QR 分解の R. R^T R が偏差の積和行列になる."""
+  X = np.asarray(X, dtype=np.float64)
+  return np.linalg.qr(X - X.mean(axis=0), mode='r')
+
+
+@profiled('linfit.vif')
+def vif_nested(r, ms: list) -> list:
+  """先頭 m 列 (m in ms) の説明変数ごとの VIF を返す.
+
+  r は centered_r() のような, R^T R が偏差の積和行列になる上三角行列.
+  列の長さをそろえた U = R / |R| は相関行列の Cholesky 分解 corr = U^T U で,
+  先頭 m 列の相関行列の分解は U の左上 m x m になる.
+  VIF は相関行列の逆行列の対角で, U^-1 の行の二乗和なので,
+  U の逆行列を 1 回求めればすべての m の VIF が出る.
+  列が定数のときや多重共線性で U が正則でないときは列ごとに回帰する.
+
+  >>> x = np.array([[1, 2], [2, 1], [3, 4], [4, 3]])
+  >>> [v.round(6).tolist() for v in vif_nested(centered_r(x), [1, 2])]
+  [[1.0], [1.5625, 1.5625]]
+  """
+  r = np.asarray(r, dtype=np.float64)
+  d = np.linalg.norm(r, axis=0)
+  m = r.shape[1]
+  if len(r) >= m and (d > 0).all():
+    u = r[:m] / d
+    diag = np.abs(np.diag(u))
+    # diag[i]^2 は i 列目を前の列で回帰したときの 1 - R^2
+    if (diag ** 2 > 1e-12).all():
+      c = np.cumsum(np.linalg.inv(u) ** 2, axis=1)
+      return [c[:k, k - 1] for k in ms]
+
+  d[d == 0] = 1
+  corr = r.T @ r / np.outer(d, d)
+  # 定数の列は他の列と相関なしとする
+  for j in np.flatnonzero(np.diag(corr) == 0):
+    corr[j, j] = 1
+  return [_vif_corr(corr[:k, :k]) for k in ms]
+
+
+def _vif_corr(corr):
+  """相関行列から, 各列を他の列で回帰した R^2 を求めて VIF にする."""
   vifs = []
-  for j in range(n_vars):
-    X_j = X[:, j]
-    X_others = np.delete(X, j, axis=1)
-    # 回帰 X_j ~ X_others
-    beta, *_ = np.linalg.lstsq(np.column_stack((np.ones(len(X_j)), X_others)), X_j, rcond=None)
-    yhat = np.column_stack((np.ones(len(X_j)), X_others)) @ beta
-    ssr = np.sum((X_j - yhat)**2)
-    sst = np.sum((X_j - X_j.mean())**2)
-    r2 = 1 - ssr / sst if sst != 0 else 0.0
-    vif_j = 1.0 / (1.0 - r2) if (1.0 - r2) != 0 else float('inf')
+  for j in range(len(corr)):
+    others = np.delete(np.arange(len(corr)), j)
+    c = corr[others, j]
+    beta, *_ = np.linalg.lstsq(corr[np.ix_(others, others)], c, rcond=None)
+    # 完全な多重共線性では丸め誤差で R^2 が 1 を少し超える
+    r2 = c @ beta
+    vif_j = 1.0 / (1.0 - r2) if (1.0 - r2) > 1e-12 else float('inf')
     vifs.append(vif_j)
   return np.array(vifs)
 
@@ -36,7 +81,9 @@ def linfit_origin(X, Y):
   return [0] + list(a)
 
 
-def linfit(X, Y, aic=False, origin=False):
+@profiled('linfit.fit')
+def linfit(X, Y, aic=False, origin=False, vifs=None):
+  """vifs は説明変数の VIF. 省略したら aic のときに X から計算する."""
   if len(X) != len(Y):
     raise ValueError("len(X) != len(Y): {} != {}".format(len(X), len(Y)))
   if (len(X) == 0):
@@ -47,10 +94,7 @@ def linfit(X, Y, aic=False, origin=False):
     a = [linfit_origin(X[:, 1:], Y)]
   else:
     a = np.linalg.lstsq(X, Y, rcond=-1)
-  y_pred = []
-  for i in range(len(Y)):
-    y_pred.append(np.dot(a[0], X[i]))
-  y_pred = np.array(y_pred)
+  y_pred = X @ np.asarray(a[0], dtype=np.float64)
   rss = np.sum((y_pred - Y)**2)
   tss = np.sum((Y - np.mean(Y))**2)
   assert tss > 0, (X.shape, Y.shape)
@@ -61,52 +105,52 @@ def linfit(X, Y, aic=False, origin=False):
   print("R^2 =", r2)   # 1 に近い（大きい）ほど良い
   if aic:
     aic = len(Y) * np.log(rss / len(Y)) + 2 * len(a[0])
-    _vif = vif(X[:, :len(a[0])])
+    _vif = vif(X[:, :len(a[0])]) if vifs is None else vifs
     print("aic =", aic)  # 小さいほど良い
     print("vif =", _vif)  # 小さいほど良い
   print()
   return a, r2
 
 
-def seprat(g_jsons, sep):
+@profiled('linfit.seprat')
+def seprat(ds, sep):
   ret = []
-  for i in range(len(sep) - 1):
-    jsons = limitedJsons(g_jsons, sep[i], sep[i + 1], None, None)
-
-    x = []
-    y = []
-    for data in dir2list(jsons):
-      gift_sum = data['total_gift']
-      livescore = data['livescore']
-
-      if i != 0 and is_excluded(gift_sum, livescore):
-        continue
-
-      y.append(livescore)
-      x.append([1, gift_sum])
+  for i, idx in enumerate(segmentIndex(ds, sep)):
+    seg = ds.take(idx)
+    gift_sum = seg['total_gift']
+    livescore = seg['livescore']
+    if i != 0:
+      keep = ~is_excluded(gift_sum, livescore)
+      gift_sum = gift_sum[keep]
+      livescore = livescore[keep]
+
+    assert len(gift_sum) > 0, ["no data for range", sep[i], "~", sep[i + 1]]
+    print("Range:", sep[i], "~", sep[i + 1], " #data", len(gift_sum))
+
+    x = np.column_stack((np.ones(len(gift_sum), dtype=np.int64), gift_sum))
+    y = livescore
+    a, r2 = linfit(x, y, aic=False, origin=(i == 0))
+    ret.append([a[0], sep[i], sep[i+1], len(x)])
 
-    assert len(x) > 0, ["no data for range", sep[i], "~", sep[i + 1]]
-    print("Range:", sep[i], "~", sep[i + 1], " #data", len(x))
+  print_ru_model(ret, sep)
 
-    x = np.array(x)
-    y = np.array(y)
-    a, r2 = linfit(x, y, aic=False, origin=(i == 0))
-    ret.append([a, sep[i], sep[i+1], len(x)])
 
-  # ret[0][0][0][1] = 3
+def print_ru_model(ret: list, sep: list):
+  """区間ごとの [係数, 下端, 上端, 件数] を common.py と navi.js の形式で表示する."""
+  # ret[0][0][1] = 3
   # 今日の日付
   today = datetime.date.today().strftime('%Y-%m-%d')
   print("#  common.py")
   print(f"    # separator {sep[1:-1]} {today}")
   print("__RU_MODEL = [")
   for i, rr in enumerate(ret):
-    r = rr[0][0]
+    r = rr[0]
     lh = comma_formatter(rr[1], 0)
     uh = comma_formatter(rr[2], 0)
 
     if i > 0:
-      b1, a1 = ret[i - 1][0][0]
-      b2, a2 = ret[i - 0][0][0]
+      b1, a1 = ret[i - 1][0]
+      b2, a2 = ret[i - 0][0]
       x = (b2 - b1) / (a1 - a2)
     else:
       x = 0
@@ -117,7 +161,7 @@ def seprat(g_jsons, sep):
   print()
   print("// js/navi.js # score2coin_orig()")
   for i, rr in enumerate(ret):
-    r = rr[0][0]
+    r = rr[0]
     print(f"    const a{i} = {r[1]};")
     print(f"    const b{i} = {r[0]};")
   print("    const model = [", end="")
@@ -125,50 +169,166 @@ def seprat(g_jsons, sep):
   print("];")
 
 
-def dir2list(data: dict) -> list:
-  ret = []
-  for vlist in data.values():
-    for v in vlist:
-      ret.append(v)
-  return ret
-
-
-def main():
-  import argparse
-
-  parser = argparse.ArgumentParser(description='')
-  parser.add_argument('args', nargs='+')
-  parser.add_argument('--xmin', default=0, type=int)
-  parser.add_argument('--xmax', default=100000000, type=int)
-  parser.add_argument('-s', type=int, action='append')
-  parser.add_argument('-n', default=1000, type=int)
-  parser.add_argument('--exclude', action='store_true',
-                      help='exclude some data according to is_excluded()')
-  parser.add_argument('--origin', action='store_true')
-  # parser.add_argument('-f', required=True)
-  # parser.add_argument('-f', required=True)
-  args = parser.parse_args()
+# seprat() の区間の上端
+SEPRAT_XMAX = 100000000
+
+
+class SegmentCosts:
+  """total_gift でソートしたデータの区間 [i, j) を直線であてはめた
+  残差平方和を O(1) で求める.
+
+  x, y, x^2, xy, y^2 の累積和を持つ. 最初の区間は原点を通る直線で
+  すべてのデータを使い, それ以降の区間は seprat() と同じく
+  is_excluded() のデータを除く. 区間の件数が min_samples より少ないか,
+  x がすべて同じ区間は inf.
+  """
+
+  def __init__(self, x, y, min_samples: int = 2):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    self.min_samples = max(min_samples, 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      keep = (~is_excluded(x, y)).astype(np.float64)
+
+    def cumsum(v):
+      return np.concatenate(([0], np.cumsum(v)))
+
+    # 原点を通る直線は x, y をずらせないのでそのまま
+    self.all_n = np.arange(len(x) + 1)
+    self.all_xx = cumsum(x * x)
+    self.all_xy = cumsum(x * y)
+    self.all_yy = cumsum(y * y)
+    # 桁落ちを抑えるため, 平均を引いてから足す
+    xc = x - x.mean() if len(x) else x
+    yc = y - y.mean() if len(y) else y
+    self.n = cumsum(keep)
+    self.x = cumsum(keep * xc)
+    self.y = cumsum(keep * yc)
+    self.xx = cumsum(keep * xc * xc)
+    self.xy = cumsum(keep * xc * yc)
+    self.yy = cumsum(keep * yc * yc)
+
+  def first(self, j):
+    """[0, j) を原点を通る直線であてはめた残差平方和."""
+    j = np.asarray(j)
+    sxx = self.all_xx[j]
+    sxy = self.all_xy[j]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      rss = self.all_yy[j] - sxy * sxy / sxx
+    return np.where((self.all_n[j] >= self.min_samples) & (sxx > 0),
+                    np.maximum(rss, 0), np.inf)
+
+  def later(self, i, j):
+    """[i, j) から is_excluded() を除いて直線であてはめた残差平方和."""
+    i = np.asarray(i)
+    n = self.n[j] - self.n[i]
+    sx = self.x[j] - self.x[i]
+    sy = self.y[j] - self.y[i]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      sxx = self.xx[j] - self.xx[i] - sx * sx / n
+      sxy = self.xy[j] - self.xy[i] - sx * sy / n
+      syy = self.yy[j] - self.yy[i] - sy * sy / n
+      rss = syy - sxy * sxy / sxx
+    ok = (n >= self.min_samples) & (sxx > 0)
+    return np.where(ok, np.maximum(rss, 0), np.inf)
+
+
+def round_between(lo: int, hi: int):
+  """lo < s < hi のうち, 末尾の 0 が最も多い整数.
+  そのような整数がなければ (lo + hi) / 2.
+
+  seprat() の区間は両端を含むので, lo や hi を返すと区切りちょうどの
+  データが両方の区間に入ってしまう.
+
+  >>> round_between(48765, 51234), round_between(179001, 179100)
+  (50000, 179010)
+  >>> round_between(5, 6)
+  5.5
+  """
+  p = 10 ** len(str(max(hi, 1)))
+  while p >= 1:
+    s = (lo // p + 1) * p
+    if s < hi:
+      return s
+    p //= 10
+  return (lo + hi) / 2
+
+
+@profiled('linfit.search')
+def search_separators(ds, k: int, min_samples: int = 30) -> tuple:
+  """seprat() の区間の残差平方和の合計が最小になる k 個の区切りを探す.
+
+  total_gift でソートして, 区切りの候補は total_gift が変わるところ.
+  区間 [i, j) の残差平方和は SegmentCosts で O(1) なので,
+  動的計画法で候補の数 m に対して O(k m^2).
+  区切りは前の区間の最大値と次の区間の最小値の間のきりのいい値にするので,
+  seprat() に渡すと同じ区間に分かれる.
+
+  returns (区切りのリスト, 残差平方和の合計)
+  """
+  x = ds['total_gift']
+  y = ds['livescore']
+  keep = (x >= 0) & (x <= SEPRAT_XMAX)
+  order = np.flatnonzero(keep)[np.argsort(x[keep], kind='stable')]
+  x = x[order]
+  y = y[order]
+  costs = SegmentCosts(x, y, min_samples)
+
+  # 区間の境界の候補. 同じ total_gift は同じ区間に入れる
+  cand = np.concatenate(([0], np.flatnonzero(np.diff(x)) + 1, [len(x)]))
+  m = len(cand)
+  best = costs.first(cand)
+  prev = []
+  for _ in range(k):
+    new = np.full(m, np.inf)
+    arg = np.zeros(m, dtype=np.int64)
+    for j in range(1, m):
+      c = best[:j] + costs.later(cand[:j], cand[j])
+      i = int(np.argmin(c))
+      new[j] = c[i]
+      arg[j] = i
+    best = new
+    prev.append(arg)
+
+  total = best[-1]
+  if not np.isfinite(total):
+    raise ValueError(f"cannot split {len(x)} samples into {k + 1} ranges"
+                     f" of {min_samples} samples")
+  bounds = []
+  j = m - 1
+  for arg in reversed(prev):
+    j = arg[j]
+    bounds.append(cand[j])
+  bounds.reverse()
+  sep = [round_between(int(x[b - 1]), int(x[b])) for b in bounds]
+  return sep, float(total)
+
+
+# design_matrix() と design_columns() の列の並びを変えたら上げる.
+# --incremental で保存した正規方程式の和はこれが違うと作り直す
+DESIGN_VERSION = 2
+
+
+@profiled('linfit.design')
+def design_matrix(records, exclude: bool):
+  """説明変数行列 xs, 目的変数 ys と, 入れ子の説明変数の列数 n を返す.
+
+  records が LiveDataset なら列のまま作る.
+  """
+  if isinstance(records, LiveDataset):
+    return design_columns(records, exclude)
 
   xs = []
   ys = []
   n = [0] * 4
 
-  jsons = readJsons(args.args)
-  print("limit: xmin =", args.xmin, ", xmax =", args.xmax)
-
-  if args.s:
-    seprat(jsons, [0] + args.s + [100000000])
-    return 0
-
-  jsons = limitedJsons(jsons, args.xmin, args.xmax, None, None)
+  for data in records:
 
-  for data in dir2list(jsons):
-
-    gift = np.array(data['gift'])
+    gift = np.asarray(data['gift'])
     gift_sum = data['total_gift']
 
     livescore = data['livescore']
-    if args.exclude and is_excluded(gift_sum, livescore):
+    if exclude and is_excluded(gift_sum, livescore):
       continue
 
     ys.append(livescore)
@@ -201,20 +361,408 @@ def main():
 
   xs = np.array(xs, dtype=np.float64)
   ys = np.array(ys, dtype=np.float64)
+  return xs, ys, n
+
+
+def design_columns(ds: LiveDataset, exclude: bool):
+  """design_matrix() の LiveDataset 版. 列の並びも同じ."""
+  if exclude:
+    ds = ds.filter(~is_excluded(ds['total_gift'], ds['livescore']))
+  xs = np.column_stack((np.ones(len(ds)), ds['total_gift'], ds['0coin'],
+                        ds.count_gifts_geq(100), ds.count_gifts_geq(5)))
+  ys = ds['livescore'].astype(np.float64)
+  return xs.astype(np.float64), ys, [2, 3, 4, 5]
+
+
+def iter_chunks(records, size: int):
+  """records を size 件ずつのリストにして返すジェネレータ."""
+  it = iter(records)
+  while True:
+    chunk = list(itertools.islice(it, size))
+    if not chunk:
+      return
+    yield chunk
+
+
+class NormalEquations:
+  """最小二乗法の正規方程式の和.
+
+  X^T X, X^T Y, ΣY, ΣY^2 と件数だけを持つので, メモリは説明変数の数 p
+  に対して O(p^2) で, データの件数によらない. add() で行をまとめて足す.
+  説明変数は入れ子なので, 先頭の k 列のあてはめも同じ和から求める.
+
+  X^T X は列の大きさが違うと条件数が悪くなる. 列をそろえた Cholesky 分解が
+  うまくいかないときのために, [X Y] の QR 分解の R も足していく.
+  R^T R = [X Y]^T [X Y] なので, 元の行がなくても QR で解き直せる.
+
+  >>> ne = NormalEquations(2)
+  >>> ne.add([[1, 0], [1, 1], [1, 2]], [1, 3, 5])
+  >>> a, r2, rss = ne.fit(2)
+  >>> a.round(6).tolist(), round(r2, 6), round(rss, 6)
+  ([1.0, 2.0], 1.0, 0.0)
+  >>> ne.fit(2, origin=True)[0].round(6).tolist()
+  [0.0, 2.6]
+  >>> ne2 = NormalEquations.from_dict(ne.to_dict())
+  >>> ne2 += ne
+  >>> ne2.cnt, ne2.fit(2)[0].round(6).tolist()
+  (6, [1.0, 2.0])
+  """
+
+  # 列の大きさをそろえた X^T X の条件数がこれより大きければ QR で解く
+  MAX_COND = 1e10
+
+  def __init__(self, p: int):
+    self.xtx = np.zeros((p, p))
+    self.xty = np.zeros(p)
+    self.sy = 0.0
+    self.syy = 0.0
+    self.cnt = 0
+    self.r = np.zeros((0, p + 1))
+
+  @property
+  def p(self) -> int:
+    return len(self.xty)
+
+  def add(self, X, Y) -> None:
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    if len(Y) == 0:
+      return
+    self.xtx += X.T @ X
+    self.xty += X.T @ Y
+    self.sy += Y.sum()
+    self.syy += Y @ Y
+    self.cnt += len(Y)
+    self._add_r(np.column_stack((X, Y)))
+
+  def __iadd__(self, other: 'NormalEquations') -> 'NormalEquations':
+    self.xtx += other.xtx
+    self.xty += other.xty
+    self.sy += other.sy
+    self.syy += other.syy
+    self.cnt += other.cnt
+    self._add_r(other.r)
+    return self
+
+  def _add_r(self, rows) -> None:
+    # [R; rows] の R は, これまでの行と rows をあわせた QR 分解の R
+    self.r = np.linalg.qr(np.vstack((self.r, rows)), mode='r')
+
+  def to_dict(self) -> dict:
+    """IncrementalState.aggregates に保存する形."""
+    return {'xtx': self.xtx.tolist(), 'xty': self.xty.tolist(),
+            'sy': float(self.sy), 'syy': float(self.syy), 'cnt': self.cnt,
+            'r': self.r.tolist()}
+
+  @classmethod
+  def from_dict(cls, d: dict) -> 'NormalEquations':
+    ne = cls(len(d['xty']))
+    ne.xtx = np.array(d['xtx'], dtype=np.float64).reshape(ne.p, ne.p)
+    ne.xty = np.array(d['xty'], dtype=np.float64)
+    ne.sy = d['sy']
+    ne.syy = d['syy']
+    ne.cnt = d['cnt']
+    ne.r = np.array(d['r'], dtype=np.float64).reshape(-1, ne.p + 1)
+    return ne
+
+  def solve(self, k: int = None, origin: bool = False) -> np.ndarray:
+    """先頭の k 列で最小二乗の係数を求める.
+
+    origin なら切片 (0 列目) を 0 にする. 長さ k の配列を返す.
+    """
+    k = self.p if k is None else k
+    cols = np.arange(1 if origin else 0, k)
+    a = np.zeros(k)
+    A = self.xtx[np.ix_(cols, cols)]
+    b = self.xty[cols]
+    d = np.sqrt(np.diag(A))
+    d[d == 0] = 1
+    try:
+      L = np.linalg.cholesky(A / np.outer(d, d))
+      diag = np.diag(L)
+      if (diag.max() / diag.min()) ** 2 > self.MAX_COND:
+        raise np.linalg.LinAlgError('ill-conditioned')
+      a[cols] = np.linalg.solve(L.T, np.linalg.solve(L, b / d)) / d
+    except np.linalg.LinAlgError:
+      a[cols] = self._solve_qr(cols)
+    return a
+
+  def _solve_qr(self, cols) -> np.ndarray:
+    m = len(cols)
+    r = np.linalg.qr(self.r[:, list(cols) + [self.p]], mode='r')
+    a, *_ = np.linalg.lstsq(r[:m, :m], r[:m, m], rcond=None)
+    return a
+
+  def rss(self, a) -> float:
+    """係数 a の残差平方和. |X a - Y|^2 = |R [a; -1]|^2"""
+    a = np.concatenate((a, np.zeros(self.p - len(a)), [-1]))
+    res = self.r @ a
+    return float(res @ res)
+
+  def tss(self) -> float:
+    return float(self.syy - self.sy * self.sy / self.cnt)
+
+  def fit(self, k: int = None, origin: bool = False) -> tuple:
+    """returns (係数, R^2, 残差平方和)"""
+    a = self.solve(k, origin)
+    rss = self.rss(a)
+    tss = self.tss()
+    assert tss > 0, (self.p, self.cnt)
+    return a, 1 - rss / tss, rss
+
+  def aic(self, k: int, rss: float) -> float:
+    return self.cnt * np.log(rss / self.cnt) + 2 * k
+
+  def vif(self, ks: list) -> list:
+    """先頭 k 列 (k in ks) の, 切片 (0 列目) を除く説明変数の VIF.
+
+    0 列目が切片のとき, R の 1 列目以降は平均を引いた X の R になる.
+    行が足りなければ None のリスト.
+    """
+    if len(self.r) < self.p:
+      return [None] * len(ks)
+    return vif_nested(self.r[1:self.p, 1:self.p], [k - 1 for k in ks])
+
+
+@profiled('linfit.fit')
+def linfit_sums(ne: NormalEquations, k: int, aic=False, origin=False):
+  """linfit() を正規方程式の和の先頭 k 列から計算する.
+
+  推定誤差の最小/最大はデータがないので表示しない.
+  """
+  a, r2, rss = ne.fit(k, origin)
+
+  print("# coeff #=", len(a), ", ", a)
+  print("R^2 =", r2)   # 1 に近い（大きい）ほど良い
+  if aic:
+    aic = ne.aic(len(a), rss)
+    print("aic =", aic)  # 小さいほど良い
+    _vif = ne.vif([k])[0]
+    if _vif is not None:
+      print("vif =", _vif)  # 小さいほど良い
+  print()
+  return a, r2
 
-  n = n[:args.n]
 
-  print("@@  #data=", len(ys), "#n=", len(n))
-  for i in range(len(n)):
-    xx = xs[:, :n[i]]
-    linfit(xx, ys, aic=True, origin=args.origin)
+def add_segments(sums: list, gift_sum, livescore, sep: list) -> None:
+  """seprat() と同じ区間ごとに [1, total_gift] の正規方程式の和を足す.
+
+  両端を含むので, 区切りちょうどのデータは両方の区間に入る.
+  最初の区間以外は is_excluded() のデータを除く.
+  """
+  gift_sum = np.asarray(gift_sum, dtype=np.float64)
+  livescore = np.asarray(livescore, dtype=np.float64)
+  excluded = is_excluded(gift_sum, livescore)
+  for i, ne in enumerate(sums):
+    keep = (gift_sum >= sep[i]) & (gift_sum <= sep[i + 1])
+    if i != 0:
+      keep &= ~excluded
+    x = gift_sum[keep]
+    ne.add(np.column_stack((np.ones(len(x)), x)), livescore[keep])
+
+
+def seprat_sums(sums: list, sep: list):
+  """seprat() を区間ごとの正規方程式の和から計算する."""
+  ret = []
+  for i, ne in enumerate(sums):
+    assert ne.cnt > 0, ["no data for range", sep[i], "~", sep[i + 1]]
+    print("Range:", sep[i], "~", sep[i + 1], " #data", ne.cnt)
+    a, r2 = linfit_sums(ne, 2, origin=(i == 0))
+    ret.append([a, sep[i], sep[i + 1], ne.cnt])
+  print_ru_model(ret, sep)
+
+
+# レコードを読みながら足すときの 1 回の行数
+CHUNK_SIZE = 4096
+
+
+@profiled('linfit.accumulate')
+def accumulate(sums, chunks, exclude: bool, sep: list = None):
+  """chunks (LiveDataset かレコードのリストの列) を正規方程式の和に足す.
+
+  sep がなければ design_matrix() の列の NormalEquations,
+  あれば区間ごとの NormalEquations のリスト. sums が None なら作る.
+  returns (sums, 足した件数)
+  """
+  n = 0
+  for chunk in chunks:
+    if sep:
+      if sums is None:
+        sums = [NormalEquations(2) for _ in sep[1:]]
+      if isinstance(chunk, LiveDataset):
+        gift_sum, livescore = chunk['total_gift'], chunk['livescore']
+      else:
+        gift_sum = [d['total_gift'] for d in chunk]
+        livescore = [d['livescore'] for d in chunk]
+      add_segments(sums, gift_sum, livescore, sep)
+      n += len(chunk)
+      continue
+    xs, ys, _ = design_matrix(chunk, exclude)
+    if len(ys) == 0:
+      continue
+    if sums is None:
+      sums = NormalEquations(xs.shape[1])
+    sums.add(xs, ys)
+    n += len(ys)
+  return sums, n
 
+
+def fit_sums(sums, args) -> int:
+  """accumulate() の和からあてはめて表示する."""
+  if args.s:
+    seprat_sums(sums, [0] + args.s + [SEPRAT_XMAX])
+    return 0
+  n = list(range(2, sums.p + 1))[:args.n]
+  for k in n:
+    linfit_sums(sums, k, aic=True, origin=args.origin)
+  vif_note()
+  return 0
+
+
+def main_incremental(args):
+  """前回からの新しいファイルだけを読み, 保存した正規方程式の和に足す."""
+  # 区間, 除外の境界線, 説明変数の並びが変わったら和を作り直す
+  state = IncrementalState(args.incremental,
+                           {'xmin': args.xmin, 'xmax': args.xmax,
+                            'exclude': args.exclude, 's': args.s,
+                            'seprat_xmax': SEPRAT_XMAX,
+                            'exclude_line': list(EXCLUDE_LINE),
+                            'design': DESIGN_VERSION})
+  ds = state.readNew(args.args, workers=args.jobs)
+  print("limit: xmin =", args.xmin, ", xmax =", args.xmax)
+  if not args.s:
+    # -s は seprat() と同じく全範囲を使う
+    ds = limitedJsons(ds, args.xmin, args.xmax, None, None)
+
+  sums = None
+  if args.s and state.aggregates:
+    sums = [NormalEquations.from_dict(d)
+            for d in state.aggregates['segments']]
+  elif state.aggregates:
+    sums = NormalEquations.from_dict(state.aggregates)
+  sums, new = accumulate(sums, [ds], args.exclude,
+                         [0] + args.s + [SEPRAT_XMAX] if args.s else None)
+  if sums is None:
+    print("no valid json data")
+    return 1
+  if args.s:
+    state.aggregates = {'segments': [ne.to_dict() for ne in sums]}
+  else:
+    state.aggregates = sums.to_dict()
+  state.save()
+
+  if not args.s:
+    print("@@  #data=", sums.cnt, "#new=", new,
+          "#n=", len(range(2, sums.p + 1)[:args.n]))
+  return fit_sums(sums, args)
+
+
+def main_stream(args):
+  """レコードを CHUNK_SIZE 件ずつ読み, 正規方程式の和だけを持ってあてはめる.
+
+  データ全体をメモリに載せない.
+  """
+  print("limit: xmin =", args.xmin, ", xmax =", args.xmax)
+  records = iter_records(args.args, workers=args.jobs)
+  if not args.s:
+    # -s は seprat() と同じく全範囲を使う
+    records = (d for d in records
+               if args.xmin <= d['total_gift'] <= args.xmax)
+  sums, _ = accumulate(None, iter_chunks(records, CHUNK_SIZE), args.exclude,
+                       [0] + args.s + [SEPRAT_XMAX] if args.s else None)
+  if sums is None:
+    print("no valid json data")
+    return 1
+  if not args.s:
+    print("@@  #data=", sums.cnt,
+          "#n=", len(range(2, sums.p + 1)[:args.n]))
+  return fit_sums(sums, args)
+
+
+def vif_note():
   print("  - aic: 小さいほど良い. 比較に使う")
   print("  - vif: 小さいほど良い. 5より大きいパラメータは多重共線性の疑いあり")
   print("        2=total_gift, 3= >=0coin, 4= >=100coin, 5= >=5coin")
   print()
 
 
+def main():
+  import argparse
+
+  parser = argparse.ArgumentParser(description='')
+  parser.add_argument('args', nargs='+')
+  parser.add_argument('--xmin', default=0, type=int)
+  parser.add_argument('--xmax', default=100000000, type=int)
+  parser.add_argument('-s', type=int, action='append')
+  parser.add_argument('--search', type=int, metavar='K',
+                      help="find the K separators for -s that minimize the"
+                      " total RSS of the ranges and fit seprat with them")
+  parser.add_argument('--min-samples', type=int, default=30,
+                      help="minimum number of samples in a range"
+                      " for --search (default: %(default)s)")
+  parser.add_argument('-n', default=1000, type=int)
+  parser.add_argument('--exclude', action='store_true',
+                      help='exclude some data according to is_excluded()')
+  parser.add_argument('--origin', action='store_true')
+  parser.add_argument('--incremental', metavar='STATE',
+                      help="read only files not yet recorded in STATE and"
+                      " fit from the normal-equation sums stored there")
+  parser.add_argument('--stream', action='store_true',
+                      help="read records in chunks and fit from the"
+                      " normal-equation sums; memory does not grow with"
+                      " the number of records")
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help="number of processes to read json files;"
+                      " 0 means all CPUs")
+  parser.add_argument('--doctest', action='store_true',
+                      help='Run doctest and exit.')
+  add_profile_arguments(parser)
+  # parser.add_argument('-f', required=True)
+  # parser.add_argument('-f', required=True)
+  args = parser.parse_args()
+  start_profile(args, 'linfit')
+
+  if args.doctest:
+    import doctest
+    doctest.testmod()
+    return 0
+
+  if args.search and (args.incremental or args.stream):
+    parser.error("--search needs all records in memory;"
+                 " it cannot be used with --incremental or --stream")
+  if args.incremental:
+    return main_incremental(args)
+  if args.stream:
+    return main_stream(args)
+
+  with profile_stage('read') as st:
+    ds = readDataset(args.args, workers=args.jobs)
+    st.records = len(ds)
+  print("limit: xmin =", args.xmin, ", xmax =", args.xmax)
+
+  if args.search:
+    s, rss = search_separators(ds, args.search, args.min_samples)
+    print("search: separator", s, "RSS =", rss)
+    args.s = s
+  if args.s:
+    seprat(ds, [0] + args.s + [SEPRAT_XMAX])
+    return 0
+
+  jsons = limitedJsons(ds, args.xmin, args.xmax, None, None)
+  xs, ys, n = design_matrix(jsons, args.exclude)
+
+  n = n[:args.n]
+
+  print("@@  #data=", len(ys), "#n=", len(n))
+  # 入れ子の説明変数の VIF は 1 回の分解からまとめて求める
+  vifs = vif_nested(centered_r(xs[:, 1:]), [k - 1 for k in n])
+  for i in range(len(n)):
+    xx = xs[:, :n[i]]
+    linfit(xx, ys, aic=True, origin=args.origin, vifs=vifs[i])
+
+  vif_note()
+
+
 if __name__ == '__main__':
   main()
 
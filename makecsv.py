@@ -7,19 +7,14 @@
 """
 
 import csv
+import os
 import sys
 import math
-import operator
+import itertools
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.ticker import FuncFormatter
-from common import is_excluded, ru_model, ru_model_x, readJsons, limitedJsons
-from common import set_ru_model, comma_formatter
-import re
-from typing import Callable
-
-plt.switch_backend('Agg')
-plt.rcParams["font.family"] = "Noto Sans CJK JP"
+from common import ru_model, readDataset, set_ru_model, iter_records
+from common import get_ru_model, LiveDataset, profile_stage, profiled
+from common import add_profile_arguments, start_profile
 
 
 def row_append_float(row, v: float, m: int = 1):
@@ -35,7 +30,16 @@ def row_append_float(row, v: float, m: int = 1):
     raise Exception(f"invalid m: {m}")
 
 
-def write_csv_file(fp, jsons: dict):
+# write_csv_file() がまとめて変換するレコード数
+CSV_CHUNK = 4096
+
+
+def write_csv_file(fp, jsons) -> int:
+  """jsons (LiveDataset, readJsons() の辞書, またはレコードの iterable)
+  を CSV で出力し, 出力した件数を返す.
+
+  行は csv_rows() でまとめて作る. 1 行ずつ作る write_csv_row() と同じ出力.
+  """
   writer = csv.writer(fp)
   if True:
     writer.writerow(['label', 'gift', 'livescore', '3xgift', '(ru)',
@@ -47,13 +51,154 @@ def write_csv_file(fp, jsons: dict):
                      'top1_ratio', 'top3_ratio', 'top5_ratio',
                      'top5%_ratio', 'top10%_ratio'])
 
-  for dirname, data_list in jsons.items():
-    for data in data_list:
-      write_csv_row(writer, data)
+  if isinstance(jsons, LiveDataset):
+    with profile_stage('csv.rows', len(jsons)):
+      rows = csv_rows(dataset_columns(jsons))
+    with profile_stage('csv.write', len(rows)):
+      writer.writerows(rows)
+    return len(jsons)
+
+  if isinstance(jsons, dict):
+    jsons = (data for data_list in jsons.values() for data in data_list)
+  n = 0
+  for chunk in iter(lambda: list(itertools.islice(jsons, CSV_CHUNK)), []):
+    with profile_stage('csv.rows', len(chunk)):
+      rows = csv_rows(record_columns(chunk))
+    with profile_stage('csv.write', len(rows)):
+      writer.writerows(rows)
+    n += len(chunk)
+  return n
+
+
+def dataset_columns(ds) -> dict:
+  """csv_rows() に渡す列を LiveDataset から作る."""
+  cols = {
+      'label': np.where(ds.has('label'), ds['label'],
+                        ds['filename']).tolist(),
+      'total_gift': ds['total_gift'],
+      'livescore': ds['livescore'],
+      'gift': ds.gift,
+      'start': ds.gift_start,
+      'length': ds['0coin'],
+  }
+  for k in ['user_rank', 'following', 'followers']:
+    cols[k] = [v if has else ''
+               for v, has in zip(ds[k].tolist(), ds.has(k).tolist())]
+  return cols
+
+
+def record_columns(records: list) -> dict:
+  """csv_rows() に渡す列を readJsons() 形式のレコードから作る."""
+  gifts = [data.get('gift', []) for data in records]
+  length = np.array([len(g) for g in gifts], dtype=np.int64)
+  cols = {
+      'label': [data.get('label', data['filename']) for data in records],
+      'total_gift': np.array([data['total_gift'] for data in records],
+                             dtype=np.int64),
+      'livescore': np.array([int(data.get('livescore', 0))
+                             for data in records], dtype=np.int64),
+      'gift': np.fromiter(itertools.chain.from_iterable(gifts),
+                          dtype=np.int64, count=int(length.sum())),
+      'start': np.concatenate(([0], np.cumsum(length)[:-1])).astype(np.int64),
+      'length': length,
+  }
+  for k in ['user_rank', 'following', 'followers']:
+    cols[k] = [data.get(k, '') for data in records]
+  return cols
+
 
+def csv_rows(cols: dict, model=None) -> list:
+  """write_csv_row() の行を全レコード分まとめて作る.
+
+  cols['gift'][cols['start'][i]:][:cols['length'][i]] が i 番目の
+  レコードのギフト. 集計は連結したギフト配列の累積和と,
+  レコード内でソートした配列の添字計算で行う.
+  model (RuModel) を省略すると set_ru_model() のモデルを使う.
+  """
+  total_gift = cols['total_gift']
+  livescore = cols['livescore']
+  length = cols['length']
+  if (total_gift == 0).any():
+    i = np.flatnonzero(total_gift == 0)[0]
+    raise Exception(f"0 total_gift: {cols['label'][i]}")
+
+  # レコードごとのギフトを連続した配列に並べ直す.
+  # 既に連続していれば (絞り込んでいない LiveDataset) コピーしない
+  offsets = np.concatenate(([0], np.cumsum(length)))
+  seg = np.repeat(np.arange(len(length)), length)
+  start = cols['start']
+  if len(start) and np.array_equal(start, offsets[:-1] + start[0]):
+    gifts = cols['gift'][start[0]:start[0] + offsets[-1]]
+  else:
+    gifts = cols['gift'][np.arange(offsets[-1]) - offsets[seg] + start[seg]]
+  head, end = offsets[:-1], offsets[1:]
+
+  def prefix(values):
+    # values のレコードごとの先頭 n 件の和を返す関数
+    cs = np.concatenate(([0], np.cumsum(values)))
+    return lambda n: cs[head + np.minimum(n, length)] - cs[head]
+
+  gift_sum = prefix(gifts)
+  n5 = prefix(gifts >= 5)(length)
+  if (n5 == 0).any():
+    i = np.flatnonzero(n5 == 0)[0]
+    raise ValueError(f"no gift >= 5: {cols['label'][i]}")
+
+  # レコード内で昇順にソート. 5コイン以上は末尾の n5 件
+  ordered = gifts[np.lexsort((gifts, seg))]
+
+  def median(base, n):
+    lo = ordered[base + (n - 1) // 2].astype(np.int64)
+    hi = ordered[base + n // 2]
+    return ((lo + hi) / 2).astype(np.int64)
+
+  # (0, 3) の区間では int になるので, 値はそのまま出力する
+  ru_score = (model or get_ru_model()).tolist(total_gift)
+  ret = [
+      cols['label'],
+      total_gift.tolist(),
+      livescore.tolist(),
+      (total_gift * 3).tolist(),
+      ru_score,
+      _format(livescore / total_gift, 3),
+      _format(np.array(ru_score, dtype=np.float64) / total_gift, 3),
+      cols['user_rank'],
+      cols['following'],
+      cols['followers'],
+      ordered[end - 1].tolist(),
+  ]
+  # p コイン以上のギフト人数
+  for p in [1000, 100, 10, 1, 0]:
+    ret.append(prefix(gifts >= p)(length).tolist())
 
+  # 5コイン以上/0コイン以上のギフト平均
+  ret.append(_format(prefix(np.where(gifts >= 5, gifts, 0))(length) / n5, 1))
+  ret.append(_format(gift_sum(length) / length, 1))
+
+  # 5コイン以上/0コイン以上のギフト中央値
+  ret.append(median(end - n5, n5).tolist())
+  ret.append(median(head, length).tolist())
+
+  # 1位のギフト割合
+  for n in [1, 3, 5]:
+    ret.append(_format(100 * gift_sum(n) / total_gift, 1))
+
+  # top5%, top10%
+  for p in [.05, .10]:
+    n = np.ceil(length * p).astype(np.int64)
+    ret.append(_format(100 * gift_sum(n) / total_gift, 1))
+
+  return list(zip(*ret))
+
+
+def _format(values, m: int) -> list:
+  # row_append_float() と同じ書式
+  return [f'{v:.{m}f}' for v in values.tolist()]
+
+
+@profiled('csv.row')
 def write_csv_row(writer, data: dict):
-  gifts = np.array(data.get('gift', []))
+  gifts = np.asarray(data.get('gift', []))
   livescore = int(data.get('livescore', 0))
   total_gift = data.get('total_gift', np.sum(gifts))
   if total_gift == 0:
@@ -100,459 +245,179 @@ def write_csv_row(writer, data: dict):
   writer.writerow(row)
 
 
-def get_sorted_xy(jsons: dict, slicer: Callable) -> list:
-  """(total_gift, livescore) のリストを取得し，
-  total_gift でソートして返す。
+# scatter.py に移した関数. matplotlib は使うときに読む
+_SCATTER_NAMES = ('get_sorted_xy', 'dimension_predicates', 'slice_dimensions',
+                  'slice_dimension', 'scatter_arrays', 'density_grid',
+                  'plot_rank_zones', 'ScatterTemplate', 'write_scatter',
+                  'template_kwargs', 'render_scatters', 'render_charts')
+
+
+def __getattr__(name: str):
+  if name in _SCATTER_NAMES:
+    import scatter
+    return getattr(scatter, name)
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _spec2argv(spec: dict) -> list[str]:
   """
-  xy = []
-  for dirname, data_list in jsons.items():
-    for data in data_list:
-      livescore = int(data.get('livescore', 0))
-      total_gift = data.get('total_gift', 0)
-      if total_gift == 0:
-        continue
-      xy.append((total_gift, livescore, data, slicer(data)))
-
-  # x でソートする
-  xy = sorted(xy, key=lambda v: v[0])
-  return xy
-
-
-def _get_operator(dimension: str):
-  if dimension.startswith('<='):
-    return operator.le, dimension[2:]
-  elif dimension.startswith('>='):
-    return operator.ge, dimension[2:]
-  compares = {'<': operator.lt,
-              '>': operator.gt,
-              '=': operator.eq}
-  if dimension[0] not in compares:
-    return operator.eq, dimension
-  return compares[dimension[0]], dimension[1:]
-
-
-def slice_dimensions(dimensions: list) -> Callable:
-  if len(dimensions) == 0:
-    return lambda d: True
-  funcs = [slice_dimension(dim) for dim in dimensions]
-  return lambda d: all(f(d) for f in funcs)
-
-
-def slice_dimension(dimension: str) -> Callable:
-  """はねていないデータ群
-
-  returns func(json_data) -> bool
-
-  >>> f = slice_dimension("rankS")
-  >>> f({'user_rank': 'S'})
-  True
+  チャート設定 (dict) をコマンドライン引数に戻す.
+  True はフラグ，list は繰り返し指定になる.
+
+  >>> _spec2argv({'scatter': 'a.png', 'no_model': True, 'dimension': ['10coin1', '>100coin2']})
+  ['--scatter', 'a.png', '--no-model', '--dimension', '10coin1', '--dimension', '>100coin2']
+  >>> _spec2argv({'xlim': 150000, 'no_rate': False})
+  ['--xlim', '150000']
   """
+  argv = []
+  for k, v in spec.items():
+    opt = '--' + k.replace('_', '-')
+    if v is True:
+      argv.append(opt)
+    elif v is False:
+      continue
+    else:
+      for x in v if isinstance(v, list) else [v]:
+        argv.extend([opt, str(x)])
+  return argv
 
-  if not dimension:
-    return lambda d: True
-  elif dimension == "exclude":
-    return lambda d: not is_excluded(d['total_gift'], d['livescore'])
-  elif not isinstance(dimension, str):
-    raise Exception(f"invalid dimension type: {type(dimension)}")
-
-  compare, dimension = _get_operator(dimension)
-
-  f = lambda d: True
-  ctype = int
-  if re.fullmatch(r'20\d\d[01]\d[0-3]\d', dimension):
-    key = 'date'
-    value = int(dimension)
-  elif re.fullmatch(r'score\d+', dimension):
-    key = 'livescore'
-    value = int(dimension[5:])
-  elif re.fullmatch(r'\d+(coin|gift)\d+', dimension):
-    m = re.fullmatch(r'(\d+)(coin|gift)(\d+)', dimension)
-    key = f'{m.group(1)}coin'
-    value = int(m.group(3))
-  elif re.fullmatch(r'100(coin|gift)\d+-\d+', dimension):
-    key = '10coin'
-    value = int(dimension.split('-')[1])
-    value2 = int(dimension.split('-')[0][7:])
-    f = lambda d: d['100coin'] == value2
-  elif re.fullmatch(r'20\d\d[01]\d[0-3]\d-\d+', dimension):
-    key = 'rank'
-    value = int(dimension.split('-')[1])
-    value2 = int(dimension.split('-')[0])
-    f = lambda d: int(d.get('date', 0)) == value2
-  elif re.fullmatch(r'rank[ABCDS][12345S]?', dimension):
-    ctype = str
-    key = 'user_rank'
-    value = dimension[4:]
-  else:
-    raise Exception(f"invalid dimension: {dimension}")
-
-  return lambda d: (compare(ctype(d.get(key, 0)), value) and f(d))
-
-
-def get_xyinvalid(xy: list) -> set:
-  xinvalid = set()
-  for i, (total_gift, livescore, _) in enumerate(xy):
-    if is_excluded(total_gift, livescore):
-      # 無効データ
-      xinvalid.add(i)
-    elif livescore / total_gift < 3 and total_gift < 20_000:
-      print(f"#invalid: gift={total_gift}, livescore={livescore}")
-      print("total_gift=", total_gift)
-      print("livescore=", livescore)
-      print("livescore / totalgift =", livescore / total_gift,)
-      print("-3*total_gift/130000 + 3 =",
-            -3 * total_gift / 130_000 + 3)
-  return xinvalid
-
-
-def get_ylim_ax1(xlim):
-  if xlim < 200_00:
-    ylim = 3 * xlim
-  elif xlim < 300_00:
-    ylim = 2.9 * xlim
-  else:
-    ylim = 2.8 * xlim
 
+def parse_scatter_spec(s: str) -> dict:
+  """
+  --scatter-spec の "key=value,key=value" を dict にする.
+  値のないキーはフラグ，同じキーの繰り返しは list になる.
 
-def set_xylim_ax1(ax1, xlim, ylim):
-  """左軸の x/y 軸範囲を設定する。
+  >>> parse_scatter_spec('scatter=a.png,heatmap=10coin,no-model')
+  {'scatter': 'a.png', 'heatmap': '10coin', 'no-model': True}
+  >>> parse_scatter_spec('scatter=b.png,dimension=10coin1,dimension=>100coin2')
+  {'scatter': 'b.png', 'dimension': ['10coin1', '>100coin2']}
   """
-  if xlim:
-    ax1.set_xlim(0, xlim)
-    if not ylim:
-      ylim = get_ylim_ax1(xlim)
-  else:
-    ax1.set_xlim(0, None)
-  if ylim:
-    ax1.set_ylim(0, ylim)
-  else:
-    ax1.set_ylim(0, None)
-  return ylim
-
-
-def plot_rank_zones(ax2, xlim, ymin: float, zorder=0):
-  assert isinstance(ymin, float), ymin
-  obi = {
-      # (min_+2, max_+6, color, max_+2, max_+4, xlim_max)
-      'SS': (1, 300_000, 810_000, 1_800_000),
-      'S': (0, 174_000, 430_000, 900_000),
-      'A5': (4, 130_000, 340_000, 730_000),
-      'A4': (3, 90_000, 220_000, 510_000),
-      'A3': (2, 70_000, 170_000, 360_000),
-      'A2': (1, 60_000, 120_000, 250_000),
-      'A1': (0, 45_000, 80_000, 160_000),
-      'B3': (4, 20_000, 50_000, 90_000),
-      'B2': (3, 12_000, 35_000, 80_000, 101_000),
-      'B1': (2, 12_000, 30_000, 65_000, 101_000),
-      'C3': (1, 4_000, 10_000, 15_000, 61_000),
-      'C2': (0, 1600, 4200, 10_000, 61_000),
-      'C1': (4, 600, 1500, 4200, 51_000),
-  }
+  spec = {}
+  for item in s.split(','):
+    k, sep, v = item.partition('=')
+    k = k.strip()
+    if not k:
+      continue
+    v = v if sep else True
+    if k in spec:
+      if not isinstance(spec[k], list):
+        spec[k] = [spec[k]]
+      spec[k].append(v)
+    else:
+      spec[k] = v
+  return spec
 
-  colors = ['#FFB6C1', '#FFD700', '#B0E0E6', '#98FB98', '#DDA0DD']
 
-  for rank, border in obi.items():
-    if len(border) == 4:
-      i, s2, s4, s6 = border
-      xlim_max = None
-    else:
-      i, s2, s4, s6, xlim_max = border
-    x2 = s2 / 3
-    x4 = s4 / 3
-    x6 = s6 / 3
-    color = colors[i]
-    y1 = ymin + 0.01 + i * 0.02
-    y2 = y1 + 0.01
-
-    if xlim_max and xlim >= xlim_max:
-      continue
-    if xlim <= x2:
-      continue
+def load_batch(fname: str) -> list[dict]:
+  """
+  --batch の TOML ファイルを読み，チャート設定の list を返す.
+  トップレベルのキーは全チャート共通の既定値，[[chart]] が 1 枚分.
 
-    ax2.fill_betweenx(
-        [y1, y2],
-        x2, x4,
-        color=color,
-        alpha=0.8,
-        zorder=zorder,
-    )
-    ax2.fill_betweenx(
-        [y1, y2],
-        x4, x6,
-        color=color,
-        alpha=0.4,
-        zorder=zorder,
-    )
-
-    if x6 > xlim:
-      x6 = xlim
-    xx = x2 + (x6 - x2) / 2
-
-    # ラベル
-    ax2.text(
-        x=xx,
-        y=y1 + 0.005,
-        s=rank,
-        color='black',
-        fontsize=10,
-        fontweight='bold',
-        horizontalalignment='center',
-        verticalalignment='center',
-        zorder=zorder,
-    )
-
-def write_scatter(fname: str, jsons: dict,
-                  plot_livescore: bool = True,
-                  plot_rate: bool = True,
-                  plot_model: bool = True,
-                  plot_3xmodel: bool = True,
-                  xlim=None, ylim=None, title: str = '',
-                  ymin: float = 2.4, ymax: float = 3.5,
-                  heatmap: str = None,
-                  cmap: str = 'jet',
-                  dimensions=[]):
-
-  fig, ax1 = plt.subplots()
-
-  ax2 = ax1.twinx()
-
-  # カンマ区切りフォーマット
-  ax1.yaxis.set_major_formatter(FuncFormatter(comma_formatter))
-  ax1.xaxis.set_major_formatter(FuncFormatter(comma_formatter))
-
-  ax1.set_xlabel('Gift (Coin)')
-  ax1.set_ylabel('Live Score')
-  ax2.set_ylabel('Live Score / Gift')
-
-  slicer = slice_dimensions(dimensions)
-  xy = get_sorted_xy(jsons, slicer)
-  assert len(xy) > 0
-
-  # ==================================
-  # 散布図
-  # ==================================
-
-  xinvalid = [v[0] for v in xy if not v[3]]
-  if plot_livescore:
-    # 左軸：gift - livescore の散布図を描画する
-    y_livescore = [v[1] for v in xy if not v[3]]
-    ax1.scatter(xinvalid, y_livescore,
-                color='#1f77b4', alpha=0.8, s=1, zorder=8,
-                marker='.')
-
-  if plot_rate:
-    # 右軸：livescore / gift の散布図を描画する
-    y_livescore_per_gift_invalid = [v[1] / v[0] for v in xy if not v[3]]
-    ax2.scatter(xinvalid, y_livescore_per_gift_invalid,
-                color='#FFCC00', alpha=0.8, s=1, zorder=8,
-                marker='.')
-
-  xvalid = [v[0] for v in xy if v[3]]
-  edgecolors = 'face'
-  linewidths = None
-  s = 2
-  if len(xinvalid) > 0:
-    edgecolors = 'black'
-    if len(xvalid) < 10:
-      s = 20
-    else:
-      s = 5
-
-  if plot_livescore:
-    # 左軸：gift - livescore の散布図を描画する
-    y_livescore = [v[1] for v in xy if v[3]]
-    ax1.scatter(xvalid, y_livescore,
-                label='Real score',
-                color='#1f77b4', alpha=0.3, s=s, marker="o",
-                edgecolors=edgecolors, linewidths=linewidths,
-                zorder=10)
-  if plot_rate:
-    # 右軸：livescore / gift の散布図を描画する
-    y_livescore_per_gift = [v[1] / v[0] for v in xy if v[3]]
-    label = 'Real score / gift'
-    if dimensions and len(dimensions) > 0:
-      label += f' ({",".join(dimensions)})'
-    if len(xvalid) != len(xy):
-      label += f' [{len(xvalid)}/{len(xy)}]'
-    else:
-      label += f' [{len(xy)} samples]'
-
-    if heatmap:
-      # ヒートマップ表示
-      c = [v[2][heatmap] for v in xy if v[3]]
-      if heatmap == 'class':
-        vmax = None
-        vmin = 0
-      elif heatmap == '0coin':
-        vmax = 50
-        vmin = 1
-      else:
-        vmax = 15
-        vmin = 1
-
-      sc = ax2.scatter(xvalid, y_livescore_per_gift, label=label,
-                       c=c, cmap=cmap,
-                       alpha=0.7, s=1, marker='.',
-                       edgecolors=edgecolors, linewidths=linewidths,
-                       zorder=10, vmin=vmin, vmax=vmax)
-      fig.colorbar(sc, ax=ax2, label=f'# of gifters (≧ {heatmap})',
-                   pad=0.10)
+    ymin = 1.6
+    no_model = true
 
-    else:
-      ax2.scatter(xvalid, y_livescore_per_gift, label=label,
-                  color='#FFCC00', alpha=0.3, s=s, marker='o',
-                  edgecolors=edgecolors, linewidths=linewidths,
-                  zorder=10)
-
-  if False:
-    # 薄紫色の補助線
-    ax2.plot([0, 150_000, 300_000], [3.05, 2.4, 1.75], color='#800080',
-             linestyle='dashed',
-             zorder=9, alpha=0.6)
-    ax2.plot([0, 300_000], [2.7, 1.6], color='#800080',
-             linestyle='dashed',
-             zorder=9, alpha=0.6)
-
-    xxx = np.arange(1, 600_000)
-    a0 = 2.9802304278833347
-    b0 = 1840.1205947642793
-    a1 = 2.6979201600185783
-    b1 = 15427.80639995219
-    a2 = 2.5422015819310215
-    b2 = 43967.846779877815
-
-    fnc = lambda x: min([a0 * x + b0,
-                         a1 * x + b1,
-                         a2 * x + b2])
-    yyy = [fnc(x) for x in xxx]
-    ax2.plot(xxx, yyy / xxx, color='#800080',
-             linestyle='dashed',
-             zorder=50, alpha=0.6)
-
-  # ==================================
-  # モデル線
-  # ==================================
-  x = [v[0] for v in xy]
-  xmin = 0
-  xmax = x[-1] * 1.05
-  if plot_livescore and plot_3xmodel:
-    # 左軸：gift - livescore のモデル線を描画する
-
-    # 旧モデル (３倍）
-    x_3 = [xmin, xmax]
-    y = [3 * v for v in x_3]
-    ax1.plot(x_3, y, label='3x gift',
-             color='#d62728', linestyle='dashed',
-             zorder=3, alpha=0.3)
-
-  if plot_livescore and plot_model:
-    # 新モデル
-    x_r = ru_model_x(xmin, xmax)
-    y = [ru_model(v) for v in x_r]
-    ax1.plot(x_r, y, label='(ru) model',
-             color='#2ca02c',
-             zorder=3, alpha=0.3)
-
-  if plot_rate and plot_model:
-    # 右軸：livescore / gift のモデル線を描画する
-    x_r = ru_model_x(xmin, xmax)
-    y = [ru_model(v) / v for v in x_r]
-    ax2.plot(x_r, y, label='(ru) model score / gift',
-             color='#2ca02c', linestyle='-.',
-             zorder=3, alpha=0.3)
-
-  # x/y 軸を原点交差
-  # ax1.spines['left'].set_position('zero')
-  # ax1.spines['bottom'].set_position('zero')
-  # ax2.spines['bottom'].set_color('none')
-  # ax2.spines['left'].set_color('none')
-
-  # ==================================
-  # ランク帯塗りつぶし
-  # ==================================
-  set_xylim_ax1(ax1, xlim or xmax, ylim)
-  xlim2 = xlim if xlim else xmax
-  plot_rank_zones(ax2, xlim2, ymin, zorder=1)
-
-  ax2.set_ylim(ymin, ymax)
-
-  yticks = np.arange(0.8, 4, 0.2)
-  ax2.set_yticks([v for v in yticks if ymin < v < ymax])
-
-  ax1.set_zorder(2)
-  ax2.set_zorder(1)
-  ax1.patch.set_visible(False)
-
-  ax1.set_title(title)
-  fig.legend(loc='upper center', bbox_to_anchor=(0.5, 0.93), ncol=1)
-
-  if not plot_rate:
-    plt.draw()  # 自動スケーリング
-
-    x_ticks = ax1.get_xticks()
-    y_ticks = 3 * x_ticks
-    ax1.set_yticks(y_ticks)
-    ax1.grid(True, color='#DDDDDD', linestyle='-', alpha=0.3)
-
-  ax1.grid(not plot_rate)
-  ax2.grid(plot_rate)
-  fig.tight_layout()
-  fig.savefig(fname)
-  plt.close(fig)
+    [[chart]]
+    scatter = "img/10coin-NNgifters.png"
+    heatmap = "10coin"
+    cmap = "turbo"
+  """
+  import tomllib
+
+  with open(fname, 'rb') as f:
+    conf = tomllib.load(f)
+  charts = conf.pop('chart', [])
+  return [conf | c for c in charts]
+
+
+def chart_args(chart_parser, args, spec: dict):
+  """コマンドラインの値を既定値として，spec で上書きした Namespace を返す"""
+  import copy
+
+  ns = copy.copy(args)
+  ns.scatter = None
+  ns.dimension = []   # --dimension はチャートごと
+  ns = chart_parser.parse_args(_spec2argv(spec), namespace=ns)
+  if not ns.scatter:
+    chart_parser.error(f"scatter is not specified: {spec}")
+  return ns
 
 
 def main() -> int:
   import argparse
 
-  parser = argparse.ArgumentParser(description='')
+  # チャートごとに変えられるオプション (--batch, --scatter-spec で上書き可)
+  chart_parser = argparse.ArgumentParser(add_help=False)
+  chart_parser.add_argument('--scatter', help="output scatter.png file")
+  chart_parser.add_argument('--dimension', help="dimension to slice",
+                            default=[], action='append')
+  chart_parser.add_argument('-x', '--xlim', type=int,
+                            help="Maximum value for the x-axis limit")
+  chart_parser.add_argument('-y', '--ylim', type=int,
+                            help="Maximum value for the y-axis limit (left)")
+  chart_parser.add_argument('--ymin', type=float, default=2.4,
+                            help="Minimum value for the y-axis limit (right)")
+  chart_parser.add_argument('--ymax', type=float, default=3.5,
+                            help="Maximum value for the y-axis limit (right)")
+  chart_parser.add_argument('-t', '--title',
+                            help="title for scatter plot")
+  chart_parser.add_argument('--no-livescore', action='store_true',
+                            help="do not plot live score")
+  chart_parser.add_argument('--no-rate', action='store_true',
+                            help="do not plot live score / gift rate")
+  chart_parser.add_argument('--no-model', action='store_true',
+                            help="do not plot model")
+  chart_parser.add_argument('--no-3x', action='store_true',
+                            help="do not plot 3x gift model")
+  chart_parser.add_argument('--heatmap', choices=['0coin', '10coin',
+                                                  '100coin', '1000coin',
+                                                  'class'])
+  chart_parser.add_argument('--cmap',
+                            choices=[
+                                     # Perceptually Uniform Sequential
+                                     'viridis', 'plasma', 'inferno', 'magma', 'cividis',
+                                     # Diverging
+                                     # 'managua', 'vanimo',
+                                     # Cyclic
+                                     'twilight', 'twilight_shifted', 'hsv',
+                                     # Qualiative
+                                     'tab20', 'tab20b', 'tab20c',
+                                     # miscellaneous
+                                     'jet', 'turbo', 'gist_rainbow'],
+                            default='jet')
+  chart_parser.add_argument('--render', choices=['points', 'density'],
+                            default='points',
+                            help="draw each sample, or a 2D histogram;"
+                            " default points")
+  chart_parser.add_argument('--bins', type=int, default=150,
+                            help="number of bins per axis for"
+                            " --render density; default 150")
+
+  parser = argparse.ArgumentParser(description='', parents=[chart_parser])
   parser.add_argument('args', nargs='+', help="input json files")
   parser.add_argument('-f', help="output csv file; default /dev/null",
                       default="/dev/null")
-  parser.add_argument('--scatter', help="output scatter.png file")
-  parser.add_argument('--dimension', help="dimension to slice",
-                      default=[], action='append')
-  parser.add_argument('-x', '--xlim', type=int,
-                      help="Maximum value for the x-axis limit")
-  parser.add_argument('-y', '--ylim', type=int,
-                      help="Maximum value for the y-axis limit (left)")
-  parser.add_argument('--ymin', type=float, default=2.4,
-                      help="Minimum value for the y-axis limit (right)")
-  parser.add_argument('--ymax', type=float, default=3.5,
-                      help="Maximum value for the y-axis limit (right)")
-  parser.add_argument('-t', '--title',
-                      help="title for scatter plot")
   parser.add_argument('--enc', choices=['utf-8', 'shift_jis'],
                       default='shift_jis',
                       help="output file encoding; default shift_jis")
-  parser.add_argument('--no-livescore', action='store_true',
-                      help="do not plot live score")
-  parser.add_argument('--no-rate', action='store_true',
-                      help="do not plot live score / gift rate")
-  parser.add_argument('--no-model', action='store_true',
-                      help="do not plot model")
-  parser.add_argument('--no-3x', action='store_true',
-                      help="do not plot 3x gift model")
   parser.add_argument('--ru-model', type=int, choices=[0, 1, 2, 3],
                       default=0)
-  parser.add_argument('--heatmap', choices=['0coin', '10coin',
-                                            '100coin', '1000coin',
-                                            'class'])
-  parser.add_argument('--cmap',
-                      choices=[
-                               # Perceptually Uniform Sequential
-                               'viridis', 'plasma', 'inferno', 'magma', 'cividis',
-                               # Diverging
-                               # 'managua', 'vanimo',
-                               # Cyclic
-                               'twilight', 'twilight_shifted', 'hsv',
-                               # Qualiative
-                               'tab20', 'tab20b', 'tab20c',
-                               # miscellaneous
-                               'jet', 'turbo', 'gist_rainbow'],
-                      default='jet')
+  parser.add_argument('--batch', metavar='SPEC.toml',
+                      help="render every [[chart]] in the TOML file")
+  parser.add_argument('--scatter-spec', default=[], action='append',
+                      metavar='KEY=VALUE,...',
+                      help="render a chart, e.g."
+                      " 'scatter=a.png,heatmap=10coin,cmap=turbo'")
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help="number of processes to read json files;"
+                      " 0 means all CPUs")
+  parser.add_argument('--render-jobs', type=int, default=1,
+                      help="number of processes to render charts;"
+                      " 0 means all CPUs")
   parser.add_argument('--doctest', action='store_true')
+  add_profile_arguments(parser)
 
   args = parser.parse_args()
+  start_profile(args, 'makecsv')
 
   if args.doctest:
     import doctest
@@ -560,36 +425,49 @@ def main() -> int:
     return 0
 
   set_ru_model(args.ru_model)
+
+  # 描画するチャートの一覧
+  specs = load_batch(args.batch) if args.batch else []
+  specs += [parse_scatter_spec(s) for s in args.scatter_spec]
+  charts = [chart_args(chart_parser, args, s) for s in specs]
+  if args.scatter:
+    charts.insert(0, args)
+
   fp = open(args.f, 'w', encoding=args.enc, newline='')
 
+  if not charts:
+    # CSV だけなら全体を読まずに流す
+    with profile_stage('csv') as st:
+      records = iter_records(args.args, workers=args.jobs)
+      # 空なら見出しも書かない
+      first = next(records, None)
+      if first is not None:
+        st.records = write_csv_file(fp, itertools.chain([first], records))
+    if first is None:
+      print("no valid json data")
+      return 1
+    return 0
+
   # #############################
   # 引数解析
   # #############################
-  jsons = readJsons(args.args)
-  if len(jsons) == 0:
+  with profile_stage('read') as st:
+    ds = readDataset(args.args, workers=args.jobs)
+    st.records = len(ds)
+  if len(ds) == 0:
     print("no valid json data")
     return 1
 
   # #############################
   # csv 出力
   # #############################
-  write_csv_file(fp, jsons)
+  if args.f != os.devnull:
+    with profile_stage('csv', len(ds)):
+      write_csv_file(fp, ds)
 
-  if args.scatter:
-    # 描画に不要なデータは先に削除
-    jsons = limitedJsons(jsons, None, args.xlim, args.ymin, args.ymax)
-
-    write_scatter(args.scatter, jsons,
-                  plot_livescore=not args.no_livescore,
-                  plot_rate=not args.no_rate,
-                  plot_model=not args.no_model,
-                  plot_3xmodel=not args.no_3x,
-                  xlim=args.xlim, ylim=args.ylim,
-                  ymin=args.ymin, ymax=args.ymax,
-                  title=args.title if args.title else '',
-                  heatmap=args.heatmap,
-                  cmap=args.cmap,
-                  dimensions=args.dimension)
+  with profile_stage('render', len(charts)):
+    from scatter import render_charts
+    render_charts(ds, charts, args.render_jobs, args.ru_model)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,721 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+makecsv.py の散布図を描く.
+
+matplotlib の読み込みとフォントの設定に時間がかかるので,
+makecsv.py は描画するときだけこのモジュールを読む.
+"""
+
+import os
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.ticker import FuncFormatter
+from common import is_excluded, ru_model_x, limitedJsons, set_ru_model
+from common import comma_formatter, LiveDataset, get_ru_model
+from common import parse_dimension, predicate_mask, profile_stage, profiled
+from typing import Callable
+
+matplotlib.use('Agg')
+plt.rcParams["font.family"] = "Noto Sans CJK JP"
+
+
+def get_sorted_xy(jsons: dict, slicer: Callable) -> list:
+  """(total_gift, livescore) のリストを取得し，
+  total_gift でソートして返す。
+  """
+  xy = []
+  for dirname, data_list in jsons.items():
+    for data in data_list:
+      livescore = int(data.get('livescore', 0))
+      total_gift = data.get('total_gift', 0)
+      if total_gift == 0:
+        continue
+      xy.append((total_gift, livescore, data, slicer(data)))
+
+  # x でソートする
+  xy = sorted(xy, key=lambda v: v[0])
+  return xy
+
+
+def dimension_predicates(dimensions: list) -> list:
+  """--dimension のリストを Predicate のリスト (すべて満たす) にする"""
+  return [p for dim in dimensions for p in parse_dimension(dim)]
+
+
+def slice_dimensions(dimensions: list) -> Callable:
+  preds = dimension_predicates(dimensions)
+  return lambda d: all(p(d) for p in preds)
+
+
+def slice_dimension(dimension: str) -> Callable:
+  """はねていないデータ群
+
+  returns func(json_data) -> bool
+
+  >>> f = slice_dimension("rankS")
+  >>> f({'user_rank': 'S'})
+  True
+  >>> slice_dimension("<20251013-5")({"rank": 3, "date": "20251013"})
+  True
+  """
+  return slice_dimensions([dimension])
+
+
+def scatter_arrays(data, dimensions: list, heatmap: str = None):
+  """
+  散布図の (total_gift, livescore, dimensions を満たすか, heatmap の列)
+  の配列を total_gift の昇順で返す. total_gift が 0 のデータは除く.
+  data は LiveDataset か readJsons() の辞書.
+  """
+  if isinstance(data, LiveDataset):
+    x = data['total_gift']
+    keep = np.flatnonzero(x != 0)
+    order = keep[np.argsort(x[keep], kind='stable')]
+    y = np.where(data.has('livescore'), data['livescore'], 0)
+    valid = predicate_mask(data, dimension_predicates(dimensions))
+    c = data[heatmap][order] if heatmap else None
+    return x[order], y[order], valid[order], c
+
+  xy = get_sorted_xy(data, slice_dimensions(dimensions))
+  x = np.array([v[0] for v in xy], dtype=np.int64)
+  y = np.array([v[1] for v in xy], dtype=np.int64)
+  valid = np.array([bool(v[3]) for v in xy], dtype=bool)
+  c = None
+  if heatmap:
+    c = np.array([v[2][heatmap] for v in xy])
+  return x, y, valid, c
+
+
+def get_xyinvalid(xy: list) -> set:
+  xinvalid = set()
+  for i, (total_gift, livescore, _) in enumerate(xy):
+    if is_excluded(total_gift, livescore):
+      # 無効データ
+      xinvalid.add(i)
+    elif livescore / total_gift < 3 and total_gift < 20_000:
+      print(f"#invalid: gift={total_gift}, livescore={livescore}")
+      print("total_gift=", total_gift)
+      print("livescore=", livescore)
+      print("livescore / totalgift =", livescore / total_gift,)
+      print("-3*total_gift/130000 + 3 =",
+            -3 * total_gift / 130_000 + 3)
+  return xinvalid
+
+
+def get_ylim_ax1(xlim):
+  if xlim < 200_00:
+    ylim = 3 * xlim
+  elif xlim < 300_00:
+    ylim = 2.9 * xlim
+  else:
+    ylim = 2.8 * xlim
+
+
+def set_xylim_ax1(ax1, xlim, ylim):
+  """左軸の x/y 軸範囲を設定する。
+  """
+  if xlim:
+    ax1.set_xlim(0, xlim)
+    if not ylim:
+      ylim = get_ylim_ax1(xlim)
+  else:
+    ax1.set_xlim(0, None)
+  if ylim:
+    ax1.set_ylim(0, ylim)
+  else:
+    ax1.set_ylim(0, None)
+  return ylim
+
+
+def plot_rank_zones(ax2, xlim, ymin: float, zorder=0) -> list:
+  """ランク帯を描画し，作成した artist のリストを返す"""
+  assert isinstance(ymin, float), ymin
+  obi = {
+      # (min_+2, max_+6, color, max_+2, max_+4, xlim_max)
+      'SS': (1, 300_000, 810_000, 1_800_000),
+      'S': (0, 174_000, 430_000, 900_000),
+      'A5': (4, 130_000, 340_000, 730_000),
+      'A4': (3, 90_000, 220_000, 510_000),
+      'A3': (2, 70_000, 170_000, 360_000),
+      'A2': (1, 60_000, 120_000, 250_000),
+      'A1': (0, 45_000, 80_000, 160_000),
+      'B3': (4, 20_000, 50_000, 90_000),
+      'B2': (3, 12_000, 35_000, 80_000, 101_000),
+      'B1': (2, 12_000, 30_000, 65_000, 101_000),
+      'C3': (1, 4_000, 10_000, 15_000, 61_000),
+      'C2': (0, 1600, 4200, 10_000, 61_000),
+      'C1': (4, 600, 1500, 4200, 51_000),
+  }
+
+  colors = ['#FFB6C1', '#FFD700', '#B0E0E6', '#98FB98', '#DDA0DD']
+  artists = []
+
+  for rank, border in obi.items():
+    if len(border) == 4:
+      i, s2, s4, s6 = border
+      xlim_max = None
+    else:
+      i, s2, s4, s6, xlim_max = border
+    x2 = s2 / 3
+    x4 = s4 / 3
+    x6 = s6 / 3
+    color = colors[i]
+    y1 = ymin + 0.01 + i * 0.02
+    y2 = y1 + 0.01
+
+    if xlim_max and xlim >= xlim_max:
+      continue
+    if xlim <= x2:
+      continue
+
+    artists.append(ax2.fill_betweenx(
+        [y1, y2],
+        x2, x4,
+        color=color,
+        alpha=0.8,
+        zorder=zorder,
+    ))
+    artists.append(ax2.fill_betweenx(
+        [y1, y2],
+        x4, x6,
+        color=color,
+        alpha=0.4,
+        zorder=zorder,
+    ))
+
+    if x6 > xlim:
+      x6 = xlim
+    xx = x2 + (x6 - x2) / 2
+
+    # ラベル
+    artists.append(ax2.text(
+        x=xx,
+        y=y1 + 0.005,
+        s=rank,
+        color='black',
+        fontsize=10,
+        fontweight='bold',
+        horizontalalignment='center',
+        verticalalignment='center',
+        zorder=zorder,
+    ))
+  return artists
+
+
+def density_grid(x, y, extent, bins, c=None):
+  """
+  (x, y) を extent = (x0, x1, y0, y1) の範囲で bins = (nx, ny) 個のビンに数える.
+  c を与えるとビンごとの c の平均になる. 点のないビンはマスクする.
+  imshow(origin='lower') 向けに (ny, nx) の配列を返す.
+
+  >>> density_grid([0.5, 0.6, 1.5], [0.5, 0.5, 1.5], (0, 2, 0, 2), (2, 2)).tolist()
+  [[2.0, None], [None, 1.0]]
+  >>> density_grid([0.5, 0.6, 1.5], [0.5, 0.5, 1.5], (0, 2, 0, 2), (2, 2),
+  ...              c=[1, 3, 5]).tolist()
+  [[2.0, None], [None, 5.0]]
+  """
+  x0, x1, y0, y1 = extent
+  rng = [[x0, x1], [y0, y1]]
+  cnt, _, _ = np.histogram2d(x, y, bins=bins, range=rng)
+  val = cnt
+  if c is not None:
+    s, _, _ = np.histogram2d(x, y, bins=bins, range=rng, weights=c)
+    val = s / np.where(cnt == 0, 1, cnt)
+  return np.ma.masked_array(val.T, mask=(cnt == 0).T)
+
+
+def _density_cmap(color: str):
+  """件数の少ないビンほど薄くなる単色のカラーマップ"""
+  from matplotlib.colors import LinearSegmentedColormap, to_rgba
+  return LinearSegmentedColormap.from_list(
+      color, [to_rgba(color, 0.3), to_rgba(color, 1.0)])
+
+
+class ScatterTemplate:
+  """
+  write_scatter() の図のひな型.
+  軸・書式・モデル線・ランク帯などの固定部分は 1 回だけ作り，
+  render() ごとに散布図の点と凡例だけを入れ替えて保存する.
+
+    with ScatterTemplate(xlim=150_000, heatmap='10coin') as t:
+      for n in range(1, 21):
+        t.render(f'10coin-{n}.png', jsons, dimensions=[f'10coin{n}'])
+  """
+
+  @profiled('scatter.template')
+  def __init__(self,
+               plot_livescore: bool = True,
+               plot_rate: bool = True,
+               plot_model: bool = True,
+               plot_3xmodel: bool = True,
+               xlim=None, ylim=None, title: str = '',
+               ymin: float = 2.4, ymax: float = 3.5,
+               heatmap: str = None,
+               cmap: str = 'jet',
+               render: str = 'points',
+               bins: int = 150,
+               model=None):
+    assert render in ('points', 'density'), render
+    self.plot_livescore = plot_livescore
+    self.plot_rate = plot_rate
+    self.xlim = xlim
+    self.ylim = ylim
+    self.title = title
+    self.ymin = ymin
+    self.ymax = ymax
+    self.heatmap = heatmap
+    self.cmap = cmap
+    self.bins = bins
+    # モデル線の RuModel. None なら set_ru_model() のモデル
+    self.model = model
+    # density: 点の代わりに 2 次元ヒストグラムの画像を描く
+    self._density = render == 'density'
+    self._images = {}
+
+    fig, ax1 = plt.subplots()
+    ax2 = ax1.twinx()
+    self.fig, self.ax1, self.ax2 = fig, ax1, ax2
+
+    # カンマ区切りフォーマット
+    ax1.yaxis.set_major_formatter(FuncFormatter(comma_formatter))
+    ax1.xaxis.set_major_formatter(FuncFormatter(comma_formatter))
+
+    ax1.set_xlabel('Gift (Coin)')
+    ax1.set_ylabel('Live Score')
+    ax2.set_ylabel('Live Score / Gift')
+
+    # ==================================
+    # 散布図 (点は render() で入れる)
+    # ==================================
+    self._ls_invalid = self._rate_invalid = None
+    self._ls_valid = self._rate_valid = None
+    if heatmap == 'class':
+      self._clim = (0, None)
+    elif heatmap == '0coin':
+      self._clim = (1, 50)
+    else:
+      self._clim = (1, 15)
+
+    if self._density:
+      # 点は render() で画像にするので，散布図は凡例用に空のまま置く
+      if plot_livescore:
+        self._ls_valid = ax1.scatter([], [], label='Real score',
+                                     color='#1f77b4', marker='s')
+      if plot_rate:
+        self._rate_valid = ax2.scatter([], [], color='#FFCC00', marker='s')
+    else:
+      if plot_livescore:
+        # 左軸：gift - livescore の散布図を描画する
+        self._ls_invalid = ax1.scatter([], [],
+                                       color='#1f77b4', alpha=0.8, s=1,
+                                       zorder=8, marker='.')
+      if plot_rate:
+        # 右軸：livescore / gift の散布図を描画する
+        self._rate_invalid = ax2.scatter([], [],
+                                         color='#FFCC00', alpha=0.8, s=1,
+                                         zorder=8, marker='.')
+      if plot_livescore:
+        self._ls_valid = ax1.scatter([], [],
+                                     label='Real score',
+                                     color='#1f77b4', alpha=0.3, marker="o",
+                                     zorder=10)
+      if plot_rate and heatmap:
+        # ヒートマップ表示
+        vmin, vmax = self._clim
+        self._rate_valid = ax2.scatter([], [], c=[], cmap=cmap,
+                                       alpha=0.7, s=1, marker='.',
+                                       zorder=10, vmin=vmin, vmax=vmax)
+      elif plot_rate:
+        self._rate_valid = ax2.scatter([], [],
+                                       color='#FFCC00', alpha=0.3, marker='o',
+                                       zorder=10)
+    self._colorbar = None
+
+    if False:
+      # 薄紫色の補助線
+      ax2.plot([0, 150_000, 300_000], [3.05, 2.4, 1.75], color='#800080',
+               linestyle='dashed',
+               zorder=9, alpha=0.6)
+      ax2.plot([0, 300_000], [2.7, 1.6], color='#800080',
+               linestyle='dashed',
+               zorder=9, alpha=0.6)
+
+      xxx = np.arange(1, 600_000)
+      a0 = 2.9802304278833347
+      b0 = 1840.1205947642793
+      a1 = 2.6979201600185783
+      b1 = 15427.80639995219
+      a2 = 2.5422015819310215
+      b2 = 43967.846779877815
+
+      fnc = lambda x: min([a0 * x + b0,
+                           a1 * x + b1,
+                           a2 * x + b2])
+      yyy = [fnc(x) for x in xxx]
+      ax2.plot(xxx, yyy / xxx, color='#800080',
+               linestyle='dashed',
+               zorder=50, alpha=0.6)
+
+    # ==================================
+    # モデル線 (x の範囲は render() で決める)
+    # ==================================
+    self._line_3x = self._line_model = self._line_rate_model = None
+    if plot_livescore and plot_3xmodel:
+      # 左軸：gift - livescore のモデル線を描画する
+
+      # 旧モデル (３倍）
+      self._line_3x, = ax1.plot([], [], label='3x gift',
+                                color='#d62728', linestyle='dashed',
+                                zorder=3, alpha=0.3)
+
+    if plot_livescore and plot_model:
+      # 新モデル
+      self._line_model, = ax1.plot([], [], label='(ru) model',
+                                   color='#2ca02c',
+                                   zorder=3, alpha=0.3)
+
+    if plot_rate and plot_model:
+      # 右軸：livescore / gift のモデル線を描画する
+      self._line_rate_model, = ax2.plot([], [],
+                                        label='(ru) model score / gift',
+                                        color='#2ca02c', linestyle='-.',
+                                        zorder=3, alpha=0.3)
+
+    # ==================================
+    # ランク帯塗りつぶし
+    # ==================================
+    # xlim がなければデータ依存なので render() で描く
+    self._zones = []
+    if xlim:
+      self._zones = plot_rank_zones(ax2, xlim, ymin, zorder=1)
+
+    ax2.set_ylim(ymin, ymax)
+
+    yticks = np.arange(0.8, 4, 0.2)
+    ax2.set_yticks([v for v in yticks if ymin < v < ymax])
+
+    ax1.set_zorder(2)
+    ax2.set_zorder(1)
+    ax1.patch.set_visible(False)
+
+    ax1.grid(not plot_rate)
+    ax2.grid(plot_rate)
+
+    self._legend = None
+    self._layout = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self) -> None:
+    plt.close(self.fig)
+
+  def _render_points(self, x, y, valid, c, label: str) -> None:
+    """散布図の点を入れ替える"""
+    rate = y / x
+    invalid = ~valid
+    if self._ls_invalid:
+      self._ls_invalid.set_offsets(np.column_stack([x[invalid], y[invalid]]))
+    if self._rate_invalid:
+      self._rate_invalid.set_offsets(
+          np.column_stack([x[invalid], rate[invalid]]))
+
+    nvalid = int(valid.sum())
+    edgecolors = 'face'
+    s = 2
+    if nvalid < len(x):
+      edgecolors = 'black'
+      if nvalid < 10:
+        s = 20
+      else:
+        s = 5
+
+    if self._ls_valid:
+      self._ls_valid.set_offsets(np.column_stack([x[valid], y[valid]]))
+      self._ls_valid.set_sizes([s])
+      self._ls_valid.set_edgecolor(edgecolors)
+    if self._rate_valid:
+      sc = self._rate_valid
+      sc.set_offsets(np.column_stack([x[valid], rate[valid]]))
+      sc.set_label(label)
+      sc.set_edgecolor(edgecolors)
+      if self.heatmap:
+        sc.set_array(np.asarray(c[valid], dtype=float))
+        # set_clim() は None を無視するので norm を直接戻す
+        sc.norm.vmin, sc.norm.vmax = self._clim
+        sc.autoscale_None()
+        if self._colorbar is None:
+          self._colorbar = self.fig.colorbar(
+              sc, ax=self.ax2, label=f'# of gifters (≧ {self.heatmap})',
+              pad=0.10)
+      else:
+        sc.set_sizes([s])
+
+  def _render_density(self, x, livescore, valid, c, xmax) -> float:
+    """
+    点を 2 次元ヒストグラムの画像にする.
+    heatmap はビンごとの平均. 左軸の y の上限を返す.
+    livescore を描かないときは _render_points() と同じく self.ylim.
+    """
+    rate = livescore / x
+    bins = (self.bins, self.bins)
+
+    ylim = self.ylim
+    if self.plot_livescore:
+      ylim = ylim or livescore.max() * 1.05
+      cmap = _density_cmap('#1f77b4')
+      extent = (0, xmax, 0, ylim)
+      self._set_image('ls_invalid', self.ax1, extent, 0.3, cmap,
+                      density_grid(x[~valid], livescore[~valid], extent, bins))
+      self._set_image('ls_valid', self.ax1, extent, 0.8, cmap,
+                      density_grid(x[valid], livescore[valid], extent, bins))
+
+    if self.plot_rate:
+      cmap = _density_cmap('#FFCC00')
+      extent = (0, xmax, self.ymin, self.ymax)
+      self._set_image('rate_invalid', self.ax2, extent, 0.3, cmap,
+                      density_grid(x[~valid], rate[~valid], extent, bins))
+      if self.heatmap:
+        c = np.asarray(c, dtype=float)
+        im = self._set_image('rate_valid', self.ax2, extent, 0.8, self.cmap,
+                             density_grid(x[valid], rate[valid], extent, bins,
+                                          c[valid]),
+                             clim=self._clim)
+        if self._colorbar is None:
+          self._colorbar = self.fig.colorbar(
+              im, ax=self.ax2, label=f'# of gifters (≧ {self.heatmap})',
+              pad=0.10)
+      else:
+        self._set_image('rate_valid', self.ax2, extent, 0.8, cmap,
+                        density_grid(x[valid], rate[valid], extent, bins))
+    return ylim
+
+  def _set_image(self, name: str, ax, extent, alpha: float, cmap, grid,
+                 clim=None):
+    """
+    name の画像を grid に入れ替える (なければ作る).
+    clim がなければ件数として対数で色付けする.
+    """
+    im = self._images.get(name)
+    if im is None:
+      from matplotlib.colors import LogNorm
+      im = ax.imshow(grid, extent=extent, origin='lower', aspect='auto',
+                     interpolation='nearest', cmap=cmap, alpha=alpha,
+                     norm=None if clim else LogNorm(), zorder=10)
+      self._images[name] = im
+    else:
+      im.set_data(grid)
+      im.set_extent(extent)
+    if clim:
+      im.norm.vmin, im.norm.vmax = clim
+      im.autoscale_None()
+    else:
+      im.norm.vmin = 1
+      im.norm.vmax = max(grid.max() if grid.count() else 0, 2)
+    return im
+
+  @profiled('scatter.render')
+  def render(self, fname: str, data, dimensions=[],
+             title: str = None) -> None:
+    """
+    data (LiveDataset か readJsons() の辞書) の散布図を描いて
+    fname に保存する
+    """
+    fig, ax1, ax2 = self.fig, self.ax1, self.ax2
+
+    with profile_stage('scatter.data') as st:
+      x, y, valid, c = scatter_arrays(data, dimensions, self.heatmap)
+      st.records = len(x)
+    assert len(x) > 0
+
+    xmin = 0
+    xmax = int(x[-1]) * 1.05
+
+    nvalid = int(valid.sum())
+    label = 'Real score / gift'
+    if dimensions and len(dimensions) > 0:
+      label += f' ({",".join(dimensions)})'
+    if nvalid != len(x):
+      label += f' [{nvalid}/{len(x)}]'
+    else:
+      label += f' [{len(x)} samples]'
+
+    # ==================================
+    # 散布図
+    # ==================================
+    ylim = self.ylim
+    if self._density:
+      ylim = self._render_density(x, y, valid, c, self.xlim or xmax)
+      if self._rate_valid:
+        self._rate_valid.set_label(label)
+    else:
+      self._render_points(x, y, valid, c, label)
+
+    # ==================================
+    # モデル線
+    # ==================================
+    if self._line_3x:
+      x_3 = [xmin, xmax]
+      self._line_3x.set_data(x_3, [3 * v for v in x_3])
+    if self._line_model or self._line_rate_model:
+      x_r = np.array(ru_model_x(xmin, xmax))
+      y = (self.model or get_ru_model()).many(x_r)
+      if self._line_model:
+        self._line_model.set_data(x_r, y)
+      if self._line_rate_model:
+        self._line_rate_model.set_data(x_r, y / x_r)
+
+    # ==================================
+    # 軸範囲とランク帯
+    # ==================================
+    # x は必ず固定するので，左軸の y だけ点とモデル線に合わせ直す
+    if self.plot_livescore:
+      ax1.relim()
+      for c in ax1.collections:
+        ax1.update_datalim(c.get_datalim(ax1.transData))
+      ax1.set_autoscaley_on(True)
+      ax1.autoscale_view(scalex=False)
+    set_xylim_ax1(ax1, self.xlim or xmax, ylim)
+    if not self.xlim:
+      for a in self._zones:
+        a.remove()
+      self._zones = plot_rank_zones(ax2, xmax, self.ymin, zorder=1)
+
+    ax1.set_title(self.title if title is None else title)
+    if self._legend:
+      self._legend.remove()
+    self._legend = fig.legend(loc='upper center',
+                              bbox_to_anchor=(0.5, 0.93), ncol=1)
+
+    if not self.plot_rate:
+      fig.canvas.draw_idle()  # 自動スケーリング
+
+      x_ticks = ax1.get_xticks()
+      y_ticks = 3 * x_ticks
+      ax1.set_yticks(y_ticks)
+      ax1.grid(True, color='#DDDDDD', linestyle='-', alpha=0.3)
+
+    # 目盛とタイトルが同じなら余白の計算は前回のまま
+    layout = (ax1.get_title(), ax1.get_xlim(), ax1.get_ylim(),
+              ax2.get_ylim(), self._colorbar and self._colorbar.norm.vmax)
+    if layout != self._layout:
+      # tight_layout() は現在の余白から計算するので初期値に戻してから
+      with profile_stage('scatter.layout'):
+        fig.subplots_adjust(**{k: plt.rcParams[f'figure.subplot.{k}']
+                               for k in ('left', 'right', 'bottom', 'top',
+                                         'wspace', 'hspace')})
+        fig.tight_layout()
+      self._layout = layout
+    with profile_stage('scatter.savefig'):
+      fig.savefig(fname)
+
+
+def write_scatter(fname: str, jsons,
+                  plot_livescore: bool = True,
+                  plot_rate: bool = True,
+                  plot_model: bool = True,
+                  plot_3xmodel: bool = True,
+                  xlim=None, ylim=None, title: str = '',
+                  ymin: float = 2.4, ymax: float = 3.5,
+                  heatmap: str = None,
+                  cmap: str = 'jet',
+                  dimensions=[],
+                  render: str = 'points',
+                  bins: int = 150):
+  with ScatterTemplate(plot_livescore=plot_livescore,
+                       plot_rate=plot_rate,
+                       plot_model=plot_model,
+                       plot_3xmodel=plot_3xmodel,
+                       xlim=xlim, ylim=ylim, title=title,
+                       ymin=ymin, ymax=ymax,
+                       heatmap=heatmap, cmap=cmap,
+                       render=render, bins=bins) as t:
+    t.render(fname, jsons, dimensions)
+
+
+def template_kwargs(args) -> dict:
+  """args (argparse.Namespace) から ScatterTemplate の引数を作る"""
+  return dict(plot_livescore=not args.no_livescore,
+              plot_rate=not args.no_rate,
+              plot_model=not args.no_model,
+              plot_3xmodel=not args.no_3x,
+              xlim=args.xlim, ylim=args.ylim,
+              ymin=args.ymin, ymax=args.ymax,
+              heatmap=args.heatmap,
+              cmap=args.cmap,
+              render=args.render,
+              bins=args.bins)
+
+
+def render_scatters(ds: LiveDataset, charts: list) -> None:
+  """
+  args (argparse.Namespace) のリストの散布図を出力する.
+  軸の設定が同じチャートは ScatterTemplate を使い回す.
+  """
+  groups = {}
+  for args in charts:
+    kw = template_kwargs(args)
+    groups.setdefault(tuple(kw.items()), []).append(args)
+
+  for key, group in groups.items():
+    kw = dict(key)
+    # 描画に不要なデータは先に削除
+    data = limitedJsons(ds, None, kw['xlim'], kw['ymin'], kw['ymax'])
+    with ScatterTemplate(**kw) as t:
+      for args in group:
+        t.render(args.scatter, data, args.dimension,
+                 title=args.title if args.title else '')
+
+
+# render_charts() のワーカーが持つデータ
+_RENDER_DS = None
+
+
+def _render_init(ds: LiveDataset, ru_model_idx: int) -> None:
+  global _RENDER_DS
+  _RENDER_DS = ds
+  # 親プロセスで表示済みなので表示しない
+  set_ru_model(ru_model_idx, verbose=False)
+
+
+def _render_some(charts: list) -> int:
+  render_scatters(_RENDER_DS, charts)
+  return len(charts)
+
+
+def render_charts(ds: LiveDataset, charts: list, jobs: int = 1,
+                  ru_model_idx: int = 0) -> None:
+  """
+  読み込み済みの ds から複数の散布図を出力する.
+  jobs != 1 ならプロセスプールで描画する (0 は全 CPU).
+  ds はワーカーごとに 1 回だけ渡す. ギフトは map_gift() したファイルを
+  開いた fd を渡して各ワーカーが mmap するので, ギフトの配列は渡さない.
+  """
+  if jobs == 1 or len(charts) <= 1:
+    render_scatters(ds, charts)
+    return
+
+  from concurrent.futures import ProcessPoolExecutor
+  jobs = jobs or os.cpu_count()
+  ds.map_gift()
+  # 同じ軸のチャートがなるべく同じワーカーに行くよう連続して分ける
+  size = -(-len(charts) // jobs)
+  chunks = [charts[i:i + size] for i in range(0, len(charts), size)]
+  with ProcessPoolExecutor(max_workers=len(chunks),
+                           initializer=_render_init,
+                           initargs=(ds, ru_model_idx)) as ex:
+    for _ in ex.map(_render_some, chunks):
+      pass
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
+
+# vim:set et ts=2 sts=2 sw=2 tw=80: